@@ -0,0 +1,81 @@
+"""
+Synthetic snapshot caches.
+
+Builds a cache with the same layout ``SnapshotCache`` reads
+(``ubuntu/<release>/amd64/<snapshot>/...``) and the matching upstream
+snapshot list. Files are sparse, so large caches are cheap to create and
+only cost the metadata the benchmarks are interested in.
+"""
+import os
+import random
+
+from datetime import datetime, timedelta
+from uuid import UUID
+
+from changes_lxc_wrapper.snapshot_cache import DATETIME_FORMAT
+
+RELEASES = ('precise', 'trusty')
+
+
+def make_cache_tree(root, snapshots=100, files_per_snapshot=20,
+                    file_size=1024 * 1024, projects=None, unknown_ratio=0.1,
+                    seed=0):
+    """
+    Create ``snapshots`` images under ``root`` and return the upstream
+    snapshot list describing them. A share of ``unknown_ratio`` images are
+    left out of the list, as if they had been invalidated, and the newest
+    image of each project is active.
+    """
+    rng = random.Random(seed)
+    if projects is None:
+        projects = max(1, snapshots // 5)
+    project_ids = [UUID(int=rng.getrandbits(128), version=4) for _ in range(projects)]
+    start = datetime(2014, 1, 1)
+
+    upstream = []
+    newest = {}
+    for n in range(snapshots):
+        image_id = UUID(int=rng.getrandbits(128), version=4)
+        release = RELEASES[n % len(RELEASES)]
+        path = os.path.join(root, 'ubuntu', release, 'amd64', str(image_id))
+        write_image(path, files_per_snapshot, file_size, rng)
+
+        if rng.random() < unknown_ratio:
+            continue
+        project_id = rng.choice(project_ids)
+        snapshot = {
+            'id': str(image_id),
+            'project': {'id': str(project_id)},
+            'dateCreated': (start + timedelta(hours=n)).strftime(DATETIME_FORMAT),
+            'isActive': False,
+            'images': [{'id': str(image_id)}],
+        }
+        upstream.append(snapshot)
+        newest[project_id] = snapshot
+
+    for snapshot in newest.values():
+        snapshot['isActive'] = True
+    return upstream
+
+
+def write_image(path, files, file_size, rng):
+    """
+    An image is a rootfs tarball and config, plus ``files`` spread over a
+    few subdirectories so walking it is representative of an extracted
+    tree.
+    """
+    os.makedirs(path)
+    with open(os.path.join(path, 'config'), 'w') as fp:
+        fp.write('lxc.utsname = benchmark\n')
+    write_sparse(os.path.join(path, 'rootfs.tar.xz'), file_size)
+
+    for n in range(files):
+        dirname = os.path.join(path, 'extra', str(n % 4))
+        os.makedirs(dirname, exist_ok=True)
+        write_sparse(os.path.join(dirname, 'file{}'.format(n)),
+                     rng.randint(0, file_size // 16))
+
+
+def write_sparse(path, size):
+    with open(path, 'wb') as fp:
+        fp.truncate(size)
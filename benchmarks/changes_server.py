@@ -0,0 +1,110 @@
+"""
+A local stand-in for the Changes API.
+
+Serves just enough of ``/api/0/`` for ``ChangesApi`` to talk to: the
+snapshot list, jobstep reads and updates, snapshot image updates and log
+appends (whose bytes are counted, then dropped). ``latency`` adds a fixed
+delay to every response to approximate a remote server.
+"""
+import json
+import re
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+API_PREFIX = '/api/0'
+
+JOBSTEP_RE = re.compile(r'^/jobsteps/([^/]+)/$')
+LOGAPPEND_RE = re.compile(r'^/jobsteps/([^/]+)/logappend/$')
+SNAPSHOT_IMAGE_RE = re.compile(r'^/snapshotimages/([^/]+)/$')
+
+
+class ChangesRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_path(self):
+        path = urlparse(self.path).path
+        if not path.startswith(API_PREFIX):
+            return None
+        return path[len(API_PREFIX):]
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            sleep(server.latency)
+
+        path = self.get_path()
+        if path == '/snapshots/':
+            return self.send_json(server.snapshots)
+
+        match = path and JOBSTEP_RE.match(path)
+        if match:
+            return self.send_json({
+                'id': match.group(1),
+                'status': {'id': 'in_progress'},
+            })
+
+        self.send_json({'error': 'Not found'}, 404)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if server.latency:
+            sleep(server.latency)
+
+        path = self.get_path()
+        match = path and LOGAPPEND_RE.match(path)
+        if match:
+            data = parse_qs(body.decode('utf-8'))
+            text = data.get('text', [''])[0]
+            with server.lock:
+                server.log_bytes += len(text.encode('utf-8'))
+                server.log_requests += 1
+            return self.send_json({'size': len(text)})
+
+        if path and (JOBSTEP_RE.match(path) or SNAPSHOT_IMAGE_RE.match(path)):
+            return self.send_json({})
+
+        self.send_json({'error': 'Not found'}, 404)
+
+
+class ChangesServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), snapshots=(), latency=0):
+        HTTPServer.__init__(self, address, ChangesRequestHandler)
+        self.snapshots = list(snapshots)
+        self.latency = latency
+        self.lock = Lock()
+        self.log_bytes = 0
+        self.log_requests = 0
+
+    @property
+    def url(self):
+        return 'http://{}:{}{}/'.format(
+            self.server_address[0], self.server_address[1], API_PREFIX)
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,170 @@
+"""
+Timing, memory measurement and baseline comparison for the benchmarks.
+"""
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+from contextlib import redirect_stdout
+from time import perf_counter
+
+from changes_lxc_wrapper.cgroup import percentile
+
+PERCENTILES = (50, 90, 99)
+
+
+class Benchmark(object):
+    """
+    A benchmark of one code path.
+
+    ``setup`` runs once and ``teardown`` once at the end. Before each
+    iteration ``prepare`` returns the arguments for ``run``, outside of the
+    timed region. ``run`` returns the amount of work it did, in ``unit``s,
+    which throughput is reported in.
+
+    ``budget`` is the most (in seconds) the median run may take, whatever
+    the baseline says. Memory is only measured with ``trace_memory``, as
+    it means nothing for work done in other processes.
+    """
+    name = None
+
+    unit = 'items'
+
+    budget = None
+
+    trace_memory = True
+
+    def setup(self):
+        pass
+
+    def prepare(self):
+        return ()
+
+    def run(self, *args):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+def measure(benchmark, iterations=20, warmup=2):
+    """
+    Returns a result dict for ``benchmark``. Latency comes from untraced
+    iterations; peak memory from one more run under tracemalloc, as
+    tracing slows everything down.
+    """
+    # anything printed by the code under test is noise here
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        benchmark.setup()
+        try:
+            for _ in range(warmup):
+                benchmark.run(*benchmark.prepare())
+
+            latencies = []
+            total_units = 0
+            for _ in range(iterations):
+                args = benchmark.prepare()
+                gc.collect()
+                start = perf_counter()
+                total_units += benchmark.run(*args)
+                latencies.append(perf_counter() - start)
+
+            peak_memory = None
+            if benchmark.trace_memory:
+                args = benchmark.prepare()
+                gc.collect()
+                tracemalloc.start()
+                try:
+                    benchmark.run(*args)
+                    peak_memory = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+        finally:
+            benchmark.teardown()
+
+    elapsed = sum(latencies)
+    result = {
+        'iterations': iterations,
+        'unit': benchmark.unit,
+        'throughput': total_units / elapsed if elapsed else None,
+        'peak_memory': peak_memory,
+        'budget': benchmark.budget,
+    }
+    for pct in PERCENTILES:
+        result['p{}'.format(pct)] = percentile(latencies, pct)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of ``(name, metric, baseline, current)`` for every
+    metric which got worse than the baseline by more than ``tolerance``
+    (a fraction). Benchmarks missing from the baseline are skipped.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        for metric in ('p50', 'peak_memory'):
+            if expected.get(metric) and result[metric] is not None and \
+                    result[metric] > expected[metric] * (1 + tolerance):
+                regressions.append((name, metric, expected[metric], result[metric]))
+        if expected.get('throughput') and \
+                result['throughput'] < expected['throughput'] / (1 + tolerance):
+            regressions.append((name, 'throughput', expected['throughput'],
+                                result['throughput']))
+    return regressions
+
+
+def check_budgets(results):
+    """
+    Returns ``(name, 'budget', budget, p50)`` for every benchmark whose
+    median exceeded its budget.
+    """
+    return [(name, 'budget', result['budget'], result['p50'])
+            for name, result in sorted(results.items())
+            if result.get('budget') and result['p50'] > result['budget']]
+
+
+def load_baseline(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(path, results, params):
+    with open(path, 'w') as fp:
+        json.dump({'params': params, 'results': results}, fp, indent=2, sort_keys=True)
+        fp.write('\n')
+
+
+def format_size(value):
+    if value is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB'):
+        if value < 1024:
+            return '{:.1f} {}'.format(value, unit)
+        value /= 1024.0
+    return '{:.1f} GB'.format(value)
+
+
+def write_report(results, baseline=None, stream=sys.stdout):
+    baseline = baseline or {}
+    stream.write('{:<32} {:>20} {:>10} {:>10} {:>10} {:>10} {:>9}\n'.format(
+        'benchmark', 'throughput', 'p50 ms', 'p90 ms', 'p99 ms', 'memory', 'vs base'))
+    for name, result in sorted(results.items()):
+        throughput = '-'
+        if result['throughput'] is not None:
+            throughput = '{:.0f} {}/s'.format(result['throughput'], result['unit'])
+        change = '-'
+        expected = baseline.get(name)
+        if expected and expected.get('p50'):
+            change = '{:+.0%}'.format(result['p50'] / expected['p50'] - 1)
+        stream.write('{:<32} {:>20} {:>10.2f} {:>10.2f} {:>10.2f} {:>10} {:>9}\n'.format(
+            name, throughput, result['p50'] * 1000, result['p90'] * 1000,
+            result['p99'] * 1000, format_size(result['peak_memory']), change))
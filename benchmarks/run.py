@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the wrapper's hot paths.
+
+Runs entirely on one host without LXC: ``lxc`` is replaced by an
+in-process fake, Changes by a local HTTP server and the snapshot cache by a
+synthetic tree. Reports throughput, latency percentiles and peak memory of
+each benchmark and compares them with a stored baseline, exiting non-zero
+if anything regressed by more than the tolerance.
+
+    python3 benchmarks/run.py
+    python3 benchmarks/run.py --snapshots 2000 --filter snapshot_cache
+    python3 benchmarks/run.py --save-baseline
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from argparse import Namespace
+from collections import deque
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_lxc  # noqa
+fake_lxc.install()
+
+from cache_tree import make_cache_tree  # noqa
+from changes_server import ChangesServer  # noqa
+from harness import (  # noqa
+    Benchmark, check_budgets, compare, load_baseline, measure, save_baseline,
+    write_report
+)
+
+from changes_lxc_wrapper.api import ChangesApi  # noqa
+from changes_lxc_wrapper.cli.manager import ManagerCommand  # noqa
+from changes_lxc_wrapper.log_reporter import LogReporter, chunked  # noqa
+from changes_lxc_wrapper.snapshot_cache import SnapshotCache, get_directory_size  # noqa
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+JOBSTEP_ID = 'a5b1a1f2-64b5-4b4b-9b1c-0d3ac3b8f3a9'
+
+# runs a console script's main() as its entry point wrapper would, with the
+# fake lxc module
+ENTRY_POINT_SCRIPT = """
+import sys
+import fake_lxc
+fake_lxc.install()
+from changes_lxc_wrapper.cli.{} import main
+sys.argv[0] = {!r}
+sys.exit(main())
+"""
+
+# a helper daemon whose commands do nothing, for timing the client alone
+NOOP_DAEMON_SCRIPT = """
+import sys
+from changes_lxc_wrapper.daemon import HelperDaemon
+
+class NoopCommand(object):
+    def prepare(self, argv):
+        pass
+
+    def execute(self, argv):
+        pass
+
+server = HelperDaemon(sys.argv[1], NoopCommand())
+print('ready', flush=True)
+server.serve_forever()
+"""
+
+
+def make_log_lines(size):
+    """
+    Console output of roughly ``size`` bytes: mostly short lines, with the
+    occasional very long one (minified output, progress bars).
+    """
+    lines = []
+    total = 0
+    n = 0
+    while total < size:
+        if n % 100 == 99:
+            line = 'x' * 20000 + '\n'
+        else:
+            line = 'line {} of some build output {}\n'.format(n, '.' * (n % 80))
+        lines.append(line)
+        total += len(line)
+        n += 1
+    return lines
+
+
+class Environment(object):
+    """
+    State shared between benchmarks: the Changes server and the synthetic
+    snapshot cache.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.root = tempfile.mkdtemp(prefix='changes-lxc-bench-')
+        self.cache_path = os.path.join(self.root, 'cache')
+        upstream = make_cache_tree(
+            self.cache_path,
+            snapshots=args.snapshots,
+            files_per_snapshot=args.files_per_snapshot,
+        )
+        self.server = ChangesServer(snapshots=upstream, latency=args.latency).start()
+        self.api = ChangesApi(self.server.url)
+
+    def close(self):
+        self.server.stop()
+        shutil.rmtree(self.root)
+
+
+class ChunkedBenchmark(Benchmark):
+    name = 'log_reporter.chunked'
+
+    unit = 'bytes'
+
+    def __init__(self, env):
+        self.lines = make_log_lines(env.args.log_bytes)
+        self.size = sum(len(l) for l in self.lines)
+
+    def prepare(self):
+        return (deque(self.lines),)
+
+    def run(self, buffer):
+        for chunk in chunked(buffer):
+            pass
+        return self.size
+
+
+class LogReporterBenchmark(Benchmark):
+    name = 'log_reporter.process'
+
+    unit = 'bytes'
+
+    def __init__(self, env):
+        self.env = env
+        # every chunk is a request, so this sends much less than chunked
+        self.lines = [l.encode('utf-8') for l in make_log_lines(env.args.log_bytes // 16)]
+        self.size = sum(len(l) for l in self.lines)
+
+    def run(self):
+        # as in the wrapper: output is written while the reporter uploads it
+        reporter = LogReporter(self.env.api, JOBSTEP_ID)
+        reporter_thread = Thread(target=reporter.process)
+        reporter_thread.start()
+        for line in self.lines:
+            reporter.write(line)
+        reporter.close()
+        reporter_thread.join()
+        return self.size
+
+
+class ApiRequestBenchmark(Benchmark):
+    name = 'api.request'
+
+    unit = 'requests'
+
+    def __init__(self, env):
+        self.env = env
+        self.requests = env.args.requests
+
+    def run(self):
+        api = self.env.api
+        for n in range(self.requests):
+            if n % 2:
+                api.get_jobstep(JOBSTEP_ID)
+            else:
+                api.append_log(JOBSTEP_ID, {'text': 'line {}\n'.format(n),
+                                            'source': 'console'})
+        return self.requests
+
+
+class SnapshotCacheBenchmark(Benchmark):
+    """
+    Initializing from the metadata, as most manager runs do.
+    """
+    name = 'snapshot_cache.initialize'
+
+    unit = 'snapshots'
+
+    reconcile = False
+
+    def __init__(self, env):
+        self.env = env
+
+    def setup(self):
+        SnapshotCache(self.env.cache_path, self.env.api, reconcile=True).initialize()
+
+    def prepare(self):
+        return (SnapshotCache(self.env.cache_path, self.env.api, reconcile=self.reconcile),)
+
+    def run(self, cache):
+        cache.initialize()
+        return len(cache.snapshots)
+
+
+class SnapshotCacheReconcileBenchmark(SnapshotCacheBenchmark):
+    """
+    Initializing with a full walk of the cache and upstream refresh.
+    """
+    name = 'snapshot_cache.reconcile'
+
+    reconcile = True
+
+
+class DirectorySizeBenchmark(Benchmark):
+    name = 'get_directory_size'
+
+    unit = 'files'
+
+    def __init__(self, env):
+        self.path = env.cache_path
+        self.files = sum(len(f) for _, _, f in os.walk(self.path))
+
+    def run(self):
+        get_directory_size(self.path)
+        return self.files
+
+
+class StartupBenchmark(Benchmark):
+    """
+    Time from starting a console script to its exit, which for quick
+    commands is mostly interpreter startup and imports.
+    """
+    unit = 'runs'
+
+    trace_memory = False
+
+    module = None
+
+    def __init__(self, env):
+        self.env = env
+        self.subprocess_env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([os.path.dirname(BENCHMARK_DIR), BENCHMARK_DIR]),
+        )
+
+    def get_args(self):
+        return ['--help']
+
+    def run(self):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                [sys.executable, '-c', ENTRY_POINT_SCRIPT.format(self.module, self.script)] +
+                self.get_args(), stdout=devnull, env=self.subprocess_env)
+        return 1
+
+
+class HelperStartupBenchmark(StartupBenchmark):
+    name = 'startup.changes-lxc'
+
+    script = 'changes-lxc'
+
+    module = 'helper'
+
+    budget = 0.15
+
+
+class ClientStartupBenchmark(StartupBenchmark):
+    """
+    A command forwarded to a helper daemon (which does nothing with it).
+    """
+    name = 'startup.changes-lxc-client'
+
+    script = 'changes-lxc-client'
+
+    module = 'client'
+
+    budget = 0.1
+
+    def setup(self):
+        path = os.path.join(self.env.root, 'helper.sock')
+        self.daemon = subprocess.Popen(
+            [sys.executable, '-c', NOOP_DAEMON_SCRIPT, path],
+            stdout=subprocess.PIPE, env=self.subprocess_env)
+        assert self.daemon.stdout.readline() == b'ready\n', "Helper daemon failed to start"
+        self.subprocess_env['CHANGES_LXC_SOCKET'] = path
+        self.subprocess_env['CHANGES_LXC_NO_FALLBACK'] = '1'
+
+    def get_args(self):
+        return ['exec', 'benchmark', '--', 'true']
+
+    def teardown(self):
+        self.daemon.kill()
+        self.daemon.wait()
+
+
+class WrapperStartupBenchmark(StartupBenchmark):
+    name = 'startup.changes-lxc-wrapper'
+
+    script = 'changes-lxc-wrapper'
+
+    module = 'wrapper'
+
+    budget = 0.25
+
+
+class ManagerStartupBenchmark(StartupBenchmark):
+    """
+    Listing the synthetic cache, served from its metadata.
+    """
+    name = 'startup.changes-snapshot-manager'
+
+    script = 'changes-snapshot-manager'
+
+    module = 'manager'
+
+    budget = 0.25
+
+    def setup(self):
+        SnapshotCache(self.env.cache_path, self.env.api, reconcile=True).initialize()
+
+    def get_args(self):
+        return ['--api-url', self.env.server.url, '--cache-path', self.env.cache_path,
+                'list', '--format', 'json']
+
+
+class CleanupBenchmark(Benchmark):
+    """
+    A dry run cleanup which has to evict everything it can, so every
+    policy is exercised without touching the tree.
+    """
+    name = 'manager.run_cleanup'
+
+    unit = 'snapshots'
+
+    def __init__(self, env):
+        self.env = env
+        self.command = ManagerCommand()
+        self.cleanup_args = Namespace(
+            dry_run=True, ttl=None, max_disk=0, max_disk_per_class=1,
+            max_rootfs_disk=0, max_package_disk=None, max_workspace_size=None,
+            max_workspace_disk=None)
+
+    def setup(self):
+        SnapshotCache(self.env.cache_path, self.env.api, reconcile=True).initialize()
+
+    def prepare(self):
+        cache = SnapshotCache(self.env.cache_path, self.env.api)
+        cache.initialize()
+        return (cache,)
+
+    def run(self, cache):
+        count = len(cache.snapshots)
+        self.command.run_cleanup(cache, self.cleanup_args)
+        return count
+
+
+BENCHMARKS = (
+    ChunkedBenchmark,
+    LogReporterBenchmark,
+    ApiRequestBenchmark,
+    SnapshotCacheBenchmark,
+    SnapshotCacheReconcileBenchmark,
+    DirectorySizeBenchmark,
+    CleanupBenchmark,
+    HelperStartupBenchmark,
+    ClientStartupBenchmark,
+    WrapperStartupBenchmark,
+    ManagerStartupBenchmark,
+)
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--filter', action='append', default=[],
+                        help="Only run benchmarks whose name contains this (may be repeated)")
+    parser.add_argument('--iterations', type=int, default=20,
+                        help="Timed iterations of each benchmark")
+    parser.add_argument('--warmup', type=int, default=2,
+                        help="Untimed iterations before timing")
+    parser.add_argument('--snapshots', type=int, default=200,
+                        help="Snapshots in the synthetic cache")
+    parser.add_argument('--files-per-snapshot', type=int, default=20,
+                        help="Extra files in each synthetic snapshot")
+    parser.add_argument('--log-bytes', type=int, default=4 * 1024 * 1024,
+                        help="Bytes of console output to chunk")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="API requests per iteration")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Seconds the fake Changes server waits before responding")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help="Baseline results to compare against")
+    parser.add_argument('--save-baseline', action='store_true', default=False,
+                        help="Store these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Fraction a metric may be worse than the baseline by")
+    return parser
+
+
+def get_params(args):
+    """
+    The arguments which change what is measured; results are only compared
+    against a baseline taken with the same ones.
+    """
+    return {
+        'snapshots': args.snapshots,
+        'files_per_snapshot': args.files_per_snapshot,
+        'log_bytes': args.log_bytes,
+        'requests': args.requests,
+        'latency': args.latency,
+    }
+
+
+def main(argv=None):
+    args = get_arg_parser().parse_args(argv)
+
+    benchmarks = [b for b in BENCHMARKS
+                  if not args.filter or any(f in b.name for f in args.filter)]
+    assert benchmarks, "No benchmarks match {}".format(args.filter)
+
+    print("==> Creating synthetic cache with {} snapshots".format(args.snapshots))
+    env = Environment(args)
+    results = {}
+    try:
+        for benchmark_cls in benchmarks:
+            print("==> Running {}".format(benchmark_cls.name))
+            results[benchmark_cls.name] = measure(
+                benchmark_cls(env), args.iterations, args.warmup)
+    finally:
+        env.close()
+
+    params = get_params(args)
+    stored = load_baseline(args.baseline)
+    baseline = None
+    if stored is None:
+        print("==> No baseline found at {}".format(args.baseline))
+    elif stored['params'] != params:
+        print("==> Baseline was taken with different parameters ({}), not comparing".format(
+            stored['params']))
+    else:
+        baseline = stored['results']
+
+    print()
+    write_report(results, baseline)
+
+    if args.save_baseline:
+        if stored and stored['params'] == params:
+            # keep results of benchmarks which weren't run this time
+            results = dict(stored['results'], **results)
+        save_baseline(args.baseline, results, params)
+        print("==> Saved baseline to {}".format(args.baseline))
+        return 0
+
+    regressions = check_budgets(results)
+    if baseline:
+        regressions.extend(compare(results, baseline, args.tolerance))
+    for name, metric, expected, actual in regressions:
+        print("==> REGRESSION: {} {} was {:.6g}, now {:.6g}".format(
+            name, metric, expected, actual))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
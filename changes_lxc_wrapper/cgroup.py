@@ -0,0 +1,326 @@
+"""
+Helpers for reading a container's cgroup accounting through the lxc API and
+for translating per-job resource limits into cgroup config.
+
+The readers only rely on ``get_cgroup_item`` and ``running`` so they work with any
+object exposing the same interface as ``lxc.Container``.
+"""
+import math
+import os
+import re
+import sys
+
+from collections import deque, namedtuple
+from threading import Event, Thread
+from time import time
+
+
+def get_cgroup_value(container, key):
+    try:
+        value = container.get_cgroup_item(key)
+    except (KeyError, ValueError):
+        return None
+    if value is False or value is None:
+        return None
+    return value
+
+
+def parse_int(value):
+    if value is None:
+        return None
+    try:
+        return int(value.strip())
+    except ValueError:
+        return None
+
+
+def parse_blkio(value):
+    """
+    Parse blkio.throttle.io_service_bytes, summing reads and writes across
+    all devices.
+    """
+    result = {'read': 0, 'write': 0}
+    if not value:
+        return result
+    for line in value.splitlines():
+        parts = line.split()
+        if len(parts) != 3:
+            continue
+        op = parts[1].lower()
+        if op in result:
+            result[op] += int(parts[2])
+    return result
+
+
+def parse_flat_keyed(value):
+    """
+    Parse files such as cpu.stat and memory.stat ("key value" per line).
+    """
+    result = {}
+    if not value:
+        return result
+    for line in value.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            result[parts[0]] = int(parts[1])
+    return result
+
+
+def read_cgroup_stats(container):
+    """
+    Returns a flat dict of the counters we care about, or an empty dict if
+    the container is not running (and therefore has no cgroup).
+    """
+    if not container.running:
+        return {}
+
+    stats = {}
+    for key, name in (('cpuacct.usage', 'cpu_ns'),
+                      ('memory.usage_in_bytes', 'memory_bytes'),
+                      ('memory.max_usage_in_bytes', 'memory_peak_bytes')):
+        value = parse_int(get_cgroup_value(container, key))
+        if value is not None:
+            stats[name] = value
+
+    blkio = get_cgroup_value(container, 'blkio.throttle.io_service_bytes')
+    if blkio is not None:
+        io = parse_blkio(blkio)
+        stats['io_read_bytes'] = io['read']
+        stats['io_write_bytes'] = io['write']
+
+    return stats
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of an unsorted list.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+Sample = namedtuple('Sample', [
+    'time', 'cpu_ns', 'memory_bytes', 'io_read_bytes', 'io_write_bytes',
+    'pids',
+])
+
+
+class CgroupSampler(object):
+    """
+    Periodically samples a running container's cgroup accounting into a
+    fixed size ring buffer, flagging memory pressure and CPU throttling as
+    they happen.
+    """
+    def __init__(self, container, interval=1.0, size=3600, stream=None):
+        self.container = container
+        self.interval = interval
+        self.samples = deque(maxlen=size)
+        self.stream = stream
+        self.done = Event()
+        self.thread = Thread(target=self.process)
+        self.thread.daemon = True
+
+        # both counters are cumulative for the life of the cgroup, so keep
+        # the first reading to report only what happened while sampling
+        self.memory_failcnt = None
+        self.memory_failcnt_start = None
+        self.nr_throttled = None
+        self.nr_throttled_start = None
+
+    def log(self, message):
+        print(message, file=self.stream or sys.stdout)
+
+    def start(self):
+        self.done.clear()
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        # capture the final state so totals cover the whole run
+        self.sample()
+
+    def process(self):
+        while not self.done.is_set():
+            self.sample()
+            self.done.wait(self.interval)
+
+    def sample(self):
+        container = self.container
+        if not container.running:
+            return
+
+        io = parse_blkio(get_cgroup_value(
+            container, 'blkio.throttle.io_service_bytes'))
+        self.samples.append(Sample(
+            time=time(),
+            cpu_ns=parse_int(get_cgroup_value(container, 'cpuacct.usage')) or 0,
+            memory_bytes=parse_int(get_cgroup_value(container, 'memory.usage_in_bytes')) or 0,
+            io_read_bytes=io['read'],
+            io_write_bytes=io['write'],
+            pids=parse_int(get_cgroup_value(container, 'pids.current')) or 0,
+        ))
+
+        failcnt = parse_int(get_cgroup_value(container, 'memory.failcnt'))
+        if failcnt is not None:
+            if self.memory_failcnt is not None and failcnt > self.memory_failcnt:
+                self.log("==> Memory pressure: container hit its memory limit {} times".format(
+                    failcnt - self.memory_failcnt))
+            if self.memory_failcnt_start is None:
+                self.memory_failcnt_start = failcnt
+            self.memory_failcnt = failcnt
+
+        throttled = parse_flat_keyed(get_cgroup_value(
+            container, 'cpu.stat')).get('nr_throttled')
+        if throttled is not None:
+            if self.nr_throttled is not None and throttled > self.nr_throttled:
+                self.log("==> CPU throttled: {} periods".format(
+                    throttled - self.nr_throttled))
+            if self.nr_throttled_start is None:
+                self.nr_throttled_start = throttled
+            self.nr_throttled = throttled
+
+    def summary(self):
+        """
+        Peak and percentile figures for the samples collected so far. Rates
+        are computed between consecutive samples.
+        """
+        samples = list(self.samples)
+        if not samples:
+            return {}
+
+        cpu, read, write = [], [], []
+        for prev, cur in zip(samples, samples[1:]):
+            elapsed = cur.time - prev.time
+            if elapsed <= 0:
+                continue
+            cpu.append((cur.cpu_ns - prev.cpu_ns) / elapsed / 1e9)
+            read.append((cur.io_read_bytes - prev.io_read_bytes) / elapsed)
+            write.append((cur.io_write_bytes - prev.io_write_bytes) / elapsed)
+
+        memory = [s.memory_bytes for s in samples]
+        result = {
+            'samples': len(samples),
+            'memory_peak_bytes': max(memory),
+            'memory_p50_bytes': percentile(memory, 50),
+            'memory_p95_bytes': percentile(memory, 95),
+            'pids_peak': max(s.pids for s in samples),
+            'io_read_bytes': samples[-1].io_read_bytes - samples[0].io_read_bytes,
+            'io_write_bytes': samples[-1].io_write_bytes - samples[0].io_write_bytes,
+        }
+        if cpu:
+            result.update({
+                'cpu_peak_cores': max(cpu),
+                'cpu_p50_cores': percentile(cpu, 50),
+                'cpu_p95_cores': percentile(cpu, 95),
+                'io_read_peak_bps': max(read),
+                'io_write_peak_bps': max(write),
+            })
+        if self.memory_failcnt != self.memory_failcnt_start:
+            result['memory_failcnt'] = self.memory_failcnt - self.memory_failcnt_start
+        if self.nr_throttled != self.nr_throttled_start:
+            result['nr_throttled'] = self.nr_throttled - self.nr_throttled_start
+        return result
+
+
+def parse_size_value(value):
+    value = value.lower()
+    match = re.match(r'(\d+)(gb|g|mb|m|kb|k|b)?', value)
+    if not match:
+        raise ValueError('Unable to parse size value')
+
+    number = int(match.group(1))
+    key = match.group(2)
+
+    if key in ('gb', 'g'):
+        return number * 1024 * 1024 * 1024
+    elif key in ('mb', 'm'):
+        return number * 1024 * 1024
+    elif key in ('kb', 'k'):
+        return number * 1024
+    return number
+
+
+# Maps launch limit names to the cgroup setting they control
+LIMIT_KEYS = (
+    ('cpu_shares', 'cpu.shares'),
+    ('cpuset', 'cpuset.cpus'),
+    ('memory_limit', 'memory.limit_in_bytes'),
+    ('blkio_weight', 'blkio.weight'),
+)
+
+
+def parse_limits(data):
+    """
+    Collect any limits present in ``data`` (parsed arguments or jobstep data).
+    """
+    return dict(
+        (name, data[name]) for name, _ in LIMIT_KEYS
+        if data.get(name) is not None
+    )
+
+
+NUMA_NODE_ROOT = '/sys/devices/system/node'
+
+
+def get_numa_nodes(root=NUMA_NODE_ROOT):
+    """
+    Returns a dict of NUMA node id to its cpulist (i.e. "0-7,16-23").
+    """
+    nodes = {}
+    if not os.path.isdir(root):
+        return nodes
+    for name in os.listdir(root):
+        match = re.match(r'^node(\d+)$', name)
+        if not match:
+            continue
+        with open(os.path.join(root, name, 'cpulist')) as fp:
+            cpulist = fp.read().strip()
+        if cpulist:
+            nodes[int(match.group(1))] = cpulist
+    return nodes
+
+
+def choose_numa_node(nodes, containers):
+    """
+    Pick the NUMA node with the fewest running containers pinned to it.
+    """
+    if not nodes:
+        return None
+
+    usage = dict((node, 0) for node in nodes)
+    for container in containers:
+        mems = get_cgroup_value(container, 'cpuset.mems')
+        if not mems or not mems.strip().isdigit():
+            # unpinned or spread across several nodes
+            continue
+        node = int(mems)
+        if node in usage:
+            usage[node] += 1
+    return min(sorted(usage), key=lambda n: usage[n])
+
+
+def get_limit_config(limits, nodes=None, containers=()):
+    """
+    Translate job limits into (config key, value) pairs for the container.
+
+    A cpuset of "auto" pins the container to a whole NUMA node (both cpus
+    and memory) chosen by ``choose_numa_node``.
+    """
+    config = []
+    for name, key in LIMIT_KEYS:
+        value = limits.get(name)
+        if value is None:
+            continue
+        if name == 'cpuset' and value == 'auto':
+            node = choose_numa_node(nodes or {}, containers)
+            if node is None:
+                continue
+            config.append(('lxc.cgroup.cpuset.cpus', nodes[node]))
+            config.append(('lxc.cgroup.cpuset.mems', str(node)))
+            continue
+        config.append(('lxc.cgroup.{}'.format(key), str(value)))
+    return config
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+A thin ``changes-lxc`` which hands its command to the helper daemon
+(``changes-lxc daemon``), so each call costs a round trip over a local
+socket rather than a full helper startup. Takes the same arguments as
+``changes-lxc``. Without a daemon the command runs in-process, unless
+CHANGES_LXC_NO_FALLBACK is set.
+
+The daemon's socket may be set with CHANGES_LXC_SOCKET.
+"""
+import os
+import sys
+
+from ..daemon import DEFAULT_SOCKET, DaemonError, forward
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    path = os.environ.get('CHANGES_LXC_SOCKET', DEFAULT_SOCKET)
+
+    try:
+        returncode = forward(path, argv)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if os.environ.get('CHANGES_LXC_NO_FALLBACK'):
+            print("==> No changes-lxc daemon listening on {}".format(path), file=sys.stderr)
+            sys.exit(1)
+        # the heavy imports are only paid for when there's no daemon
+        from .helper import main as helper_main
+        helper_main(argv)
+        return
+    except DaemonError as e:
+        print("==> {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import io
+import json
 import logging
+import os
+import sys
 
-from raven.handlers.logging import SentryHandler
+from contextlib import redirect_stderr
 from uuid import UUID
 
-from ..container import Container
+from ..cgroup import parse_limits, parse_size_value
+from ..clone import CLONE_BACKENDS
+from ..daemon import DEFAULT_SOCKET, FORWARDED_COMMANDS, HelperDaemon
+from ..package_cache import parse_package_caches
+from ..sentry import configure_logging
+from ..snapshot_cache import SNAPSHOT_CACHE
 
 
 DESCRIPTION = "LXC helper for running Changes jobs"
@@ -15,6 +24,9 @@ DEFAULT_RELEASE = 'precise'
 
 DEFAULT_USER = 'ubuntu'
 
+# changes_lxc_wrapper.peers.DEFAULT_PORT, which isn't imported until needed
+DEFAULT_PEER_PORT = 8411
+
 
 class CommandError(Exception):
     pass
@@ -23,6 +35,9 @@ class CommandError(Exception):
 class HelperCommand(object):
     def __init__(self, argv=None):
         self.argv = argv
+        self.parser = None
+        # container handles kept between commands when running as a daemon
+        self.containers = None
 
     def get_arg_parser(self):
         parser = argparse.ArgumentParser(description=DESCRIPTION)
@@ -41,7 +56,7 @@ class HelperCommand(object):
             help="Release")
         launch_parser.add_argument(
             '--no-validate', action='store_false', default=True, dest='validate',
-            help="Don't validate downloaded images")
+            help="Only check sizes of cached images, not their hashes")
         launch_parser.add_argument(
             '--clean', action='store_true', default=False,
             help="Use a fresh container from Ubuntu minimal install")
@@ -57,6 +72,44 @@ class HelperCommand(object):
         launch_parser.add_argument(
             '--post-launch',
             help="Command to run after container is launched")
+        launch_parser.add_argument(
+            '--cpu-shares', type=int,
+            help="Relative CPU weight of the container")
+        launch_parser.add_argument(
+            '--cpuset',
+            help="CPUs to pin the container to (i.e. 0-3), or 'auto' for the least busy NUMA node")
+        launch_parser.add_argument(
+            '--memory-limit',
+            help="Memory limit for the container (i.e. 4G)")
+        launch_parser.add_argument(
+            '--blkio-weight', type=int,
+            help="Relative block IO weight of the container (10-1000)")
+        launch_parser.add_argument(
+            '--package-cache', type=parse_package_caches, default=[], dest='package_caches',
+            help="Mount host package caches into the container (i.e. apt,pip,npm,maven)")
+        launch_parser.add_argument(
+            '--project',
+            help="Project the build belongs to, which package caches are kept per")
+        launch_parser.add_argument(
+            '--workspace', action='append', dest='workspaces', default=[],
+            help="Directory in the container (i.e. a ccache directory) kept "
+                 "between the project's jobs (may be repeated)")
+        launch_parser.add_argument(
+            '--clone-backend', choices=['auto'] + sorted(CLONE_BACKENDS), default='auto',
+            help="How to clone the snapshot's rootfs (default: detected from the cache's filesystem)")
+        launch_parser.add_argument(
+            '--tmpfs', type=parse_size_value, dest='tmpfs_size',
+            help="Keep the container's writes in a tmpfs of this size (i.e. 4G), "
+                 "if the host has the memory to spare")
+        launch_parser.add_argument(
+            '--tmpfs-required', action='store_true', default=False,
+            help="Fail rather than write to disk when there isn't the memory for --tmpfs")
+        launch_parser.add_argument(
+            '--peer', action='append', dest='peers', default=[],
+            help="URL of another host serving its image cache (may be repeated)")
+        launch_parser.add_argument(
+            '--peers-file',
+            help="File listing peer URLs, one per line")
 
         exec_parser = subparsers.add_parser('exec', help='Execute a command within a container')
         exec_parser.add_argument(
@@ -86,50 +139,156 @@ class HelperCommand(object):
             'path', nargs=argparse.REMAINDER,
             help="Local script to run inside the container")
 
+        exec_batch_parser = subparsers.add_parser(
+            'exec-batch', help='Execute a list of commands within a container, attaching once')
+        exec_batch_parser.add_argument(
+            '--user', '-u', default=DEFAULT_USER,
+            help="User to run commands as, unless a command says otherwise")
+        exec_batch_parser.add_argument(
+            '--cwd',
+            help="Working directory for commands, unless a command says otherwise")
+        exec_batch_parser.add_argument(
+            '--keep-going', action='store_false', default=True, dest='fail_fast',
+            help="Run the remaining commands after one fails")
+        exec_batch_parser.add_argument(
+            '--results',
+            help="Write each command's exit code and duration to this file (JSON)")
+        exec_batch_parser.add_argument(
+            'name', nargs='?', type=str,
+            help="Container name")
+        exec_batch_parser.add_argument(
+            'path', nargs='?', default='-',
+            help="JSON list of commands, each a list of arguments or an object with "
+                 "cmd and optionally env, cwd, user and fail_fast (default: stdin)")
+
         destroy_parser = subparsers.add_parser('destroy', help='Destroy a running container')
         destroy_parser.add_argument(
             'name', nargs='?', type=str,
             help="Container name")
 
+        serve_parser = subparsers.add_parser('serve', help='Serve the local image cache to peers')
+        serve_parser.add_argument(
+            '--cache-path', default=SNAPSHOT_CACHE,
+            help="Image cache to serve")
+        serve_parser.add_argument(
+            '--bind', default='',
+            help="Address to listen on (default: all)")
+        serve_parser.add_argument(
+            '--port', type=int, default=DEFAULT_PEER_PORT,
+            help="Port to listen on (default: {})".format(DEFAULT_PEER_PORT))
+        serve_parser.add_argument(
+            '--max-connections', type=int, default=8,
+            help="Maximum concurrent transfers, further requests are refused")
+
+        daemon_parser = subparsers.add_parser(
+            'daemon', help='Serve {} commands on a local socket'.format(
+                ', '.join(FORWARDED_COMMANDS)))
+        daemon_parser.add_argument(
+            '--socket', default=DEFAULT_SOCKET,
+            help="Unix socket to listen on (default: {})".format(DEFAULT_SOCKET))
+
         return parser
 
     def configure_logging(self, level):
-        logging.basicConfig(level=level)
+        configure_logging(level)
 
-        root = logging.getLogger()
-        root.addHandler(SentryHandler())
-
-    def run(self):
-        parser = self.get_arg_parser()
-        args = parser.parse_args(self.argv)
+    def parse_args(self, argv):
+        if self.parser is None:
+            self.parser = self.get_arg_parser()
+        args = self.parser.parse_args(argv)
 
         try:
             args.cmd.remove('--')
         except (AttributeError, ValueError):
             pass
+        return args
+
+    def run(self):
+        args = self.parse_args(self.argv)
 
         self.configure_logging(args.log_level)
 
+        self.dispatch(args)
+
+    def dispatch(self, args):
         if args.command == 'launch':
             self.run_launch(**vars(args))
         elif args.command == 'exec':
             self.run_exec(**vars(args))
         elif args.command == 'exec-script':
             self.run_exec_script(**vars(args))
+        elif args.command == 'exec-batch':
+            self.run_exec_batch(**vars(args))
         elif args.command == 'destroy':
             self.run_destroy(**vars(args))
+        elif args.command == 'serve':
+            self.run_serve(**vars(args))
+        elif args.command == 'daemon':
+            self.run_daemon(**vars(args))
+
+    def get_container(self, name, **kwargs):
+        # lxc is only loaded by commands which need it
+        from ..container import Container
+
+        if self.containers is None or kwargs:
+            return Container(name=name, **kwargs)
+        container = self.containers.get(name)
+        if container is None:
+            container = Container(name=name)
+        return container
+
+    def prepare(self, argv):
+        """
+        Called by the daemon before handing a command to a child process.
+        Handles are only kept for containers which already exist, as one
+        created beforehand wouldn't see the container's config.
+        """
+        try:
+            with redirect_stderr(io.StringIO()):
+                args = self.parse_args(argv)
+        except SystemExit:
+            # the child reports bad arguments to the client
+            return
+        if args.command in ('launch', 'destroy'):
+            self.containers.pop(args.name, None)
+        elif args.command in ('exec', 'exec-script', 'exec-batch') and \
+                args.name not in self.containers:
+            container = self.get_container(args.name)
+            if container.defined:
+                self.containers[args.name] = container
+
+    def execute(self, argv):
+        """
+        Run a forwarded command in a child of the daemon.
+        """
+        args = self.parse_args(argv)
+        assert args.command in FORWARDED_COMMANDS, \
+            "{} cannot be run by the daemon".format(args.command)
+        logging.getLogger().setLevel(args.log_level)
+        self.dispatch(args)
 
     def run_launch(self, name, snapshot=None, release=DEFAULT_RELEASE,
                    validate=True, s3_bucket=None, clean=False,
                    flush_cache=False, pre_launch=None, post_launch=None,
+                   cpu_shares=None, cpuset=None, memory_limit=None,
+                   blkio_weight=None, peers=None, peers_file=None,
+                   package_caches=(), project=None, workspaces=(),
+                   clone_backend=None, tmpfs_size=None, tmpfs_required=False,
                    **kwargs):
 
-        container = Container(
-            name=name,
+        from ..peers import load_peers
+
+        container = self.get_container(
+            name,
             snapshot=snapshot,
             release=release,
             validate=validate,
             s3_bucket=s3_bucket,
+            peers=load_peers(peers, peers_file),
+            package_caches=package_caches,
+            project=project,
+            workspaces=workspaces,
+            clone_backend=clone_backend,
         )
 
         container.launch(
@@ -137,33 +296,92 @@ class HelperCommand(object):
             post=post_launch,
             clean=clean,
             flush_cache=flush_cache,
+            limits=parse_limits({
+                'cpu_shares': cpu_shares,
+                'cpuset': cpuset,
+                'memory_limit': memory_limit,
+                'blkio_weight': blkio_weight,
+            }),
+            tmpfs_size=tmpfs_size,
+            tmpfs_required=tmpfs_required,
         )
         print("==> Instance successfully launched as {}".format(name))
 
     def run_exec(self, name, cmd, user=DEFAULT_USER, cwd=None, **kwargs):
-        container = Container(
-            name=name,
-        )
+        container = self.get_container(name)
 
         container.run(cmd, user=user, cwd=cwd)
 
     def run_exec_script(self, name, path, user=DEFAULT_USER, cwd=None, **kwargs):
-        container = Container(
-            name=name,
-        )
+        container = self.get_container(name)
 
         container.run_script(' '.join(path), user=user, cwd=cwd)
 
+    def run_exec_batch(self, name, path='-', user=DEFAULT_USER, cwd=None,
+                       fail_fast=True, results=None, **kwargs):
+        if path == '-':
+            commands = json.load(sys.stdin)
+        else:
+            with open(path) as fp:
+                commands = json.load(fp)
+
+        for n, command in enumerate(commands):
+            if not isinstance(command, dict):
+                command = commands[n] = {'cmd': command}
+            command.setdefault('user', user)
+            command.setdefault('cwd', cwd)
+
+        container = self.get_container(name)
+
+        command_results = container.run_batch(commands, fail_fast=fail_fast)
+        if results:
+            with open(results, 'w') as fp:
+                json.dump(command_results, fp, indent=2)
+
+        for result in command_results:
+            if result['returncode'] is None:
+                # skipped without any command failing first
+                sys.exit(1)
+            if result['returncode']:
+                sys.exit(result['returncode'])
+
     def run_destroy(self, name, **kwargs):
-        container = Container(
-            name=name,
-        )
+        container = self.get_container(name)
 
         container.destroy()
 
+    def run_serve(self, cache_path=SNAPSHOT_CACHE, bind='', port=DEFAULT_PEER_PORT,
+                  max_connections=8, **kwargs):
+        from ..peers import ImageServer
+
+        server = ImageServer(cache_path, (bind, port), max_connections)
+        print("==> Serving {} on port {}".format(cache_path, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    def run_daemon(self, socket=DEFAULT_SOCKET, **kwargs):
+        # loaded once here rather than in every child
+        from .. import container  # noqa
+
+        self.containers = {}
+        server = HelperDaemon(socket, self)
+        print("==> Serving {} on {}".format(', '.join(FORWARDED_COMMANDS), socket))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if os.path.exists(socket):
+                os.unlink(socket)
+
 
-def main():
-    command = HelperCommand()
+def main(argv=None):
+    command = HelperCommand(argv)
     command.run()
 
 
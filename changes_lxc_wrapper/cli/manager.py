@@ -1,42 +1,99 @@
 #!/usr/bin/env python3
 
 import argparse
-import re
+import csv
+import json
+import sys
 
 from collections import defaultdict, namedtuple
+from contextlib import redirect_stdout
 from datetime import datetime, timedelta
+from time import time
+from uuid import UUID
 
 from ..api import ChangesApi
-from ..container import SNAPSHOT_CACHE
-from ..snapshot_cache import SnapshotCache
+from ..cgroup import parse_size_value
+from ..metrics import PhaseRecorder
+from ..prefetch import DEFAULT_RELEASE, DEFAULT_WINDOW, Prefetcher, lower_priority
+from ..snapshot_cache import SNAPSHOT_CACHE, SnapshotCache, convert_date
 
 DESCRIPTION = "LXC snapshot manager"
 
 SnapshotInfo = namedtuple('SnapshotInfo', ['id', 'path', 'size'])
 
+LIST_FORMATS = ('table', 'json', 'jsonl', 'csv')
 
-def parse_size_value(value):
-    value = value.lower()
-    match = re.match(r'(\d+)(gb|g|mb|m|kb|k|b)?', value)
-    if not match:
-        raise ValueError('Unable to parse size value')
+LIST_FIELDS = (
+    'id', 'project', 'path', 'date_created', 'is_active', 'is_valid', 'size',
+    'dir_size', 'shared_size', 'hits', 'last_access', 'download_time',
+    'eviction_priority',
+)
 
-    number = int(match.group(1))
-    key = match.group(2)
-
-    if key in ('gb', 'g'):
-        return number / 1024 / 1024 / 1024
-    elif key in ('mb', 'm'):
-        return number / 1024 / 1024
-    elif key in ('kb', 'k'):
-        return number / 1024
-    return number
+# --sort values and the (indexed where possible) columns they order by
+SORT_COLUMNS = {
+    'date': 'date_created',
+    'hits': 'hits',
+    'last-access': 'last_access',
+    'priority': 'eviction_priority',
+    'project': 'project',
+    'size': 'size',
+}
 
 
 def parse_ttl_date(value):
     return datetime.utcnow() - timedelta(seconds=int(value))
 
 
+def format_timestamp(value):
+    if value is None:
+        return None
+    return datetime.utcfromtimestamp(value).isoformat()
+
+
+def get_list_record(row):
+    return {
+        'id': row['id'],
+        'project': row['project'],
+        'path': row['path'],
+        'date_created': convert_date(row['date_created']).isoformat()
+        if row['date_created'] else None,
+        'is_active': bool(row['is_active']),
+        'is_valid': bool(row['is_known'] and row['is_intact']),
+        'size': row['size'],
+        'dir_size': row['dir_size'],
+        'shared_size': row['shared_size'],
+        'hits': row['hits'],
+        'last_access': format_timestamp(row['last_access']),
+        'download_time': row['download_time'],
+        'eviction_priority': row['eviction_priority'],
+    }
+
+
+def write_records(records, fmt, stream):
+    """
+    Write list records as they arrive, flushing each so consumers see them
+    immediately.
+    """
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=LIST_FIELDS)
+        writer.writeheader()
+    elif fmt == 'json':
+        stream.write('[')
+
+    for num, record in enumerate(records):
+        if fmt == 'csv':
+            writer.writerow(record)
+        elif fmt == 'json':
+            stream.write('{}\n{}'.format(',' if num else '',
+                                         json.dumps(record, sort_keys=True)))
+        else:
+            stream.write(json.dumps(record, sort_keys=True) + '\n')
+        stream.flush()
+
+    if fmt == 'json':
+        stream.write('\n]\n')
+
+
 def format_size_value(value):
     if value > 1024 * 1024 * 1024:
         return '{}GB'.format(value // 1024 // 1024 // 1024)
@@ -71,15 +128,70 @@ class ManagerCommand(object):
         parser.add_argument('--cache-path', default=SNAPSHOT_CACHE)
         parser.add_argument('--api-url', required=True,
                             help="API URL to Changes (i.e. https://changes.example.com/api/0/)")
+        parser.add_argument('--metrics-file',
+                            help="Append per-phase timing metrics to this file (JSON lines)")
+        parser.add_argument('--reconcile', action='store_true', default=False,
+                            help="Rebuild the cache metadata from disk and upstream first")
+        parser.add_argument('--reconcile-interval', type=int,
+                            default=SnapshotCache.reconcile_interval,
+                            help="Seconds between automatic rebuilds of the cache metadata")
 
         subparsers = parser.add_subparsers(dest='command')
         cleanup_parser = subparsers.add_parser('cleanup', help='Clean up the local snapshot cache')
         cleanup_parser.add_argument('--max-disk', required=True, type=parse_size_value)
         cleanup_parser.add_argument('--max-disk-per-class', type=parse_size_value)
         cleanup_parser.add_argument('--ttl', type=parse_ttl_date)
+        cleanup_parser.add_argument('--max-rootfs-disk', type=parse_size_value,
+                                    help="Bound the space used by extracted base rootfs")
+        cleanup_parser.add_argument('--max-package-disk', type=parse_size_value,
+                                    help="Bound the space used by host package caches")
+        cleanup_parser.add_argument('--max-workspace-size', type=parse_size_value,
+                                    help="Discard any project workspace larger than this")
+        cleanup_parser.add_argument('--max-workspace-disk', type=parse_size_value,
+                                    help="Bound the space used by project workspaces")
         cleanup_parser.add_argument('--dry-run', action='store_true', default=False)
 
-        subparsers.add_parser('list', help='List the status of local snapshots')
+        list_parser = subparsers.add_parser('list', help='List the status of local snapshots')
+        list_parser.add_argument('--format', choices=LIST_FORMATS, default='table')
+        list_parser.add_argument('--sort', choices=sorted(SORT_COLUMNS),
+                                 help="Order snapshots by this field")
+        list_parser.add_argument('--desc', action='store_true', default=False,
+                                 help="Sort in descending order")
+        list_parser.add_argument('--project', type=UUID,
+                                 help="Only list snapshots for this project")
+        list_parser.add_argument('--active', action='store_true', default=None,
+                                 help="Only list active snapshots")
+        list_parser.add_argument('--inactive', action='store_false', dest='active',
+                                 help="Only list inactive snapshots")
+        list_parser.add_argument('--invalid', action='store_true', default=False,
+                                 help="Only list unknown or corrupt snapshots")
+        list_parser.add_argument('--min-size', type=parse_size_value,
+                                 help="Only list snapshots at least this big")
+        list_parser.add_argument('--unused-for', type=int,
+                                 help="Only list snapshots not launched in the last N seconds")
+        list_parser.add_argument('--limit', type=int,
+                                 help="List at most this many snapshots")
+
+        prefetch_parser = subparsers.add_parser(
+            'prefetch', help='Download newly active snapshots ahead of their jobs')
+        prefetch_parser.add_argument('--max-disk', type=parse_size_value,
+                                     help="Don't prefetch past this cache size")
+        prefetch_parser.add_argument('--bandwidth-limit', type=parse_size_value,
+                                     help="Bytes per second to download at (i.e. 20M)")
+        prefetch_parser.add_argument('--window', type=int, default=DEFAULT_WINDOW,
+                                     help="Rank projects by jobs run in the last N seconds")
+        prefetch_parser.add_argument('--release', default=DEFAULT_RELEASE,
+                                     help="Release for projects whose jobs didn't record one")
+        prefetch_parser.add_argument('--s3-bucket',
+                                     help="S3 Bucket to fetch images from")
+        prefetch_parser.add_argument('--peer', action='append', dest='peers', default=[],
+                                     help="URL of another host serving its image cache (may be repeated)")
+        prefetch_parser.add_argument('--peers-file',
+                                     help="File listing peer URLs, one per line")
+        prefetch_parser.add_argument('--interval', type=int, default=60,
+                                     help="Seconds between polls of the snapshot list")
+        prefetch_parser.add_argument('--once', action='store_true', default=False,
+                                     help="Prefetch once and exit rather than polling")
 
         return parser
 
@@ -88,16 +200,93 @@ class ManagerCommand(object):
         args = parser.parse_args(self.argv)
 
         api = ChangesApi(args.api_url)
-        cache = SnapshotCache(args.cache_path, api)
+        cache = SnapshotCache(args.cache_path, api, PhaseRecorder(args.metrics_file),
+                              reconcile=args.reconcile)
+        cache.reconcile_interval = args.reconcile_interval
+
+        if args.command == 'prefetch':
+            # the prefetcher only looks at the cache when there is work to do
+            return self.run_prefetch(cache, api, args)
+
+        if args.command == 'list':
+            # served directly from the metadata, without loading everything
+            return self.run_list(cache, args)
+
         cache.initialize()
 
         if args.command == 'cleanup':
             self.run_cleanup(cache, args)
 
-        elif args.command == 'list':
-            self.run_list(cache, args)
+    def run_prefetch(self, cache, api, args):
+        from ..image_store import S3ImageStore
+        from ..peers import PeerImageStore, load_peers
+
+        image_store = S3ImageStore(args.s3_bucket) if args.s3_bucket else None
+        peers = load_peers(args.peers, args.peers_file)
+        if peers:
+            image_store = PeerImageStore(peers, image_store)
+        if image_store is None:
+            raise ValueError('Prefetching requires --s3-bucket or peers')
+
+        lower_priority()
+
+        prefetcher = Prefetcher(
+            api=api,
+            cache=cache,
+            image_store=image_store,
+            max_disk=args.max_disk,
+            bandwidth=args.bandwidth_limit,
+            window=args.window,
+            release=args.release,
+            metrics=cache.metrics,
+        )
+        if args.once:
+            prefetcher.run_once()
+        else:
+            prefetcher.run(args.interval)
+
+    def get_list_query(self, args):
+        """
+        Build the metadata query for list's filter and sort flags, returning
+        (where, params, order_by).
+        """
+        clauses, params = [], []
+        if args.project:
+            clauses.append('project = ?')
+            params.append(str(args.project))
+        if args.active is not None:
+            clauses.append('is_active = ?')
+            params.append(int(args.active))
+        if args.invalid:
+            clauses.append('NOT (is_known AND is_intact)')
+        if args.min_size:
+            clauses.append('size >= ?')
+            params.append(args.min_size)
+        if args.unused_for:
+            clauses.append('(last_access IS NULL OR last_access < ?)')
+            params.append(time() - args.unused_for)
+
+        order_by = None
+        if args.sort:
+            order_by = '{} {}'.format(SORT_COLUMNS[args.sort], 'DESC' if args.desc else 'ASC')
+        return ' AND '.join(clauses) or None, params, order_by
 
     def run_list(self, cache, args):
+        if args.format == 'table':
+            cache.refresh()
+        else:
+            # keep progress messages out of machine readable output
+            with redirect_stdout(sys.stderr):
+                cache.refresh()
+
+        where, params, order_by = self.get_list_query(args)
+        records = (get_list_record(row) for row in cache.metadata.query(
+            where, params, order_by, args.limit, with_priority=True))
+
+        if args.format != 'table':
+            write_records(records, args.format, sys.stdout)
+            return
+
         print('-' * 80)
         template = '{id:41}  {size:5}  {is_valid:5} {project:10} {date}'
         print(template.format(
@@ -108,33 +297,58 @@ class ManagerCommand(object):
             date='Date',
         ))
         print('-' * 80)
-        for snapshot in cache.snapshots:
+        for record in records:
             print(template.format(
-                id=str(snapshot.id) if not snapshot.is_active else '* {}'.format(snapshot.id),
-                size=format_size_value(snapshot.size),
-                is_valid='T' if snapshot.is_valid else 'F',
-                project=str(snapshot.project or 'n/a'),
-                date=snapshot.date_created.date() if snapshot.date_created else 'n/a',
+                id=record['id'] if not record['is_active'] else '* {}'.format(record['id']),
+                size=format_size_value(record['size']),
+                is_valid='T' if record['is_valid'] else 'F',
+                project=record['project'] or 'n/a',
+                date=record['date_created'][:10] if record['date_created'] else 'n/a',
             ))
 
+        rootfs_entries = cache.rootfs_cache.list()
+        if rootfs_entries:
+            print('-' * 80)
+            print('{id:41}  {size:5}  {last_used}'.format(
+                id='Extracted rootfs', size='Size', last_used='Last Used'))
+            print('-' * 80)
+            for entry in rootfs_entries:
+                print('{id:41}  {size:5}  {last_used}'.format(
+                    id=entry.id,
+                    size=format_size_value(entry.size),
+                    last_used=datetime.utcfromtimestamp(entry.last_used).replace(microsecond=0),
+                ))
+
+        for title, entries in (('Package cache', cache.package_cache.list()),
+                               ('Project workspace', cache.workspace_cache.list())):
+            if not entries:
+                continue
+            print('-' * 80)
+            print('{id:41}  {size:5}  {last_used}'.format(
+                id=title, size='Size', last_used='Last Used'))
+            print('-' * 80)
+            for entry in entries:
+                print('{id:41}  {size:5}  {last_used}'.format(
+                    id=entry.id,
+                    size=format_size_value(entry.size),
+                    last_used=datetime.utcfromtimestamp(entry.last_used).replace(microsecond=0),
+                ))
+
     def run_cleanup(self, cache, args):
 
         wipe_on_disk = not args.dry_run
 
+        # snapshots may have become active since the metadata was refreshed
+        cache.refresh_upstream()
+
         if not wipe_on_disk:
             print("==> DRY RUN: Not removing files on disk")
 
         # find snapshot data within Changes
-        snapshots_by_class = defaultdict(list)
         used_space_by_class = defaultdict(int)
 
-        def get_sort_value(snapshot):
-            if snapshot.date_created:
-                return int(snapshot.date_created.strftime('%s'))
-            else:
-                return 0
-
-        for snapshot in sorted(cache.snapshots, key=get_sort_value):
+        # oldest first, unknown dates before all others
+        for snapshot in cache.query(order_by='date_created'):
             # this snapshot is unknown or has been invalidated
             if snapshot.is_active:
                 continue
@@ -150,13 +364,14 @@ class ManagerCommand(object):
 
             # add size to class pool for later determination
             used_space_by_class[snapshot.project] += snapshot.size
-            snapshots_by_class[snapshot.project].append(snapshot)
 
         if args.max_disk_per_class:
             for project_id, class_size in used_space_by_class.items():
                 # keep removing old snapshots until we're under the threshold
-                while class_size > args.max_disk_per_class:
-                    snapshot = snapshots_by_class.pop(0)
+                for snapshot in cache.query('project = ?', (str(project_id),),
+                                            order_by='date_created'):
+                    if class_size <= args.max_disk_per_class:
+                        break
                     if snapshot.is_active:
                         continue
                     cache.remove(snapshot, wipe_on_disk)
@@ -165,8 +380,7 @@ class ManagerCommand(object):
         # finally, ensure we're under our disk threshold or remove snapshots
         # based on their size
         # TODO(dcramer): we could optimize this to more evenly remove snapshots
-        snapshot_size_iter = iter(sorted(
-            cache.snapshots, key=lambda x: x.size, reverse=True))
+        snapshot_size_iter = iter(cache.query(order_by='size DESC'))
 
         while cache.total_size > args.max_disk:
             try:
@@ -177,6 +391,82 @@ class ManagerCommand(object):
                 continue
             cache.remove(snapshot, wipe_on_disk)
 
+        if args.max_rootfs_disk is not None:
+            self.run_rootfs_cleanup(cache, args.max_rootfs_disk, wipe_on_disk)
+
+        if args.max_package_disk is not None:
+            self.run_package_cleanup(cache, args.max_package_disk, wipe_on_disk)
+
+        if args.max_workspace_size is not None or args.max_workspace_disk is not None:
+            self.run_workspace_cleanup(cache, args.max_workspace_size,
+                                       args.max_workspace_disk, wipe_on_disk)
+
+    def run_rootfs_cleanup(self, cache, max_disk, wipe_on_disk):
+        """
+        Evict extracted rootfs, least recently used first, skipping any
+        which running containers are still layered on.
+        """
+        for entry in sorted(cache.rootfs_entries, key=lambda x: x.last_used):
+            if cache.rootfs_size <= max_disk:
+                break
+            if cache.rootfs_cache.get_users(entry):
+                continue
+            cache.remove_rootfs(entry, wipe_on_disk)
+
+    def run_package_cleanup(self, cache, max_disk, wipe_on_disk):
+        """
+        Evict package caches, least recently used first, skipping any
+        mounted by a container.
+        """
+        entries = cache.package_cache.list()
+        total_size = sum(e.size for e in entries)
+        print("==> {} package caches found ({} bytes)".format(len(entries), total_size))
+
+        if wipe_on_disk:
+            for name in cache.package_cache.remove_stale_work():
+                print("==> Removed package cache work directory of {}".format(name))
+
+        for entry in sorted(entries, key=lambda x: x.last_used):
+            if total_size <= max_disk:
+                break
+            print("==> Removing package cache: {}".format(entry.id))
+            if wipe_on_disk and not cache.package_cache.remove(entry):
+                print("==> Package cache {} is in use, skipping".format(entry.id))
+                continue
+            total_size -= entry.size
+
+    def run_workspace_cleanup(self, cache, max_size, max_disk, wipe_on_disk):
+        """
+        Discard workspaces which outgrew ``max_size``, then evict the least
+        recently used until under ``max_disk``, skipping any mounted by a
+        container.
+        """
+        slots = cache.workspace_cache.list()
+        total_size = sum(s.size for s in slots)
+        print("==> {} project workspaces found ({} bytes)".format(len(slots), total_size))
+
+        def remove(slot):
+            print("==> Removing project workspace: {}".format(slot.id))
+            if wipe_on_disk and not cache.workspace_cache.remove(slot):
+                print("==> Project workspace {} is in use, skipping".format(slot.id))
+                return False
+            return True
+
+        remaining = []
+        for slot in sorted(slots, key=lambda x: x.last_used):
+            if max_size is not None and slot.size > max_size and remove(slot):
+                total_size -= slot.size
+            else:
+                remaining.append(slot)
+
+        if max_disk is None:
+            return
+        for slot in remaining:
+            if total_size <= max_disk:
+                break
+            if remove(slot):
+                total_size -= slot.size
+
 
 def main():
     command = ManagerCommand()
@@ -2,17 +2,26 @@
 
 import argparse
 import logging
+import os
 import sys
 import traceback
 
-from raven.handlers.logging import SentryHandler
-from threading import Thread
-from time import sleep
+from functools import partial
+from threading import Event, Thread
+from time import sleep, time
 from uuid import UUID, uuid4
 
 from ..api import ChangesApi
-from ..container import Container
+from ..cgroup import parse_limits, parse_size_value
+from ..clone import CLONE_BACKENDS
+from ..heartbeat import Heartbeater
 from ..log_reporter import LogReporter
+from ..metrics import PhaseRecorder
+from ..package_cache import parse_package_caches
+from ..pipeline import DEFAULT_STAGE_LIMITS, PIPELINE_DIR, PostBuildPipeline
+from ..reaper import ContainerReaper
+from ..sentry import configure_logging
+from ..snapshot_cache import SNAPSHOT_CACHE
 
 
 DESCRIPTION = "LXC Wrapper for running Changes jobs"
@@ -43,6 +52,25 @@ class WrapperCommand(object):
         self.argv = argv
         self.stdout = sys.stdout
         self.stderr = sys.stderr
+        self.reporter = None
+        self.metrics = PhaseRecorder()
+        self.sample_interval = None
+        self.reaper = None
+        # the container running the build, killed if upstream cancels
+        self.container = None
+        self.cancelled = Event()
+        self.layered = False
+        self.peers = []
+        self.stream_upload = False
+        self.package_caches = []
+        self.project = None
+        self.workspaces = []
+        self.clone_backend = None
+        self.tmpfs_size = None
+        self.tmpfs_required = False
+        self.pipeline = None
+        # called with (snapshot, status) once a snapshot is saved in the background
+        self.update_snapshot_status = None
 
     def get_arg_parser(self):
         parser = argparse.ArgumentParser(description=DESCRIPTION)
@@ -53,9 +81,17 @@ class WrapperCommand(object):
         parser.add_argument('--keep', action='store_true', default=False,
                             help="Don't destroy the container after running cmd/build")
         parser.add_argument('--no-validate', action='store_false', default=True, dest='validate',
-                            help="Don't validate downloaded images")
+                            help="Only check sizes of cached images, not their hashes")
         parser.add_argument('--save-snapshot', action='store_true', default=False,
                             help="Create an image from this container")
+        parser.add_argument('--parent-snapshot', type=UUID,
+                            help="Save the snapshot as a delta against this parent snapshot")
+        parser.add_argument('--delta-snapshots', action='store_true', default=False,
+                            help="Save snapshots as deltas against the jobstep's current snapshot")
+        parser.add_argument('--layered-images', action='store_true', default=False, dest='layered',
+                            help="Save snapshots as deduplicated chunks")
+        parser.add_argument('--stream-upload', action='store_true', default=False,
+                            help="Upload snapshots in parallel parts while they are compressed")
         parser.add_argument('--clean', action='store_true', default=False,
                             help="Use a fresh container from Ubuntu minimal install")
         parser.add_argument('--flush-cache', action='store_true', default=False,
@@ -74,16 +110,66 @@ class WrapperCommand(object):
                             help="Script to execute as command")
         parser.add_argument('--s3-bucket',
                             help="S3 Bucket to store/fetch images from")
+        parser.add_argument('--peer', action='append', dest='peers', default=[],
+                            help="URL of another host serving its image cache (may be repeated)")
+        parser.add_argument('--peers-file',
+                            help="File listing peer URLs, one per line")
+        parser.add_argument('--package-cache', type=parse_package_caches, default=[],
+                            dest='package_caches',
+                            help="Mount host package caches into the container (i.e. apt,pip,npm,maven)")
+        parser.add_argument('--project',
+                            help="Project the build belongs to, which package caches are kept per")
+        parser.add_argument('--workspace', action='append', dest='workspaces', default=[],
+                            help="Directory in the container (i.e. a ccache directory) kept "
+                                 "between the project's jobs (may be repeated)")
+        parser.add_argument('--clone-backend', choices=['auto'] + sorted(CLONE_BACKENDS),
+                            default='auto',
+                            help="How to clone the snapshot's rootfs (default: detected from the cache's filesystem)")
+        parser.add_argument('--tmpfs', type=parse_size_value, dest='tmpfs_size',
+                            help="Keep the container's writes in a tmpfs of this size (i.e. 4G), "
+                                 "if the host has the memory to spare")
+        parser.add_argument('--tmpfs-required', action='store_true', default=False,
+                            help="Fail rather than write to disk when there isn't the memory for --tmpfs")
+        parser.add_argument('--cpu-shares', type=int,
+                            help="Relative CPU weight of the container")
+        parser.add_argument('--cpuset',
+                            help="CPUs to pin the container to (i.e. 0-3), or 'auto' for the least busy NUMA node")
+        parser.add_argument('--memory-limit',
+                            help="Memory limit for the container (i.e. 4G)")
+        parser.add_argument('--blkio-weight', type=int,
+                            help="Relative block IO weight of the container (10-1000)")
+        parser.add_argument('--metrics-file',
+                            help="Append per-phase timing and resource metrics to this file (JSON lines)")
+        parser.add_argument('--raw-log-dir',
+                            help="Keep an uncollapsed, byte for byte copy of the jobstep's "
+                                 "output in this directory")
+        parser.add_argument('--log-flush-window', type=float,
+                            default=LogReporter.flush_window,
+                            help="Seconds an unfinished line (i.e. a progress bar) or repeated "
+                                 "lines are held back before being sent to Changes")
+        parser.add_argument('--report-metrics', action='store_true', default=False,
+                            help="Send per-phase metrics to Changes with the jobstep")
+        parser.add_argument('--sample-interval', type=float,
+                            help="Sample container cgroup usage every N seconds while running")
+        parser.add_argument('--teardown-concurrency', type=int, default=2,
+                            help="Maximum number of containers destroyed at once after the "
+                                 "result is reported (the wrapper waits for them before exiting)")
+        parser.add_argument('--foreground-snapshot', action='store_true', default=False,
+                            help="Save and upload snapshots before reporting the result, "
+                                 "rather than in the background afterwards")
+        parser.add_argument('--image-concurrency', type=int,
+                            default=DEFAULT_STAGE_LIMITS['create_image'],
+                            help="Maximum number of snapshots archived at once on this host")
+        parser.add_argument('--upload-concurrency', type=int,
+                            default=DEFAULT_STAGE_LIMITS['upload'],
+                            help="Maximum number of snapshots uploaded at once on this host")
         parser.add_argument('--log-level', default='WARN')
         parser.add_argument('cmd', nargs=argparse.REMAINDER,
                             help="Command to run inside the container")
         return parser
 
     def configure_logging(self, level):
-        logging.basicConfig(level=level)
-
-        root = logging.getLogger()
-        root.addHandler(SentryHandler())
+        configure_logging(level)
 
     def patch_system_logging(self, reporter):
         sys.stdout = WrappedOutput(sys.stdout, reporter)
@@ -100,15 +186,63 @@ class WrapperCommand(object):
 
         self.configure_logging(args.log_level)
 
-        if args.jobstep_id:
-            return self.run_remote(args)
-        return self.run_local(args)
+        from ..peers import load_peers
+
+        self.metrics = PhaseRecorder(args.metrics_file)
+        self.sample_interval = args.sample_interval
+        self.layered = args.layered
+        self.peers = load_peers(args.peers, args.peers_file)
+        self.stream_upload = args.stream_upload
+        self.package_caches = args.package_caches
+        self.project = args.project
+        self.workspaces = args.workspaces
+        self.clone_backend = args.clone_backend
+        self.tmpfs_size = args.tmpfs_size
+        self.tmpfs_required = args.tmpfs_required
+
+        if not args.foreground_snapshot:
+            self.pipeline = PostBuildPipeline(
+                os.path.join(SNAPSHOT_CACHE, PIPELINE_DIR),
+                limits={
+                    'create_image': args.image_concurrency,
+                    'upload': args.upload_concurrency,
+                },
+                metrics=self.metrics,
+            )
+
+        self.reaper = ContainerReaper(args.teardown_concurrency)
+        self.reaper.start()
+        try:
+            self.reap_orphans()
+
+            if args.jobstep_id:
+                return self.run_remote(args)
+            return self.run_local(args)
+        finally:
+            if self.pipeline:
+                # snapshots are saved after the result is reported, and
+                # queue their containers for teardown when done
+                self.pipeline.close()
+            # only the result report moved ahead of teardown: the wrapper
+            # still exits once every container is destroyed
+            self.reaper.close()
+
+    def reap_orphans(self):
+        """
+        Queue containers leaked by crashed wrapper processes for teardown.
+        """
+        from ..container import find_orphans
+
+        for container in find_orphans():
+            print("==> Found orphaned container {}".format(container.name))
+            self.reaper.submit(container)
 
     def run_local(self, args):
         """
         Run a local-only build (i.e. for testing).
         """
         snapshot = str(args.snapshot) if args.snapshot else None
+        parent_snapshot = str(args.parent_snapshot) if args.parent_snapshot else None
         release = args.release or DEFAULT_RELEASE
 
         self.run_build_script(
@@ -121,10 +255,12 @@ class WrapperCommand(object):
             clean=args.clean,
             flush_cache=args.flush_cache,
             save_snapshot=args.save_snapshot,
+            parent_snapshot=parent_snapshot,
             user=args.user,
             cmd=args.cmd,
             script=args.script,
             keep=args.keep,
+            limits=parse_limits(vars(args)),
         )
 
     def run_remote(self, args):
@@ -149,14 +285,25 @@ class WrapperCommand(object):
 
                 release = resp['data'].get('release') or DEFAULT_RELEASE
 
+                # limits given by the jobstep take precedence over our defaults
+                limits = parse_limits(vars(args))
+                limits.update(parse_limits(resp['data']))
+
                 # If we're expected a snapshot output we need to override
                 # any snapshot parameters, and also ensure we're creating a clean
                 # image
+                parent_snapshot = None
                 if resp['expectedSnapshot']:
                     snapshot = str(UUID(resp['expectedSnapshot']['id']))
                     save_snapshot = True
                     clean = True
 
+                    # build on top of the current snapshot and only save
+                    # what changed
+                    if args.delta_snapshots and resp['snapshot']:
+                        parent_snapshot = str(UUID(resp['snapshot']['id']))
+                        clean = False
+
                 else:
                     if resp['snapshot']:
                         snapshot = str(UUID(resp['snapshot']['id']))
@@ -165,6 +312,10 @@ class WrapperCommand(object):
                     save_snapshot = False
                     clean = False
 
+                # package caches and workspaces are kept per project
+                if not self.project and resp.get('project'):
+                    self.project = resp['project']['id']
+
                 api.update_jobstep(jobstep_id, {"status": "in_progress"})
 
                 cmd = [
@@ -173,7 +324,7 @@ class WrapperCommand(object):
                     '--jobstep_id', jobstep_id,
                 ]
 
-                self.run_build_script(
+                deferred = self.run_build_script(
                     snapshot=snapshot,
                     release=release,
                     validate=args.validate,
@@ -183,14 +334,20 @@ class WrapperCommand(object):
                     clean=clean,
                     flush_cache=args.flush_cache,
                     save_snapshot=save_snapshot,
+                    parent_snapshot=parent_snapshot,
                     user=args.user,
                     cmd=cmd,
                     keep=args.keep,
+                    limits=limits,
                 )
 
             except Exception:
+                heartbeater.close()
                 reporter.write(traceback.format_exc())
 
+                if args.report_metrics:
+                    self.report_metrics(api, jobstep_id)
+
                 api.update_jobstep(jobstep_id, {"status": "finished", "result": "failed"})
                 if args.save_snapshot:
                     api.update_snapshot_image(snapshot, {"status": "failed"})
@@ -198,17 +355,41 @@ class WrapperCommand(object):
                 raise
 
             else:
+                heartbeater.close()
+                if args.report_metrics:
+                    self.report_metrics(api, jobstep_id)
+
                 api.update_jobstep(jobstep_id, {"status": "finished"})
-                if args.save_snapshot:
+                # otherwise updated once saved in the background
+                if args.save_snapshot and not deferred:
                     api.update_snapshot_image(snapshot, {"status": "active"})
 
         api = ChangesApi(args.api_url)
         jobstep_id = args.jobstep_id
 
-        reporter = LogReporter(api, jobstep_id)
+        if args.save_snapshot:
+            def update_snapshot_status(snapshot, status):
+                api.update_snapshot_image(snapshot, {"status": status})
+            self.update_snapshot_status = update_snapshot_status
+
+        reporter = LogReporter(api, jobstep_id, raw_dir=args.raw_log_dir,
+                               flush_window=args.log_flush_window)
         reporter_thread = Thread(target=reporter.process)
         reporter_thread.start()
         self.patch_system_logging(reporter)
+        self.reporter = reporter
+
+        # watches for the jobstep being finished (aborted) upstream
+        heartbeater = Heartbeater(api, jobstep_id)
+
+        def heartbeat():
+            heartbeater.wait()
+            if heartbeater.cancelled.is_set():
+                self.cancel()
+
+        heartbeat_thread = Thread(target=heartbeat)
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
 
         run_thread = Thread(target=inner_run, args=[api, jobstep_id])
         run_thread.daemon = True
@@ -227,18 +408,49 @@ class WrapperCommand(object):
             # and the builder
             run_thread.join(5)
 
+        heartbeater.close()
+        heartbeat_thread.join()
+
         reporter.close()
 
         reporter_thread.join(60)
 
+        # anything the post-build stages print stays local
+        sys.stdout = self.stdout
+        sys.stderr = self.stderr
+
+    def cancel(self):
+        """
+        Called once upstream has aborted the jobstep. The build's container
+        is killed at once, and torn down as usual once the build fails.
+        """
+        cancelled_at = time()
+        self.cancelled.set()
+        print("==> Jobstep was cancelled upstream, killing the build")
+        container = self.container
+        if container is not None:
+            container.kill(signalled_at=cancelled_at)
+
+    def report_metrics(self, api, jobstep_id):
+        try:
+            api.update_jobstep(jobstep_id, {"metrics": self.metrics.dumps()})
+        except Exception:
+            # metrics are best effort and should never fail the job
+            logging.exception('Failed to report metrics')
+
     def run_build_script(self, snapshot, release, validate, s3_bucket, pre_launch,
                          post_launch, clean, flush_cache, save_snapshot,
-                         user, cmd=None, script=None, keep=False):
+                         user, cmd=None, script=None, keep=False, limits=None,
+                         parent_snapshot=None):
         """
         Run the given build script inside of the LXC container.
         """
-        assert clean or not (save_snapshot and snapshot), \
-            "You cannot create a snapshot from an existing snapshot"
+        if parent_snapshot:
+            assert save_snapshot and not clean, \
+                "A parent snapshot can only be used when saving a delta snapshot"
+        else:
+            assert clean or not (save_snapshot and snapshot), \
+                "You cannot create a snapshot from an existing snapshot"
 
         assert not (cmd and script), \
             'Only one of cmd or script can be specified'
@@ -246,28 +458,60 @@ class WrapperCommand(object):
         assert cmd or script, \
             'Missing build command'
 
+        from ..container import Container
+
+        clone_backend = self.clone_backend
+        if parent_snapshot:
+            # the delta is taken from the overlay
+            clone_backend = 'overlayfs'
+
         container = Container(
             name=str(uuid4()),
-            snapshot=snapshot,
+            snapshot=parent_snapshot or snapshot,
             release=release,
             validate=validate,
             s3_bucket=s3_bucket,
+            log_reporter=self.reporter,
+            metrics=self.metrics,
+            sample_interval=self.sample_interval,
+            layered=self.layered,
+            peers=self.peers,
+            stream_upload=self.stream_upload,
+            package_caches=self.package_caches,
+            project=self.project,
+            workspaces=self.workspaces,
+            clone_backend=clone_backend,
         )
 
+        deferred = False
+        self.container = container
         try:
-            container.launch(pre_launch, post_launch, clean, flush_cache)
+            container.launch(pre_launch, post_launch, clean, flush_cache, limits,
+                             tmpfs_size=self.tmpfs_size, tmpfs_required=self.tmpfs_required,
+                             owned=True)
 
             # TODO(dcramer): we should assert only one type of command arg is set
-            if cmd:
+            if cmd and not self.cancelled.is_set():
                 container.run(cmd, user=user)
-            elif script:
+            elif script and not self.cancelled.is_set():
                 container.run_script(script, user=user)
 
+            self.container = None
+            if self.cancelled.is_set():
+                raise CommandError('Jobstep was cancelled upstream')
+
             if save_snapshot or not keep:
                 container.stop()
 
-            if save_snapshot:
-                snapshot = container.create_image()
+            if save_snapshot and self.pipeline:
+                # the reporter is closed before the stages finish, so their
+                # output (i.e. tar's) only goes to our own stdout
+                container.log_reporter = None
+                self.pipeline.submit(container.name, self.get_post_build_stages(
+                    container, snapshot or str(uuid4()), parent_snapshot, s3_bucket, keep))
+                deferred = True
+            elif save_snapshot:
+                snapshot = container.create_image(snapshot=snapshot, parent=parent_snapshot)
                 print("==> Snapshot saved: {}".format(snapshot))
                 if s3_bucket:
                     container.upload_image(snapshot=snapshot)
@@ -275,12 +519,43 @@ class WrapperCommand(object):
             logging.exception(e)
             raise e
         finally:
-            if not keep:
-                container.destroy()
-            else:
+            self.container = None
+            if keep:
                 print("==> Container kept at {}".format(container.rootfs))
                 print("==> SSH available via:")
                 print("==>   $ sudo lxc-attach --name={}".format(container.name))
+            elif not deferred:
+                self.teardown(container)
+
+        return deferred
+
+    def teardown(self, container):
+        if self.reaper:
+            self.reaper.submit(container)
+        else:
+            container.destroy()
+
+    def get_post_build_stages(self, container, snapshot, parent_snapshot, s3_bucket, keep):
+        """
+        Returns the pipeline stages saving the (stopped) container as a
+        snapshot, reporting it and tearing the container down.
+        """
+        def create_image():
+            container.create_image(snapshot=snapshot, parent=parent_snapshot)
+            print("==> Snapshot saved: {}".format(snapshot))
+
+        stages = [('create_image', create_image, False)]
+        if s3_bucket:
+            stages.append(('upload', partial(container.upload_image, snapshot=snapshot), False))
+        if self.update_snapshot_status:
+            def update_snapshot_image(failed):
+                self.update_snapshot_status(snapshot, 'failed' if failed else 'active')
+            stages.append(('update_snapshot_image', update_snapshot_image, True))
+        if not keep:
+            def teardown(failed):
+                self.teardown(container)
+            stages.append(('teardown', teardown, True))
+        return stages
 
 
 def main():
@@ -0,0 +1,266 @@
+"""
+Copy-on-write clones of extracted rootfs for launches.
+
+By default lxc clones the base container as an overlay, which is cheap to
+create but slows write-heavy builds down with copy-up. Where the image
+cache is on a filesystem which can share data between copies, the rootfs
+is cloned with it instead:
+
+- btrfs: a subvolume snapshot (rootfs are extracted into subvolumes)
+- zfs: a clone of a snapshot (rootfs are extracted into datasets)
+- reflink: a copy sharing data extents (i.e. xfs with reflink=1)
+
+These clones live under ``<cache>/clones/<container>/rootfs`` so they are on
+the same filesystem as the rootfs they came from.
+"""
+import os
+import shutil
+import subprocess
+
+from uuid import uuid4
+
+from .rootfs_cache import get_tree_size
+
+CLONE_DIR = 'clones'
+
+# inode number of the root of every btrfs subvolume
+BTRFS_SUBVOLUME_INO = 256
+
+
+class CloneError(Exception):
+    pass
+
+
+def get_mount(path, mounts='/proc/self/mounts'):
+    """
+    Returns (source, mount point, filesystem type) of the mount holding
+    ``path``, which need not exist yet.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    path = os.path.realpath(path)
+
+    best = ('', '/', '')
+    with open(mounts) as fp:
+        for line in fp:
+            source, mount_point, fstype = line.split()[:3]
+            # spaces and the like are octal escaped
+            mount_point = mount_point.encode().decode('unicode_escape')
+            if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                if len(mount_point) >= len(best[1]):
+                    best = (source, mount_point, fstype)
+    return best
+
+
+def is_btrfs_subvolume(path):
+    return get_mount(path)[2] == 'btrfs' and \
+        os.stat(path).st_ino == BTRFS_SUBVOLUME_INO
+
+
+def get_zfs_dataset(path):
+    """
+    Returns the dataset mounted at ``path``, or None if it isn't one.
+    """
+    source, mount_point, fstype = get_mount(path)
+    if fstype == 'zfs' and mount_point == os.path.realpath(path):
+        return source
+    return None
+
+
+def supports_reflink(path):
+    """
+    Checks whether files under ``path`` can be copied as reflinks.
+    """
+    probe = os.path.join(path, '.reflink-{}'.format(uuid4().hex))
+    try:
+        with open(probe, 'w') as fp:
+            fp.write('probe')
+        return subprocess.call(
+            ['cp', '--reflink=always', probe, probe + '.copy'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+    except OSError:
+        return False
+    finally:
+        for name in (probe, probe + '.copy'):
+            if os.path.exists(name):
+                os.unlink(name)
+
+
+def remove_rootfs(path):
+    """
+    Removes a rootfs however it was created.
+    """
+    dataset = get_zfs_dataset(path)
+    if dataset is not None:
+        origin = subprocess.check_output(
+            ['zfs', 'get', '-H', '-o', 'value', 'origin', dataset]).decode().strip()
+        subprocess.check_call(['zfs', 'destroy', '-r', dataset])
+        if origin != '-':
+            # the snapshot taken for this clone
+            subprocess.check_call(['zfs', 'destroy', origin])
+        if os.path.exists(path):
+            os.rmdir(path)
+    elif os.path.exists(path) and is_btrfs_subvolume(path):
+        subprocess.check_call(['btrfs', 'subvolume', 'delete', path],
+                              stdout=subprocess.DEVNULL)
+    else:
+        shutil.rmtree(path)
+
+
+class CloneBackend(object):
+    name = None
+
+    # whether containers are cloned by lxc rather than clone_rootfs
+    lxc_snapshot = False
+
+    def create_rootfs(self, path):
+        """
+        Create an empty rootfs which can be cloned cheaply.
+        """
+        os.makedirs(path)
+
+    def rootfs_moved(self, path):
+        """
+        Called once the directory holding a rootfs created by
+        ``create_rootfs`` was renamed, leaving it at ``path``.
+        """
+
+    def can_clone(self, src, dest):
+        """
+        Whether ``src`` can be cheaply cloned into the directory ``dest``.
+        """
+        return False
+
+    def clone_rootfs(self, src, dest):
+        raise NotImplementedError
+
+    def copy_rootfs(self, src, dest):
+        """
+        Like ``clone_rootfs``, but ``src`` can still be removed while the
+        copy exists (i.e. when caching a container's rootfs).
+        """
+        self.clone_rootfs(src, dest)
+
+    def remove_rootfs(self, path):
+        remove_rootfs(path)
+
+    def get_space_used(self, path):
+        """
+        Bytes used only by the clone at ``path``, or None if unknown.
+        """
+        return None
+
+
+class OverlayBackend(CloneBackend):
+    name = 'overlayfs'
+
+    lxc_snapshot = True
+
+    def get_space_used(self, path):
+        # the delta directory holds everything the clone wrote
+        return get_tree_size(path)
+
+
+class ReflinkBackend(CloneBackend):
+    name = 'reflink'
+
+    def can_clone(self, src, dest):
+        # on the same filesystem
+        return get_mount(src)[0] == get_mount(dest)[0]
+
+    def clone_rootfs(self, src, dest):
+        if subprocess.call(['cp', '-a', '--reflink=always', src, dest]) != 0:
+            shutil.rmtree(dest, ignore_errors=True)
+            raise CloneError('Failed to reflink {}'.format(src))
+
+
+class BtrfsBackend(ReflinkBackend):
+    name = 'btrfs'
+
+    def create_rootfs(self, path):
+        subprocess.check_call(['btrfs', 'subvolume', 'create', path],
+                              stdout=subprocess.DEVNULL)
+
+    def clone_rootfs(self, src, dest):
+        if not is_btrfs_subvolume(src):
+            # extracted before switching backends
+            return super().clone_rootfs(src, dest)
+        subprocess.check_call(['btrfs', 'subvolume', 'snapshot', src, dest],
+                              stdout=subprocess.DEVNULL)
+
+    def get_space_used(self, path):
+        try:
+            output = subprocess.check_output(
+                ['btrfs', 'filesystem', 'du', '-s', '--raw', path],
+                stderr=subprocess.DEVNULL).decode()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        # Total, Exclusive, Set shared, Filename
+        return int(output.splitlines()[-1].split()[1])
+
+
+class ZfsBackend(CloneBackend):
+    name = 'zfs'
+
+    def create_rootfs(self, path):
+        parent = get_mount(path)[0]
+        dataset = '{}/rootfs-{}'.format(parent, uuid4().hex)
+        subprocess.check_call(['zfs', 'create', '-o', 'mountpoint={}'.format(path), dataset])
+
+    def rootfs_moved(self, path):
+        # the mount moved with its parent, but zfs still has the old path
+        source, mount_point, fstype = get_mount(path)
+        if fstype == 'zfs' and mount_point == os.path.realpath(path):
+            subprocess.check_call(['zfs', 'set', 'mountpoint={}'.format(path), source])
+
+    def can_clone(self, src, dest):
+        return get_zfs_dataset(src) is not None
+
+    def clone_rootfs(self, src, dest):
+        dataset = get_zfs_dataset(src)
+        if dataset is None:
+            raise CloneError('{} is not a zfs dataset'.format(src))
+        name = uuid4().hex
+        snapshot = '{}@{}'.format(dataset, name)
+        subprocess.check_call(['zfs', 'snapshot', snapshot])
+        subprocess.check_call([
+            'zfs', 'clone', '-o', 'mountpoint={}'.format(dest), snapshot,
+            '{}/clone-{}'.format(dataset.rsplit('/', 1)[0], name),
+        ])
+
+    def copy_rootfs(self, src, dest):
+        # a clone depends on a snapshot of src, which would then refuse to
+        # be destroyed along with its container
+        self.create_rootfs(dest)
+        subprocess.check_call(['cp', '-a', '{}/.'.format(src), dest])
+
+    def get_space_used(self, path):
+        dataset = get_zfs_dataset(path)
+        if dataset is None:
+            return None
+        return int(subprocess.check_output(
+            ['zfs', 'get', '-Hp', '-o', 'value', 'used', dataset]).decode().strip())
+
+
+CLONE_BACKENDS = dict((b.name, b) for b in (
+    OverlayBackend, BtrfsBackend, ZfsBackend, ReflinkBackend,
+))
+
+
+def get_clone_backend(path, name=None):
+    """
+    Returns the named backend, or the cheapest one available for rootfs
+    kept under ``path``.
+    """
+    if name and name != 'auto':
+        return CLONE_BACKENDS[name]()
+
+    fstype = get_mount(path)[2]
+    if fstype == 'btrfs' and shutil.which('btrfs'):
+        return BtrfsBackend()
+    if fstype == 'zfs' and shutil.which('zfs'):
+        return ZfsBackend()
+    if fstype == 'xfs' and os.path.isdir(path) and supports_reflink(path):
+        return ReflinkBackend()
+    return OverlayBackend()
@@ -1,22 +1,125 @@
+import fcntl
+import json
+import logging
 import lxc
 import os
 import shutil
+import signal
 import socket
+import sqlite3
 import subprocess
+import sys
 
+from functools import partial
 from time import time
 from uuid import uuid4
 
-SNAPSHOT_CACHE = '/var/cache/lxc/download'
+from .cgroup import CgroupSampler, get_limit_config, get_numa_nodes
+from .clone import CLONE_DIR, OverlayBackend, get_clone_backend
+from .history import JOB_HISTORY_FILE, JobHistory
+from .image_store import S3ImageStore
+from .integrity import (
+    VerificationCache, copy_hashed, describe_file, verify_image
+)
+from .layers import (
+    CHUNK_DIR, MANIFEST_FILE, ChunkStore, read_manifest, split_archive,
+    write_manifest
+)
+from .metadata import METADATA_FILE, MetadataStore
+from .metrics import PhaseRecorder, instrumented
+from .output import OutputPipe, write_fd
+from .overlay import get_exclude_args, scan_delta
+from .package_cache import PackageCache
+from .peers import PeerImageStore
+from .reaper import get_owner_id, is_orphaned
+from .rootfs_cache import ORIGIN_FILE, RootfsCache
+from .snapshot_cache import SNAPSHOT_CACHE, get_directory_size
+from .tmpfs import DEFAULT_RESERVE, get_memory_headroom, mount_tmpfs, unmount_tmpfs
+from .upload import PART_SIZE, MultipartUpload, upload_file
+from .workspace import WorkspaceCache
+
+LXC_DEFAULT_CONFIG = '/etc/lxc/default.conf'
+
+LXC_TEMPLATE_CONFIG = '/usr/share/lxc/config'
+
+# Written next to the container config to record the owning wrapper process
+OWNER_FILE = 'changes-lxc-wrapper.pid'
+
+# Where a container's tmpfs layer is mounted, next to its config
+TMPFS_DIR = 'tmpfs'
+
+# Held while checking memory headroom and mounting a tmpfs layer
+TMPFS_LOCK_FILE = 'tmpfs.lock'
+
+# Held from choosing a NUMA node until the container has started on it
+NUMA_LOCK_FILE = 'numa.lock'
+
+# options of each command given to Container.run_batch
+BATCH_COMMAND_KEYS = {'cmd', 'cwd', 'env', 'user', 'quiet', 'fail_fast'}
+
+
+def find_orphans():
+    """
+    Returns containers left behind by wrapper processes which have died.
+    """
+    orphans = []
+    for name in lxc.list_containers():
+        container = Container(name)
+        if is_orphaned(container.owner_path):
+            orphans.append(container)
+    return orphans
 
 
 class Container(lxc.Container):
     def __init__(self, name, release=None, snapshot=None, validate=True,
-                 s3_bucket=None, *args, **kwargs):
+                 s3_bucket=None, log_reporter=None, metrics=None,
+                 sample_interval=None, image_store=None, layered=False,
+                 peers=None, stream_upload=False, package_caches=(),
+                 project=None, workspaces=(), clone_backend=None, *args, **kwargs):
         self.snapshot = snapshot
         self.release = release
         self.s3_bucket = s3_bucket
 
+        if image_store is None and s3_bucket:
+            image_store = S3ImageStore(s3_bucket)
+        if peers:
+            # other build hosts serving their caches, tried before the store
+            image_store = PeerImageStore(peers, image_store)
+        self.image_store = image_store
+
+        # Upload the archive while it is being compressed
+        self.stream_upload = stream_upload
+        # keys already sent to the image store by a streamed upload
+        self.uploaded_keys = set()
+
+        # Save images as deduplicated chunks rather than a single tarball
+        self.layered = layered
+        self.chunk_store = ChunkStore(os.path.join(SNAPSHOT_CACHE, CHUNK_DIR))
+        self.rootfs_cache = RootfsCache(SNAPSHOT_CACHE)
+        # How launches clone the extracted rootfs (i.e. btrfs), detected
+        # from the cache's filesystem unless given
+        self.clone_backend_name = clone_backend
+        self._clone_backend = None
+        self.metadata = MetadataStore(os.path.join(SNAPSHOT_CACHE, METADATA_FILE))
+
+        # Host package caches (i.e. apt, pip) mounted into the container,
+        # per project where they aren't shared
+        self.package_caches = package_caches
+        self.project = project
+        self.package_cache = PackageCache(SNAPSHOT_CACHE)
+
+        # Directories (i.e. a ccache directory) kept per project between jobs
+        self.workspaces = workspaces
+        self.workspace_cache = WorkspaceCache(SNAPSHOT_CACHE)
+
+        # When set, command output is captured and streamed to the reporter
+        self.log_reporter = log_reporter
+
+        self.metrics = metrics or PhaseRecorder()
+
+        # Seconds between cgroup usage samples while running commands
+        self.sample_interval = sample_interval
+
         # This will be the hostname inside the container
         self.utsname = snapshot or str(uuid4())
 
@@ -30,6 +133,42 @@ class Container(lxc.Container):
         """ May be real path or overlayfs:base-dir:delta-dir """
         return self.get_config_item('lxc.rootfs').split(':')[-1]
 
+    @property
+    def rootfs_layers(self):
+        """ Returns (base-dir, delta-dir), base-dir is None if not an overlay """
+        parts = self.get_config_item('lxc.rootfs').split(':')
+        if len(parts) == 3:
+            return parts[1], parts[2]
+        return None, parts[-1]
+
+    @property
+    def clone_backend(self):
+        if self._clone_backend is None:
+            self._clone_backend = get_clone_backend(SNAPSHOT_CACHE, self.clone_backend_name)
+        return self._clone_backend
+
+    @property
+    def origin_path(self):
+        return os.path.join(os.path.dirname(self.config_file_name), ORIGIN_FILE)
+
+    @property
+    def owner_path(self):
+        return os.path.join(os.path.dirname(self.config_file_name), OWNER_FILE)
+
+    def mark_owner(self):
+        with open(self.owner_path, 'w') as fp:
+            fp.write(get_owner_id())
+
+    def update_metadata(self, method, *args, **kwargs):
+        """
+        The metadata database is advisory (the manager reconciles it with
+        the disk), so failing to write it must never fail a build.
+        """
+        try:
+            getattr(self.metadata, method)(*args, **kwargs)
+        except (sqlite3.Error, OSError):
+            logging.exception('Failed to update image metadata')
+
     def get_home_dir(self, user):
         return '/root' if user == 'root' else '/home/{}'.format(user)
 
@@ -41,7 +180,7 @@ class Container(lxc.Container):
             snapshot=snapshot,
         )
 
-    def ensure_image_cached(self, snapshot):
+    def ensure_image_cached(self, snapshot, assemble=True):
         """
         To avoid complexity of having a sort-of public host, and to ensure we
         can just instead easily store images on S3 (or similar) we attempt to
@@ -49,49 +188,264 @@ class Container(lxc.Container):
         that when we attempt to run the image, the download will look for our
         existing cache (that we've correctly populated) and just reference the
         image from there.
+
+        Layered images only carry a manifest, so after syncing the metadata we
+        fetch whichever chunks are missing locally and reassemble the rootfs.
+
+        Images with a manifest listing file hashes are verified. Files are
+        hashed as they download, and files already in the cache are only
+        re-hashed (with ``validate``) if their size, mtime or inode changed
+        since they were last verified.
+
+        Without ``assemble`` the chunks of a layered image are only fetched,
+        which is all prefetching needs.
         """
         path = self.get_image_path(snapshot)
 
-        local_path = "/var/cache/lxc/download/{}".format(path)
+        local_path = "{}/{}".format(SNAPSHOT_CACHE, path)
         # list of files required to avoid network hit
         file_list = [
             'rootfs.tar.xz',
             'config',
             'snapshot_id',
         ]
-        if all(os.path.exists(os.path.join(local_path, f)) for f in file_list):
+
+        manifest = read_manifest(local_path)
+        if manifest is not None and 'files' in manifest:
+            bad = verify_image(local_path, manifest, rehash=self.validate)
+            if bad:
+                print("==> Image {} failed verification: {}".format(
+                    snapshot, ', '.join(bad)))
+                self.download_image(snapshot)
+                manifest = read_manifest(local_path)
+        elif all(os.path.exists(os.path.join(local_path, f)) for f in file_list):
             return
+        elif manifest is None or not os.path.exists(os.path.join(local_path, 'config')):
+            self.download_image(snapshot)
+            manifest = read_manifest(local_path)
+
+        if manifest is not None and 'chunks' in manifest:
+            self.fetch_chunks(snapshot, manifest)
+            if assemble and not os.path.exists(os.path.join(local_path, 'rootfs.tar.xz')):
+                print("==> Assembling rootfs.tar.xz from chunks")
+                self.chunk_store.assemble(
+                    manifest['chunks'], os.path.join(local_path, 'rootfs.tar.xz'))
+
+    def is_image_cached(self, snapshot):
+        """
+        Cheaply check whether an image is fully present locally (sizes only,
+        plus whatever has already been verified).
+        """
+        local_path = "{}/{}".format(SNAPSHOT_CACHE, self.get_image_path(snapshot))
+        manifest = read_manifest(local_path)
+        if manifest is None:
+            return all(os.path.exists(os.path.join(local_path, f))
+                       for f in ('rootfs.tar.xz', 'config', 'snapshot_id'))
+        if verify_image(local_path, manifest, rehash=False):
+            return False
+        return not self.chunk_store.missing(manifest.get('chunks', ()))
 
-        assert self.s3_bucket, 'Missing S3 bucket configuration'
+    def download_image(self, snapshot):
+        """
+        Fetch an image from the store. When it has a manifest, each listed
+        file is streamed and hashed on the way in, skipping any we already
+        hold a verified copy of, and the manifest is written last.
+        """
+        assert self.image_store, 'Missing S3 bucket configuration'
 
+        path = self.get_image_path(snapshot)
+        local_path = "{}/{}".format(SNAPSHOT_CACHE, path)
         if not os.path.exists(local_path):
             os.makedirs(local_path)
 
-        remote_path = "s3://{}/{}".format(self.s3_bucket, path)
-
         print("==> Downloading image {}".format(snapshot))
-        start = time()
-        assert not subprocess.call(
-            ["aws", "s3", "sync", remote_path, local_path],
-            env=os.environ.copy(),
-        ), "Failed to download image {}".format(remote_path)
-        stop = time()
+        with self.metrics.phase('download', snapshot=snapshot) as record:
+            start = time()
+            size_before = get_directory_size(local_path)
+            manifest_key = '{}/{}'.format(path, MANIFEST_FILE)
+            if self.image_store.exists(manifest_key):
+                fp = self.image_store.open(manifest_key)
+                try:
+                    manifest = json.loads(fp.read().decode('utf-8'))
+                finally:
+                    fp.close()
+
+                cache = VerificationCache(local_path)
+                for name, expected in sorted(manifest.get('files', {}).items()):
+                    file_path = os.path.join(local_path, name)
+                    if cache.is_verified(file_path, name, expected['sha256']):
+                        continue
+                    self.image_store.get_verified(
+                        '{}/{}'.format(path, name), file_path, expected['sha256'])
+                    cache.record(file_path, name, expected['sha256'])
+                cache.save()
+
+                if 'files' not in manifest:
+                    # layered image from before manifests listed their files
+                    for name in ('config', 'snapshot_id'):
+                        self.image_store.get('{}/{}'.format(path, name),
+                                             os.path.join(local_path, name))
+                write_manifest(local_path, manifest)
+            else:
+                self.image_store.download(path, local_path)
+            stop = time()
+            record['bytes'] = get_directory_size(local_path) - size_before
         print("==> Image {} downloaded in {}s".format(
             snapshot, int((stop - start) * 100) / 100))
 
+        manifest = read_manifest(local_path) or {}
+        dir_size = get_directory_size(local_path)
+        self.update_metadata(
+            'record_image', snapshot, local_path,
+            dir_size=dir_size,
+            # corrected for shared chunks when the manager next loads it
+            size=dir_size,
+            chunks=[c['id'] for c in manifest.get('chunks', ())],
+            is_intact=1,
+            download_time=stop - start,
+        )
+
+    def ensure_rootfs_extracted(self, snapshot):
+        """
+        Returns the extracted rootfs cache entry for a snapshot, downloading
+        and extracting the image (and any delta parents) if needed.
+        """
+        entry = self.rootfs_cache.get(snapshot)
+        if entry is not None:
+            return entry
+
+        chain = self.ensure_image_chain(snapshot)
+
+        layers = []
+        for image in chain:
+            local_path = "{}/{}".format(SNAPSHOT_CACHE, self.get_image_path(image))
+            layers.append((image, os.path.join(local_path, 'rootfs.tar.xz'),
+                           read_manifest(local_path) or {}))
+
+        print("==> Extracting image {}".format(snapshot))
+        with self.metrics.phase('extract', snapshot=snapshot) as record:
+            start = time()
+            entry = self.rootfs_cache.extract(snapshot, layers, self.clone_backend)
+            stop = time()
+            record['bytes'] = entry.size
+        print("==> Image {} extracted in {}s".format(
+            snapshot, int((stop - start) * 100) / 100))
+
+        for image in chain:
+            self.discard_assembled_image(image)
+
+        return entry
+
+    def define_base_container(self, snapshot, rootfs):
+        """
+        Define a (never started) container on top of an extracted rootfs for
+        launches to clone, the same way the lxc download template would.
+        """
+        local_path = "{}/{}".format(SNAPSHOT_CACHE, self.get_image_path(snapshot))
+
+        base = lxc.Container(snapshot)
+        config_dir = os.path.dirname(base.config_file_name)
+        if not os.path.exists(config_dir):
+            os.makedirs(config_dir)
+
+        if os.path.exists(LXC_DEFAULT_CONFIG):
+            assert base.load_config(LXC_DEFAULT_CONFIG), \
+                "Unable to load {}".format(LXC_DEFAULT_CONFIG)
+
+        with open(os.path.join(local_path, 'config')) as fp:
+            for line in fp:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                key, value = [p.strip() for p in line.split('=', 1)]
+                value = value.replace('LXC_TEMPLATE_CONFIG', LXC_TEMPLATE_CONFIG)
+                assert base.set_config_item(key, value), \
+                    "Unable to set {}".format(key)
+
+        assert base.set_config_item('lxc.rootfs', rootfs)
+        assert base.set_config_item('lxc.utsname', snapshot)
+        assert base.save_config(), \
+            "Failed to define base container: {}".format(snapshot)
+        return base
+
+    def ensure_image_chain(self, snapshot, assemble=True):
+        """
+        Ensure a snapshot and all of its delta parents are cached, returning
+        them ordered from the full base image to the given snapshot.
+        """
+        chain = []
+        while snapshot:
+            assert snapshot not in chain, "Cycle in snapshot parents"
+            chain.insert(0, snapshot)
+            self.ensure_image_cached(snapshot=snapshot, assemble=assemble)
+            manifest = read_manifest("{}/{}".format(
+                SNAPSHOT_CACHE, self.get_image_path(snapshot))) or {}
+            snapshot = manifest.get('parent')
+        return chain
+
+    def fetch_chunks(self, snapshot, manifest):
+        missing = self.chunk_store.missing(manifest['chunks'])
+        if not missing:
+            return
+
+        assert self.image_store, 'Missing S3 bucket configuration'
+
+        print("==> Fetching {} of {} chunks for image {}".format(
+            len(missing), len(manifest['chunks']), snapshot))
+        with self.metrics.phase('download.chunks', snapshot=snapshot) as record:
+            start = time()
+            self.image_store.get_chunks(self.chunk_store, missing)
+            stop = time()
+            record['bytes'] = sum(c['compressed_size'] for c in missing)
+        self.update_metadata('add_chunks', missing)
+        print("==> Chunks for image {} downloaded in {}s".format(
+            snapshot, int((stop - start) * 100) / 100))
+
+    def discard_assembled_image(self, snapshot):
+        """
+        Once the base container exists, the tarball reassembled from chunks
+        is only a duplicate of data in the chunk store.
+        """
+        local_path = "{}/{}".format(SNAPSHOT_CACHE, self.get_image_path(snapshot))
+        manifest = read_manifest(local_path)
+        if manifest is not None and 'chunks' in manifest:
+            os.unlink(os.path.join(local_path, 'rootfs.tar.xz'))
+
     def upload_image(self, snapshot):
-        assert self.s3_bucket, 'Missing S3 bucket configuration'
+        assert self.image_store, 'Missing S3 bucket configuration'
 
         path = self.get_image_path(snapshot)
         local_path = "{}/{}".format(SNAPSHOT_CACHE, path)
-        remote_path = "s3://{}/{}".format(self.s3_bucket, path)
 
         start = time()
         print("==> Uploading image {}".format(snapshot))
-        assert not subprocess.call(
-            ["aws", "s3", "sync", local_path, remote_path],
-            env=os.environ.copy(),
-        ), "Failed to upload image {}".format(remote_path)
+        with self.metrics.phase('upload', snapshot=snapshot) as record:
+            manifest = read_manifest(local_path)
+            if manifest is not None:
+                record['bytes'] = 0
+                if 'chunks' in manifest:
+                    record['bytes'] += sum(
+                        c['compressed_size'] for c in manifest['chunks'])
+                    self.image_store.put_chunks(self.chunk_store, manifest['chunks'])
+                names = sorted(manifest.get('files', ('config', 'snapshot_id')))
+                for name in names:
+                    key = '{}/{}'.format(path, name)
+                    if key in self.uploaded_keys:
+                        continue
+                    file_path = os.path.join(local_path, name)
+                    record['bytes'] += os.path.getsize(file_path)
+                    if os.path.getsize(file_path) > PART_SIZE:
+                        upload_file(self.image_store, file_path, key)
+                    else:
+                        self.image_store.put(file_path, key)
+                # the manifest goes last (in a single atomic put) so the
+                # image is never visible before all of its files and
+                # chunks are
+                self.image_store.put(os.path.join(local_path, MANIFEST_FILE),
+                                     '{}/{}'.format(path, MANIFEST_FILE))
+            else:
+                record['bytes'] = get_directory_size(local_path)
+                self.image_store.upload(local_path, path)
         stop = time()
         print("==> Image {} uploaded in {}s".format(
             snapshot, int((stop - start) * 100) / 100))
@@ -105,53 +459,218 @@ class Container(lxc.Container):
         print("==> Writing local script {} as /{}".format(script_path, new_name))
         shutil.copy(script_path, os.path.join(self.rootfs, new_name))
         script_path = '/' + new_name
-        assert self.run(['chmod', '0755', script_path], quiet=True) == 0
-        assert self.run([script_path], **kwargs) == 0
+        chmod, script = self.run_batch([
+            {'cmd': ['chmod', '0755', script_path], 'quiet': True},
+            dict(kwargs, cmd=[script_path]),
+        ])
+        assert chmod['returncode'] == 0
+        assert script['returncode'] == 0
 
+    @instrumented('run')
     def run(self, cmd, cwd=None, env=None, user='root', quiet=False):
         assert self.running, "Cannot run cmd in non-RUNNING container"
 
-        home_dir = self.get_home_dir(user)
-        if cwd is None:
-            cwd = home_dir
-        else:
-            cwd = '/'
-
-        def run(args):
-            cmd, cwd, env = args
-
-            new_env = {
-                # TODO(dcramer): HOME is pretty hacky here
-                'USER': user,
-                'HOME': home_dir,
-                'PWD': cwd,
-                'DEBIAN_FRONTEND': 'noninteractive',
-                'LXC_NAME': self.name,
-                'HOST_HOSTNAME': socket.gethostname(),
-                'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
-            }
-            if env:
-                new_env.update(env)
-
-            if user != 'root':
-                cmd = ['sudo', '-EHu', user] + cmd
-
-            return subprocess.call(cmd, cwd=cwd, env=new_env)
-
         if not quiet:
             print("==> Running: {}".format(cmd))
 
-        ret_code = self.attach_wait(run, (cmd, cwd, env), env_policy=lxc.LXC_ATTACH_CLEAR_ENV)
+        ret_code, results = self.attach_batch([{
+            'cmd': cmd, 'cwd': cwd, 'env': env, 'user': user, 'quiet': True,
+        }], quiet=quiet)
+        if results[0]['returncode'] is not None:
+            ret_code = results[0]['returncode']
 
         if not quiet:
             print("==> Command exited: {}".format(ret_code))
 
         return ret_code
 
+    @instrumented('run_batch')
+    def run_batch(self, commands, fail_fast=True, quiet=False):
+        """
+        Runs ``commands`` in order within a single attached process, rather
+        than attaching (and setting up an environment) for each one.
+
+        Each command is a list of arguments, or a dict of ``cmd`` and
+        optionally ``cwd``, ``env``, ``user`` (default root), ``quiet`` and
+        ``fail_fast``. Unless ``fail_fast`` is off (for the batch, or the
+        command) a failed command skips the rest.
+
+        Returns a dict per command of its ``returncode`` (None if it was
+        skipped) and ``duration`` in seconds.
+        """
+        assert self.running, "Cannot run cmd in non-RUNNING container"
+
+        ret_code, results = self.attach_batch(commands, fail_fast, quiet)
+        # the attached process only fails if it couldn't run the commands
+        assert ret_code == 0, \
+            "Attached process exited with {} before running every command".format(ret_code)
+
+        if not quiet:
+            ran = [r for r in results if r['returncode'] is not None]
+            print("==> Ran {} of {} commands in {}s".format(
+                len(ran), len(results), round(sum(r['duration'] for r in ran), 2)))
+
+        return results
+
+    def get_batch_commands(self, commands, fail_fast=True, quiet=False):
+        result = []
+        for command in commands:
+            if not isinstance(command, dict):
+                command = {'cmd': command}
+            assert set(command) <= BATCH_COMMAND_KEYS, \
+                "Unknown command options: {}".format(set(command) - BATCH_COMMAND_KEYS)
+            assert command.get('cmd'), "Missing command"
+
+            command = dict(command)
+            command.setdefault('user', 'root')
+            command.setdefault('fail_fast', fail_fast)
+            command['quiet'] = quiet or command.get('quiet', False)
+            command['home_dir'] = self.get_home_dir(command['user'])
+            if command.get('cwd') is None:
+                command['cwd'] = command['home_dir']
+            result.append(command)
+        return result
+
+    def attach_batch(self, commands, fail_fast=True, quiet=False):
+        """
+        Attach once and run each command. Results come back from the
+        attached process through a pipe, as one JSON line per command.
+
+        Returns the attached process's exit code (non-zero if it failed
+        before reporting every command) and a result per command.
+        """
+        commands = self.get_batch_commands(commands, fail_fast, quiet)
+
+        def run(args):
+            commands, results_fd, stdout, stderr = args
+            hostname = socket.gethostname()
+            # where the commands' output goes
+            out_fd = 1 if stdout is None else stdout
+            err_fd = 2 if stderr is None else stderr
+
+            for command in commands:
+                user = command['user']
+                new_env = {
+                    # TODO(dcramer): HOME is pretty hacky here
+                    'USER': user,
+                    'HOME': command['home_dir'],
+                    'PWD': command['cwd'],
+                    'DEBIAN_FRONTEND': 'noninteractive',
+                    'LXC_NAME': self.name,
+                    'HOST_HOSTNAME': hostname,
+                    'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+                }
+                if command.get('env'):
+                    new_env.update(command['env'])
+
+                cmd = command['cmd']
+                if user != 'root':
+                    cmd = ['sudo', '-EHu', user] + cmd
+
+                if not command['quiet']:
+                    write_fd(out_fd, "==> Running: {}\n".format(command['cmd']).encode('utf-8'))
+
+                start = time()
+                try:
+                    returncode = subprocess.call(cmd, cwd=command['cwd'], env=new_env,
+                                                 stdout=stdout, stderr=stderr)
+                except OSError as e:
+                    write_fd(err_fd, "==> Failed to run {}: {}\n".format(cmd, e).encode('utf-8'))
+                    returncode = 127
+                duration = time() - start
+
+                if not command['quiet']:
+                    write_fd(out_fd, "==> Command exited: {}\n".format(returncode).encode('utf-8'))
+                write_fd(results_fd, (json.dumps({
+                    'returncode': returncode,
+                    'duration': duration,
+                }) + '\n').encode('utf-8'))
+
+                if returncode != 0 and command['fail_fast']:
+                    break
+            return 0
+
+        output = []
+        results_pipe = OutputPipe(output.append)
+        pipes = self.get_output_pipes()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for pipe in pipes + [results_pipe]:
+            pipe.start()
+        if pipes:
+            stdout, stderr = [p.write_fd for p in pipes]
+        else:
+            stdout, stderr = None, None
+
+        sampler = None
+        if self.sample_interval and not quiet:
+            sampler = CgroupSampler(self, interval=self.sample_interval)
+            sampler.start()
+
+        try:
+            ret_code = self.attach_wait(run, (commands, results_pipe.write_fd, stdout, stderr),
+                                        env_policy=lxc.LXC_ATTACH_CLEAR_ENV)
+        finally:
+            for pipe in pipes:
+                pipe.close(timeout=5)
+            # only the attached process writes results, and it has exited
+            results_pipe.close(timeout=5)
+            if sampler:
+                sampler.stop()
+                cmd = commands[0]['cmd'] if len(commands) == 1 else [c['cmd'] for c in commands]
+                self.report_usage(cmd, sampler.summary())
+
+        results = [json.loads(line) for line in b''.join(output).decode('utf-8').splitlines()]
+        for command in commands[len(results):]:
+            results.append({'returncode': None, 'duration': None})
+        for command, result in zip(commands, results):
+            result['cmd'] = command['cmd']
+        return ret_code, results
+
+    def report_usage(self, cmd, summary):
+        if not summary:
+            return
+
+        self.metrics.record(dict(summary, phase='run.usage', cmd=cmd))
+
+        print("==> Resource usage: peak memory {}MB (p95 {}MB), peak cpu {} cores (p95 {}), "
+              "io {}MB read / {}MB written, peak pids {}".format(
+                  summary['memory_peak_bytes'] // 1024 // 1024,
+                  summary['memory_p95_bytes'] // 1024 // 1024,
+                  round(summary.get('cpu_peak_cores', 0), 2),
+                  round(summary.get('cpu_p95_cores', 0), 2),
+                  summary['io_read_bytes'] // 1024 // 1024,
+                  summary['io_write_bytes'] // 1024 // 1024,
+                  summary['pids_peak'],
+              ))
+
+    def get_output_pipes(self):
+        """
+        Returns (stdout, stderr) pipes which tee the child's output to our
+        own terminal and to the log reporter, or an empty list if there is
+        no reporter and the child can simply inherit our descriptors.
+        """
+        if self.log_reporter is None:
+            return []
+
+        return [
+            OutputPipe(
+                partial(write_fd, sys.__stdout__.fileno()),
+                partial(self.log_reporter.write, stream='stdout'),
+            ),
+            OutputPipe(
+                partial(write_fd, sys.__stderr__.fileno()),
+                partial(self.log_reporter.write, stream='stderr'),
+            ),
+        ]
+
     def install(self, pkgs):
-        assert self.run(["apt-get", "update", "-y", "--fix-missing"]) == 0, \
-            "Failed updating apt resources"
-        return self.run(["apt-get", "install", "-y", "--force-yes"] + pkgs)
+        update, install = self.run_batch([
+            ["apt-get", "update", "-y", "--fix-missing"],
+            ["apt-get", "install", "-y", "--force-yes"] + pkgs,
+        ])
+        assert update['returncode'] == 0, "Failed updating apt resources"
+        return install['returncode']
 
     def setup_sudoers(self, user='ubuntu'):
         sudoers_path = os.path.join(self.rootfs, 'etc', 'sudoers')
@@ -166,36 +685,183 @@ class Container(lxc.Container):
 
         return True
 
-    def launch(self, pre=None, post=None, clean=False, flush_cache=False):
+    def lock_numa_node(self, limits, lock_dir=SNAPSHOT_CACHE):
+        """
+        With a cpuset of "auto", returns a host-wide lock to hold until the
+        container has started, so concurrent launches each see the nodes
+        the others picked. Otherwise returns None.
+        """
+        if limits.get('cpuset') != 'auto':
+            return None
+        os.makedirs(lock_dir, exist_ok=True)
+        lock = open(os.path.join(lock_dir, NUMA_LOCK_FILE), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def apply_limits(self, limits):
+        """
+        Set cgroup resource limits (cpu_shares, cpuset, memory_limit,
+        blkio_weight) on the container config before it is started.
+        """
+        nodes, containers = None, ()
+        if limits.get('cpuset') == 'auto':
+            nodes = get_numa_nodes()
+            containers = lxc.list_containers(active=True, as_object=True)
+
+        for key, value in get_limit_config(limits, nodes, containers):
+            print("==> Setting {} = {}".format(key, value))
+            assert self.set_config_item(key, value), \
+                "Failed to set {}".format(key)
+
+    def attach_caches(self, user='ubuntu'):
+        """
+        Mount the host package caches and project workspaces into the
+        container. The config is saved while they are locked, so they are
+        seen to be in use before anything can evict (or claim) them.
+        """
+        mounts, locks = [], []
+        try:
+            if self.package_caches:
+                cache_mounts, cache_locks = self.package_cache.get_mount_entries(
+                    self.name, self.package_caches, self.release, self.project,
+                    self.get_home_dir(user))
+                mounts.extend(cache_mounts)
+                locks.extend(cache_locks)
+            if self.workspaces:
+                workspace_mounts, workspace_locks = self.workspace_cache.get_mount_entries(
+                    self.project, self.workspaces)
+                mounts.extend(workspace_mounts)
+                locks.extend(workspace_locks)
+
+            for value in mounts:
+                assert self.append_config_item('lxc.mount.entry', value), \
+                    "Failed to mount {}".format(value)
+            assert self.save_config(), "Failed to save container config"
+        finally:
+            for lock in locks:
+                lock.close()
+
+    def get_cache_mounts(self, root):
+        mounts = self.get_config_item('lxc.mount.entry') or []
+        if isinstance(mounts, str):
+            mounts = [mounts]
+        return [m for m in mounts if root in m]
+
+    def clone_rootfs(self, base):
+        """
+        Define the container as a copy of ``base`` whose rootfs is a clone
+        made by the backend, kept on the same filesystem as the base's.
+        """
+        src = base.get_config_item('lxc.rootfs')
+        clone_path = os.path.join(SNAPSHOT_CACHE, CLONE_DIR, self.name)
+        rootfs = os.path.join(clone_path, 'rootfs')
+
+        config_dir = os.path.dirname(self.config_file_name)
+        os.makedirs(config_dir)
+        # written first, so the base is never evicted from under the clone
+        with open(self.origin_path, 'w') as fp:
+            fp.write(src)
+
+        os.makedirs(clone_path)
+        self.clone_backend.clone_rootfs(src, rootfs)
+
+        assert self.load_config(base.config_file_name), \
+            "Unable to load {}".format(base.config_file_name)
+        assert self.set_config_item('lxc.rootfs', rootfs)
+        assert self.save_config(), "Failed to define container: {}".format(self.name)
+
+    @property
+    def tmpfs_path(self):
+        return os.path.join(os.path.dirname(self.config_file_name), TMPFS_DIR)
+
+    def mount_tmpfs_layer(self, size):
+        """
+        Move the (overlay) container's upper directory to a tmpfs, returning
+        whether there was the memory for it.
+        """
+        base, delta = self.rootfs_layers
+        assert base, "A tmpfs layer requires an overlayfs clone"
+        if not mount_tmpfs(self.tmpfs_path, size,
+                           lock_path=os.path.join(SNAPSHOT_CACHE, TMPFS_LOCK_FILE)):
+            print("==> Writing to disk instead")
+            return False
+
+        upper = os.path.join(self.tmpfs_path, os.path.basename(delta))
+        subprocess.check_call(['cp', '-a', delta, upper])
+        prefix = self.get_config_item('lxc.rootfs').split(':')[0]
+        assert self.set_config_item('lxc.rootfs', '{}:{}:{}'.format(prefix, base, upper))
+        assert self.save_config(), "Failed to save container config"
+        print("==> Writing to a {} byte tmpfs".format(size))
+        return True
+
+    def unmount_tmpfs_layer(self):
+        """
+        Drop the tmpfs, pointing the overlay back at an (empty) upper
+        directory on disk for lxc to remove.
+        """
+        unmount_tmpfs(self.tmpfs_path)
+        prefix, base, upper = self.get_config_item('lxc.rootfs').split(':')
+        upper = os.path.join(os.path.dirname(self.config_file_name), os.path.basename(upper))
+        os.makedirs(upper, exist_ok=True)
+        assert self.set_config_item('lxc.rootfs', '{}:{}:{}'.format(prefix, base, upper))
+
+    @instrumented('launch')
+    def launch(self, pre=None, post=None, clean=False, flush_cache=False,
+               limits=None, tmpfs_size=None, tmpfs_required=False, owned=False):
         """ Launch a container
 
         If we have a snapshot, attempt to download and extract the image to clone.
         Without a snapshot, generate a container from ubuntu minimal install.
+
+        With a ``tmpfs_size`` the writable layer is kept in memory, if the
+        host has enough of it. Otherwise it stays on disk, unless
+        ``tmpfs_required`` is set, in which case the launch fails.
+
+        If ``owned``, the calling process is recorded as the container's
+        owner, and the container is reaped as an orphan once it has exited.
+        Only pass it when this process destroys the container.
         """
+        if tmpfs_size and (clean or not self.snapshot):
+            assert not tmpfs_required, "A tmpfs layer requires a snapshot"
+            print("==> A tmpfs layer requires a snapshot, writing to disk")
+            tmpfs_size = None
+        if tmpfs_size and tmpfs_required:
+            # fail before fetching anything
+            headroom = get_memory_headroom()
+            assert headroom - tmpfs_size >= DEFAULT_RESERVE, \
+                "Not enough memory for a {} byte tmpfs ({} bytes free)".format(
+                    tmpfs_size, headroom)
 
         if self.snapshot and not clean:
-            if self.snapshot not in lxc.list_containers():
-                self.ensure_image_cached(snapshot=self.snapshot)
-
-                create_args = [
-                    '--dist', 'ubuntu',
-                    '--release', self.release,
-                    '--arch', 'amd64',
-                    '--variant', self.snapshot,
-                ]
-                if not self.validate:
-                    create_args.extend(['--no-validate'])
+            JobHistory(os.path.join(SNAPSHOT_CACHE, JOB_HISTORY_FILE)).record(
+                self.snapshot, self.release)
 
-                base = lxc.Container(self.snapshot)
-                assert base.create('download', args=create_args), (
-                    "Failed to load cached image: {}".format(self.snapshot))
+            if self.snapshot not in lxc.list_containers():
+                entry = self.ensure_rootfs_extracted(self.snapshot)
+                base = self.define_base_container(self.snapshot, entry.rootfs)
             else:
                 base = lxc.Container(self.snapshot)
+            self.rootfs_cache.touch(self.snapshot)
+            self.update_metadata('record_access', self.snapshot)
+
+            backend = self.clone_backend
+            if tmpfs_size:
+                # only the overlay's upper directory moves to the tmpfs
+                backend = OverlayBackend()
+            print("==> Cloning container: {} ({})".format(self.snapshot, backend.name))
+            with self.metrics.phase('clone', backend=backend.name) as record:
+                if backend.lxc_snapshot:
+                    assert base.clone(self.name, flags=lxc.LXC_CLONE_KEEPNAME | lxc.LXC_CLONE_SNAPSHOT), (
+                        "Failed to clone: {}".format(self.snapshot))
+                    assert self.load_config(), "Unable to reload container config"
+                else:
+                    self.clone_rootfs(base)
 
-            print("==> Overlaying container: {}".format(self.snapshot))
-            assert base.clone(self.name, flags=lxc.LXC_CLONE_KEEPNAME | lxc.LXC_CLONE_SNAPSHOT), (
-                "Failed to clone: {}".format(self.snapshot))
-            assert self.load_config(), "Unable to reload container config"
+                if tmpfs_size:
+                    mounted = self.mount_tmpfs_layer(tmpfs_size)
+                    assert mounted or not tmpfs_required, "Not enough memory for a tmpfs layer"
+                    if mounted:
+                        record['tmpfs'] = tmpfs_size
         else:
             create_args = [
                 '--release', self.release,
@@ -208,6 +874,9 @@ class Container(lxc.Container):
             assert self.create('ubuntu', args=create_args), \
                 "Failed to create container. Try running this command as root."
 
+        if owned:
+            self.mark_owner()
+
         if pre:
             pre_env = dict(os.environ, LXC_ROOTFS=self.rootfs, LXC_NAME=self.name)
             subprocess.check_call(pre, cwd=self.rootfs, env=pre_env)
@@ -218,8 +887,19 @@ class Container(lxc.Container):
         assert self.append_config_item('lxc.cgroup.devices.allow', 'c 10:137 rwm')
         assert self.append_config_item('lxc.cgroup.devices.allow', 'b 6:* rwm')
 
-        print("==> Starting container")
-        assert self.start(), "Failed to start base container"
+        numa_lock = self.lock_numa_node(limits or {})
+        try:
+            if limits:
+                self.apply_limits(limits)
+
+            if self.package_caches or self.workspaces:
+                self.attach_caches()
+
+            print("==> Starting container")
+            assert self.start(), "Failed to start base container"
+        finally:
+            if numa_lock is not None:
+                numa_lock.close()
 
         print("==> Waiting for container to startup networking")
         assert self.get_ips(family='inet', timeout=30), "Failed to connect to container"
@@ -234,8 +914,17 @@ class Container(lxc.Container):
             # Naively check if trying to run a file that exists outside the container
             self.run_script(post)
 
-    def create_image(self):
-        snapshot = self.snapshot or str(uuid4())
+    @instrumented('create_image')
+    def create_image(self, snapshot=None, parent=None):
+        """
+        Save the (stopped) container as a snapshot image.
+
+        With a parent snapshot the container must be an overlay clone of it,
+        and only the overlay delta is archived. Whiteouts and opaque
+        directories are recorded in the manifest so launch can stack the
+        delta back on top of its parent.
+        """
+        snapshot = snapshot or self.snapshot or str(uuid4())
         dest = "/var/cache/lxc/download/{}".format(
             self.get_image_path(snapshot))
 
@@ -255,16 +944,163 @@ class Container(lxc.Container):
 
         rootfs_txz = os.path.join(dest, "rootfs.tar.xz")
 
-        print("==> Creating rootfs.tar.xz")
-        subprocess.check_call(["tar", "-Jcf", rootfs_txz,
-                               "-C", self.get_config_item('lxc.rootfs'),
-                               "."])
-
         with open(os.path.join(dest, "snapshot_id"), 'w') as fp:
             fp.write(self.utsname)
 
+        manifest = {'snapshot': snapshot}
+        if parent:
+            base, delta = self.rootfs_layers
+            assert base, "Delta images require an overlayfs clone of the parent"
+            whiteouts, opaque, markers = scan_delta(base, delta)
+            print("==> Creating delta against {} ({} whiteouts, {} opaque dirs)".format(
+                parent, len(whiteouts), len(opaque)))
+            manifest.update({
+                'parent': parent,
+                'whiteouts': whiteouts,
+                'opaque': opaque,
+            })
+            tar_args = ["-C", delta] + get_exclude_args(markers) + ["."]
+        else:
+            tar_args = ["-C", self.get_config_item('lxc.rootfs'), "."]
+
+        files = {
+            'config': describe_file(os.path.join(dest, 'config')),
+            'snapshot_id': describe_file(os.path.join(dest, 'snapshot_id')),
+        }
+        if self.layered:
+            if os.path.exists(rootfs_txz):
+                os.unlink(rootfs_txz)
+            manifest['chunks'] = self.create_layers(tar_args)
+        else:
+            print("==> Creating rootfs.tar.xz")
+            key = None
+            if self.stream_upload and self.image_store:
+                key = '{}/rootfs.tar.xz'.format(self.get_image_path(snapshot))
+            files['rootfs.tar.xz'] = self.create_archive(rootfs_txz, tar_args, key)
+        manifest['files'] = files
+
+        cache = VerificationCache(dest)
+        for name, expected in files.items():
+            cache.record(os.path.join(dest, name), name, expected['sha256'])
+        cache.save()
+
+        write_manifest(dest, manifest)
+
+        dir_size = get_directory_size(dest)
+        self.update_metadata(
+            'record_image', snapshot, dest,
+            dir_size=dir_size,
+            size=dir_size,
+            chunks=[c['id'] for c in manifest.get('chunks', ())],
+            is_intact=1,
+        )
+        if self.layered:
+            self.update_metadata('add_chunks', manifest['chunks'])
+
+        rootfs = self.get_config_item('lxc.rootfs')
+        if not parent and self.clone_backend.can_clone(rootfs, self.rootfs_cache.root):
+            # launches of the new snapshot here needn't extract it
+            print("==> Adding rootfs to cache ({})".format(self.clone_backend.name))
+            self.rootfs_cache.add(snapshot, [snapshot],
+                                  partial(self.clone_backend.copy_rootfs, rootfs),
+                                  self.clone_backend)
+
         return snapshot
 
+    def create_archive(self, dest, tar_args, key=None):
+        """
+        Write a compressed archive, hashing it as it is written rather than
+        reading it back afterwards.
+
+        With a ``key`` the archive is also uploaded to the image store as it
+        is produced, so the upload overlaps with compression.
+        """
+        upload = None
+        if key is not None:
+            print("==> Streaming rootfs.tar.xz to image store")
+            upload = MultipartUpload(self.image_store, key)
+
+        proc = subprocess.Popen(["tar", "-Jcf", "-"] + tar_args,
+                                stdout=subprocess.PIPE)
+        try:
+            size, sha256 = copy_hashed(
+                proc.stdout, dest, write=upload.write if upload else None)
+        except Exception:
+            if upload:
+                upload.abort()
+            raise
+        finally:
+            proc.stdout.close()
+        failed = proc.wait() != 0
+        if failed and upload:
+            upload.abort()
+        assert not failed, "Failed to archive rootfs"
+
+        if upload:
+            with self.metrics.phase('upload.stream', key=key) as record:
+                record['bytes'] = size
+                upload.close()
+            self.uploaded_keys.add(key)
+        return {'size': size, 'sha256': sha256}
+
+    def create_layers(self, tar_args):
+        """
+        Archive into the chunk store, only writing chunks we do not already
+        have, and return the manifest entries for the archive.
+        """
+        print("==> Creating rootfs chunks")
+        proc = subprocess.Popen(["tar", "-cf", "-"] + tar_args,
+                                stdout=subprocess.PIPE)
+        chunks = []
+        try:
+            for data in split_archive(proc.stdout):
+                chunks.append(self.chunk_store.add(data))
+        finally:
+            proc.stdout.close()
+        assert proc.wait() == 0, "Failed to archive rootfs"
+
+        created = [c for c in chunks if c.pop('created')]
+        print("==> Wrote {} new chunks ({} bytes), reused {}".format(
+            len(created), sum(c['compressed_size'] for c in created),
+            len(chunks) - len(created)))
+
+        return chunks
+
+    def kill(self, signalled_at=None, timeout=30):
+        """
+        Stops everything running in the container at once, rather than
+        waiting for a clean shutdown. The cgroup is frozen first, which
+        releases its CPU and stops anything forking while the container's
+        init (and with it every process in its pid namespace) is killed.
+
+        Times are recorded relative to ``signalled_at`` (i.e. when a cancel
+        was received).
+        """
+        start = signalled_at or time()
+        record = {'phase': 'cancel'}
+        if self.running:
+            frozen = self.freeze()
+            if frozen:
+                record['cpu_released'] = time() - start
+            # -1 once stopped, which kill() would take as every process
+            init_pid = self.init_pid
+            if init_pid > 0:
+                try:
+                    os.kill(init_pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            # the kill is only delivered once thawed
+            if frozen:
+                self.unfreeze()
+            self.wait('STOPPED', timeout=timeout)
+        record['stopped'] = time() - start
+        record.setdefault('cpu_released', record['stopped'])
+        self.metrics.record(record)
+        print("==> Container killed {}s after cancel, CPU released after {}s".format(
+            round(record['stopped'], 2), round(record['cpu_released'], 2)))
+        return record
+
+    @instrumented('destroy')
     def destroy(self, timeout=-1):
         if not self.defined:
             print("==> No container to destroy")
@@ -276,5 +1112,27 @@ class Container(lxc.Container):
             print("==> Wait for container to stop")
             self.wait('STOPPED', timeout=timeout)
 
-        print("==> Destroying container")
-        super().destroy()
+        mounts = self.get_cache_mounts(self.package_cache.root)
+        if mounts:
+            self.package_cache.harvest(mounts, self.name)
+        mounts = self.get_cache_mounts(self.workspace_cache.root)
+        if mounts:
+            self.workspace_cache.detach(mounts)
+
+        base, rootfs = self.rootfs_layers
+        cloned = os.path.exists(self.origin_path)
+        with self.metrics.phase('destroy.rootfs', backend=self.clone_backend.name) as record:
+            if base is not None or cloned:
+                record['bytes'] = self.clone_backend.get_space_used(rootfs)
+                if record['bytes'] is not None:
+                    print("==> Container wrote {} bytes".format(record['bytes']))
+            if cloned:
+                # cheaper than lxc removing it file by file
+                self.clone_backend.remove_rootfs(rootfs)
+                shutil.rmtree(os.path.dirname(rootfs), ignore_errors=True)
+                self.clear_config_item('lxc.rootfs')
+            if os.path.ismount(self.tmpfs_path):
+                self.unmount_tmpfs_layer()
+
+            print("==> Destroying container")
+            super().destroy()
@@ -0,0 +1,197 @@
+"""
+A long-lived helper process serving ``changes-lxc`` commands on a Unix socket.
+
+Build scripts run ``changes-lxc exec`` many times per job, and each run pays
+for interpreter startup, imports, logging setup and a new container handle.
+The daemon pays for those once. Clients send their arguments, environment
+and working directory along with their stdin, stdout and stderr descriptors
+(as ``SCM_RIGHTS`` ancillary data). Each request is handled in a child
+forked from the daemon, which takes over those descriptors, so output
+(including that of any process it starts) goes straight to the client as
+if the helper had been run directly. The child replies with the exit code.
+
+This module only uses the standard library, so the client stays cheap to
+start.
+"""
+import array
+import json
+import logging
+import os
+import socket
+import sys
+import traceback
+
+from socketserver import BaseRequestHandler, ForkingMixIn, UnixStreamServer
+
+DEFAULT_SOCKET = '/var/run/changes-lxc.sock'
+
+# only these helper commands may be forwarded to the daemon
+FORWARDED_COMMANDS = ('launch', 'exec', 'exec-script', 'exec-batch', 'destroy')
+
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+
+class DaemonError(Exception):
+    pass
+
+
+def send_message(sock, data, fds=()):
+    """
+    Send ``data`` as a line of JSON, passing ``fds`` with it.
+    """
+    payload = json.dumps(data).encode('utf-8') + b'\n'
+    ancillary = []
+    if fds:
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+    sent = sock.sendmsg([payload], ancillary)
+    if sent < len(payload):
+        sock.sendall(payload[sent:])
+
+
+def recv_message(sock, max_fds=3):
+    """
+    Read a line of JSON from ``sock``, returning it with any descriptors
+    passed along with it. Returns ``(None, [])`` if the peer hung up.
+    """
+    payload = b''
+    fds = array.array('i')
+    while not payload.endswith(b'\n'):
+        data, ancdata, flags, addr = sock.recvmsg(
+            4096, socket.CMSG_LEN(max_fds * fds.itemsize))
+        for level, type_, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                usable = len(cmsg_data) - (len(cmsg_data) % fds.itemsize)
+                fds.frombytes(cmsg_data[:usable])
+        if not data:
+            for fd in fds:
+                os.close(fd)
+            return None, []
+        payload += data
+        if len(payload) > MAX_MESSAGE_SIZE:
+            for fd in fds:
+                os.close(fd)
+            raise DaemonError('Message too large')
+    return json.loads(payload.decode('utf-8')), list(fds)
+
+
+def forward(path, argv, fds=(0, 1, 2), cwd=None, env=None):
+    """
+    Run a helper command in the daemon listening on ``path``, with our
+    stdio, and return its exit code.
+
+    Raises ``OSError`` (i.e. ``FileNotFoundError``, ``ConnectionRefusedError``)
+    if no daemon is listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        send_message(sock, {
+            'argv': list(argv),
+            'cwd': cwd or os.getcwd(),
+            'env': dict(os.environ if env is None else env),
+        }, fds)
+        response, _ = recv_message(sock, max_fds=0)
+    finally:
+        sock.close()
+    if response is None:
+        raise DaemonError('The daemon exited without a response')
+    return response['returncode']
+
+
+class HelperRequestHandler(BaseRequestHandler):
+    def handle(self):
+        message, fds = self.server.pending
+        returncode = self.server.execute(message, fds)
+        send_message(self.request, {'returncode': returncode})
+
+
+class HelperDaemon(ForkingMixIn, UnixStreamServer):
+    """
+    Serves ``command``, which must provide ``prepare(argv)`` (called in the
+    daemon before forking, to keep any state worth sharing between
+    requests) and ``execute(argv)`` (called in the forked child).
+    """
+    # seconds a client has to send its request
+    request_timeout = 5
+
+    # requests being handled at once; ForkingMixIn waits for one to finish
+    # before accepting more
+    max_children = 64
+
+    def __init__(self, path, command):
+        self.command = command
+        self.pending = None
+        if os.path.exists(path):
+            os.unlink(path)
+        UnixStreamServer.__init__(self, path, HelperRequestHandler)
+
+    def server_bind(self):
+        # only the user running the daemon (root) may launch containers, so
+        # the socket is created 0600 rather than changed after binding
+        umask = os.umask(0o177)
+        try:
+            UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def process_request(self, request, client_address):
+        request.settimeout(self.request_timeout)
+        try:
+            message, fds = recv_message(request)
+        except (OSError, ValueError) as e:
+            logging.warning('Failed to read request: %s', e)
+            self.shutdown_request(request)
+            return
+        if message is None:
+            self.shutdown_request(request)
+            return
+        request.settimeout(None)
+
+        try:
+            self.command.prepare(message['argv'])
+        except Exception:
+            # the child will hit (and report) the same problem
+            logging.exception('Failed to prepare %s', message['argv'])
+
+        # anything buffered would be written again by the child
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        self.pending = message, fds
+        try:
+            ForkingMixIn.process_request(self, request, client_address)
+        finally:
+            self.pending = None
+            for fd in fds:
+                os.close(fd)
+
+    def execute(self, message, fds):
+        """
+        Become the client (its stdio, working directory and environment)
+        and run its command, returning the exit code.
+        """
+        for target, fd in enumerate(fds):
+            if fd != target:
+                os.dup2(fd, target)
+                os.close(fd)
+        os.chdir(message['cwd'])
+        os.environ.clear()
+        os.environ.update(message['env'])
+
+        try:
+            self.command.execute(message['argv'])
+            returncode = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                returncode = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            # the child exits without flushing
+            sys.stdout.flush()
+            sys.stderr.flush()
+        return returncode
@@ -1,5 +1,7 @@
 from threading import Condition, Event
 
+from .api import BuildCancelled
+
 
 class Heartbeater(object):
     interval = 5
@@ -9,16 +11,21 @@ class Heartbeater(object):
         self.jobstep_id = jobstep_id
         self.cv = Condition()
         self.finished = Event()
+        # set when upstream finished the jobstep, rather than us closing
+        self.cancelled = Event()
 
         if interval is not None:
             self.interval = interval
 
     def wait(self):
         with self.cv:
-            self.finished.clear()
             while not self.finished.is_set():
-                data = self.api.get_jobstep(self.jobstep_id)
+                try:
+                    data = self.api.get_jobstep(self.jobstep_id)
+                except BuildCancelled:
+                    data = {'status': {'id': 'finished'}}
                 if data['status']['id'] == 'finished':
+                    self.cancelled.set()
                     self.finished.set()
                     break
 
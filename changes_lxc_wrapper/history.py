@@ -0,0 +1,67 @@
+"""
+A record of the snapshots launched on this host, used to work out which
+projects' snapshots are worth prefetching.
+"""
+import fcntl
+import json
+import os
+
+from time import time
+from uuid import uuid4
+
+JOB_HISTORY_FILE = 'jobs.log'
+
+
+class JobHistory(object):
+    """
+    Append-only JSON lines of ``{"time", "snapshot", "release"}``. Writers
+    take a lock so that pruning never loses a concurrent append.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def lock(self):
+        fp = open('{}.lock'.format(self.path), 'w')
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        return fp
+
+    def record(self, snapshot, release, when=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        line = json.dumps({
+            'time': when or time(),
+            'snapshot': str(snapshot),
+            'release': release,
+        })
+        with self.lock():
+            with open(self.path, 'a') as fp:
+                fp.write(line + '\n')
+
+    def read(self, since=0):
+        entries = []
+        try:
+            with open(self.path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn write
+                        continue
+                    if entry['time'] >= since:
+                        entries.append(entry)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def prune(self, since):
+        """
+        Drop entries older than ``since``.
+        """
+        if not os.path.exists(self.path):
+            return
+        with self.lock():
+            entries = self.read(since)
+            tmp_path = '{}.{}'.format(self.path, uuid4().hex)
+            with open(tmp_path, 'w') as fp:
+                for entry in entries:
+                    fp.write(json.dumps(entry) + '\n')
+            os.rename(tmp_path, self.path)
@@ -0,0 +1,323 @@
+"""
+Remote storage backends for snapshot images.
+
+Keys are slash separated paths relative to the root of the store, i.e.
+``ubuntu/precise/amd64/<snapshot>/config`` or ``chunks/ab/<chunk id>``.
+"""
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep, time
+from uuid import uuid4
+
+from .integrity import copy_verified
+from .layers import CHUNK_DIR
+
+# in-progress multipart uploads to a local store
+UPLOAD_DIR = '.uploads'
+
+
+class RateLimiter(object):
+    """
+    Caps the combined rate (in bytes per second) of everything sharing the
+    limiter, allowing bursts of up to one second's worth.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time()
+        self.lock = Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time()
+            self.allowance = min(
+                self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= size
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            sleep(delay)
+
+
+class ThrottledReader(object):
+    def __init__(self, fp, limiter):
+        self.fp = fp
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.limiter.consume(len(data))
+        return data
+
+    def close(self):
+        return self.fp.close()
+
+
+class ProcessReader(object):
+    """
+    Streams the stdout of a command. A failed command shows up as a short
+    read, which callers verifying a hash will reject.
+    """
+    def __init__(self, args):
+        self.proc = subprocess.Popen(args, env=os.environ.copy(),
+                                     stdout=subprocess.PIPE)
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        self.proc.stdout.close()
+        return self.proc.wait()
+
+
+class ImageStore(object):
+    # parallel transfers when fetching or sending many chunks
+    concurrency = 8
+
+    # when set, verified downloads are throttled by it
+    rate_limiter = None
+
+    def set_rate_limiter(self, limiter):
+        self.rate_limiter = limiter
+
+    def throttle(self, fp):
+        if self.rate_limiter is None:
+            return fp
+        return ThrottledReader(fp, self.rate_limiter)
+
+    def get(self, key, path):
+        raise NotImplementedError
+
+    def put(self, path, key):
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def open(self, key):
+        """
+        Returns a readable file object streaming the contents of ``key``.
+        """
+        raise NotImplementedError
+
+    def get_verified(self, key, path, sha256, decompress=False):
+        """
+        Like get, but the data is hashed as it arrives and ``path`` is only
+        written if it matches.
+        """
+        fp = self.open(key)
+        try:
+            copy_verified(self.throttle(fp), path, sha256, decompress=decompress)
+        finally:
+            fp.close()
+
+    def start_upload(self, key):
+        """
+        Begin a multipart upload to ``key``, returning its upload id. Nothing
+        is visible at ``key`` until the upload is completed.
+        """
+        raise NotImplementedError
+
+    def put_part(self, key, upload_id, number, data):
+        """
+        Upload part ``number`` (counting from 1), returning whatever
+        complete_upload needs to know about it. Parts may be sent in any
+        order, and re-sending a part replaces it.
+        """
+        raise NotImplementedError
+
+    def complete_upload(self, key, upload_id, parts):
+        raise NotImplementedError
+
+    def abort_upload(self, key, upload_id):
+        raise NotImplementedError
+
+    def download(self, prefix, local_path):
+        """
+        Mirror everything under ``prefix`` into ``local_path``.
+        """
+        raise NotImplementedError
+
+    def upload(self, local_path, prefix):
+        """
+        Mirror everything under ``local_path`` to ``prefix``.
+        """
+        raise NotImplementedError
+
+    def get_chunks(self, chunk_store, chunks):
+        """
+        Fetch the given chunks into the local chunk store, checking each
+        against its id (the sha256 of its uncompressed content).
+        """
+        def fetch(chunk):
+            path = chunk_store.get_path(chunk['id'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.get_verified(chunk_store.get_key(chunk['id']), path,
+                              chunk['id'], decompress=True)
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            list(executor.map(fetch, chunks))
+
+    def put_chunks(self, chunk_store, chunks):
+        """
+        Send any of the given chunks which the store does not have yet.
+        """
+        def send(chunk):
+            key = chunk_store.get_key(chunk['id'])
+            if not self.exists(key):
+                self.put(chunk_store.get_path(chunk['id']), key)
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            list(executor.map(send, chunks))
+
+
+class LocalImageStore(ImageStore):
+    """
+    Stores images in a local (or network mounted) directory.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def get(self, key, path):
+        shutil.copyfile(self.get_path(key), path)
+
+    def put(self, path, key):
+        dest = self.get_path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = '{}.{}'.format(dest, uuid4().hex)
+        shutil.copyfile(path, tmp_path)
+        os.rename(tmp_path, dest)
+
+    def exists(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def open(self, key):
+        return open(self.get_path(key), 'rb')
+
+    def get_upload_path(self, upload_id):
+        return os.path.join(self.root, UPLOAD_DIR, upload_id)
+
+    def start_upload(self, key):
+        upload_id = uuid4().hex
+        os.makedirs(self.get_upload_path(upload_id))
+        return upload_id
+
+    def put_part(self, key, upload_id, number, data):
+        path = os.path.join(self.get_upload_path(upload_id), '{:05d}'.format(number))
+        tmp_path = '{}.{}'.format(path, uuid4().hex)
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_path, path)
+        return number
+
+    def complete_upload(self, key, upload_id, parts):
+        upload_path = self.get_upload_path(upload_id)
+        dest = self.get_path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = '{}.{}'.format(dest, upload_id)
+        with open(tmp_path, 'wb') as out:
+            for number in parts:
+                with open(os.path.join(upload_path, '{:05d}'.format(number)), 'rb') as fp:
+                    shutil.copyfileobj(fp, out, 1024 * 1024)
+        os.rename(tmp_path, dest)
+        shutil.rmtree(upload_path)
+
+    def abort_upload(self, key, upload_id):
+        shutil.rmtree(self.get_upload_path(upload_id), ignore_errors=True)
+
+    def download(self, prefix, local_path):
+        src = self.get_path(prefix)
+        assert os.path.isdir(src), "Missing image {}".format(prefix)
+        for name in os.listdir(src):
+            self.get('{}/{}'.format(prefix, name), os.path.join(local_path, name))
+
+    def upload(self, local_path, prefix):
+        for name in os.listdir(local_path):
+            self.put(os.path.join(local_path, name), '{}/{}'.format(prefix, name))
+
+
+class S3ImageStore(ImageStore):
+    """
+    Stores images in S3 using the AWS CLI tools.
+    """
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get_url(self, key):
+        return "s3://{}/{}".format(self.bucket, key)
+
+    def aws(self, *args):
+        return subprocess.call(["aws", "s3"] + list(args), env=os.environ.copy())
+
+    def get(self, key, path):
+        assert not self.aws("cp", "--quiet", self.get_url(key), path), \
+            "Failed to download {}".format(self.get_url(key))
+
+    def put(self, path, key):
+        assert not self.aws("cp", "--quiet", path, self.get_url(key)), \
+            "Failed to upload {}".format(self.get_url(key))
+
+    def s3api(self, command, key, *args):
+        """
+        Run an ``aws s3api`` command against ``key``, returning its parsed
+        JSON output.
+        """
+        output = subprocess.check_output(
+            ["aws", "s3api", command, "--bucket", self.bucket, "--key", key,
+             "--output", "json"] + list(args),
+            env=os.environ.copy())
+        return json.loads(output.decode('utf-8')) if output.strip() else {}
+
+    def start_upload(self, key):
+        return self.s3api("create-multipart-upload", key)['UploadId']
+
+    def put_part(self, key, upload_id, number, data):
+        with tempfile.NamedTemporaryFile(prefix='changes-lxc-part-') as fp:
+            fp.write(data)
+            fp.flush()
+            result = self.s3api("upload-part", key, "--upload-id", upload_id,
+                                "--part-number", str(number), "--body", fp.name)
+        return {'PartNumber': number, 'ETag': result['ETag']}
+
+    def complete_upload(self, key, upload_id, parts):
+        self.s3api("complete-multipart-upload", key, "--upload-id", upload_id,
+                   "--multipart-upload", json.dumps({'Parts': parts}))
+
+    def abort_upload(self, key, upload_id):
+        self.s3api("abort-multipart-upload", key, "--upload-id", upload_id)
+
+    def exists(self, key):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(
+                ["aws", "s3", "ls", self.get_url(key)],
+                env=os.environ.copy(), stdout=devnull, stderr=devnull,
+            ) == 0
+
+    def open(self, key):
+        return ProcessReader(
+            ["aws", "s3", "cp", "--quiet", self.get_url(key), "-"])
+
+    def put_chunks(self, chunk_store, chunks):
+        # A single sync lists the remote chunks once rather than checking
+        # each one. Chunks are immutable, so anything already present
+        # (from any image) is skipped.
+        assert not self.aws("sync", "--size-only", "--exclude", "*.*",
+                            chunk_store.root, self.get_url(CHUNK_DIR)), \
+            "Failed to upload chunks"
+
+    def download(self, prefix, local_path):
+        assert not self.aws("sync", self.get_url(prefix), local_path), \
+            "Failed to download image {}".format(self.get_url(prefix))
+
+    def upload(self, local_path, prefix):
+        assert not self.aws("sync", local_path, self.get_url(prefix)), \
+            "Failed to upload image {}".format(self.get_url(prefix))
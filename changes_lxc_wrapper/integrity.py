@@ -0,0 +1,156 @@
+"""
+Integrity checking for snapshot images.
+
+Image manifests list the size and sha256 of every file in the image. Hashes
+are computed while data streams through us (when writing the archive, and
+when downloading), so verification costs no extra reads. The result of a
+verification is remembered per file by (size, mtime, inode), so a warm cache
+never re-hashes an unchanged multi-GB archive.
+"""
+import hashlib
+import json
+import lzma
+import os
+
+from uuid import uuid4
+
+BLOCK_SIZE = 1024 * 1024
+
+VERIFIED_FILE = '.verified'
+
+
+class IntegrityError(Exception):
+    pass
+
+
+def get_stat_key(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_hashed(src, dest, write=None):
+    """
+    Stream ``src`` (a file object) to ``dest`` atomically, returning the
+    size and sha256 of the data written. Each block is also passed to
+    ``write`` if given.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = '{}.{}'.format(dest, uuid4().hex)
+    try:
+        with open(tmp_path, 'wb') as out:
+            for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+                digest.update(block)
+                out.write(block)
+                if write is not None:
+                    write(block)
+                size += len(block)
+        os.rename(tmp_path, dest)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return size, digest.hexdigest()
+
+
+def copy_verified(src, dest, sha256, decompress=False):
+    """
+    Stream ``src`` to ``dest``, only moving it into place if its sha256
+    matches. With ``decompress`` the hash is of the xz-decoded content, as
+    used for chunk ids.
+    """
+    digest = hashlib.sha256()
+    decompressor = lzma.LZMADecompressor() if decompress else None
+    tmp_path = '{}.{}'.format(dest, uuid4().hex)
+    try:
+        with open(tmp_path, 'wb') as out:
+            for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+                out.write(block)
+                if decompressor:
+                    block = decompressor.decompress(block)
+                digest.update(block)
+        if digest.hexdigest() != sha256:
+            raise IntegrityError('Checksum mismatch for {}'.format(dest))
+        os.rename(tmp_path, dest)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def describe_file(path):
+    return {
+        'size': os.path.getsize(path),
+        'sha256': hash_file(path),
+    }
+
+
+class VerificationCache(object):
+    """
+    Remembers which files in an image directory have been verified, keyed
+    by their (size, mtime, inode) at the time.
+    """
+    def __init__(self, path):
+        self.path = os.path.join(path, VERIFIED_FILE)
+        try:
+            with open(self.path) as fp:
+                self.data = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            self.data = {}
+
+    def is_verified(self, path, name, sha256):
+        record = self.data.get(name)
+        if not record or record[3] != sha256:
+            return False
+        try:
+            return record[:3] == get_stat_key(path)
+        except FileNotFoundError:
+            return False
+
+    def record(self, path, name, sha256):
+        self.data[name] = get_stat_key(path) + [sha256]
+
+    def save(self):
+        tmp_path = '{}.{}'.format(self.path, uuid4().hex)
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.data, fp)
+        os.rename(tmp_path, self.path)
+
+
+def verify_image(path, manifest, rehash=True):
+    """
+    Check the files listed in an image manifest, returning the names of any
+    which are missing or corrupt.
+
+    Files whose size, mtime and inode match a previous successful check are
+    trusted. Otherwise they are re-hashed, or with ``rehash=False`` only
+    their size is checked.
+    """
+    cache = VerificationCache(path)
+    bad = []
+    changed = False
+    for name, expected in sorted(manifest.get('files', {}).items()):
+        file_path = os.path.join(path, name)
+        if not os.path.exists(file_path):
+            bad.append(name)
+        elif cache.is_verified(file_path, name, expected['sha256']):
+            continue
+        elif os.path.getsize(file_path) != expected['size']:
+            bad.append(name)
+        elif rehash:
+            if hash_file(file_path) == expected['sha256']:
+                cache.record(file_path, name, expected['sha256'])
+                changed = True
+            else:
+                bad.append(name)
+    if changed:
+        cache.save()
+    return bad
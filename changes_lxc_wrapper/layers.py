@@ -0,0 +1,215 @@
+"""
+Content-addressed storage for snapshot images.
+
+A snapshot's rootfs tarball is split into chunks at tar member boundaries,
+and each chunk is stored once under its sha256 as an independent xz stream.
+Because xz decoders accept concatenated streams, the original
+``rootfs.tar.xz`` can be reassembled by simply concatenating the chunk files
+listed in the snapshot's manifest, with no recompression.
+
+Cut points are chosen from member names rather than offsets so that adding,
+removing or changing a file only affects the chunks around it, and
+unchanged parts of the filesystem dedupe across snapshots.
+"""
+import hashlib
+import json
+import lzma
+import os
+import shutil
+import zlib
+
+from uuid import uuid4
+
+
+BLOCK_SIZE = 512
+
+MIN_CHUNK_SIZE = 1024 * 1024
+
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+# roughly one in BOUNDARY_MODULUS members starts a new chunk once the
+# current one is above MIN_CHUNK_SIZE
+BOUNDARY_MODULUS = 8
+
+# tar typeflags for headers which describe the member that follows them
+EXTENSION_TYPES = (b'L', b'K', b'x', b'g')
+
+CHUNK_DIR = 'chunks'
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def read_exact(fp, size):
+    result = bytearray()
+    while len(result) < size:
+        data = fp.read(size - len(result))
+        if not data:
+            break
+        result += data
+    return bytes(result)
+
+
+def parse_tar_size(field):
+    # GNU tar uses base-256 for very large sizes
+    if field[0] & 0x80:
+        return int.from_bytes(bytes([field[0] & 0x7f]) + field[1:], 'big')
+    field = field.split(b'\0', 1)[0].strip()
+    return int(field, 8) if field else 0
+
+
+def split_archive(fp):
+    """
+    Split an uncompressed tar stream into raw chunks. Concatenating the
+    chunks yields the original stream byte for byte.
+    """
+    current = bytearray()
+    in_extension = False
+    while True:
+        header = read_exact(fp, BLOCK_SIZE)
+        if not header:
+            break
+
+        if len(header) < BLOCK_SIZE or header == bytes(BLOCK_SIZE):
+            # end of archive marker (and record padding)
+            current += header
+            current += fp.read()
+            break
+
+        size = parse_tar_size(header[124:136])
+        padded_size = (size + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+        typeflag = header[156:157]
+
+        data = None
+        key = header[:100]
+        if typeflag in EXTENSION_TYPES:
+            # the real name lives in the extension payload
+            data = read_exact(fp, padded_size)
+            key = data
+
+        if not in_extension and current:
+            if padded_size + BLOCK_SIZE >= MAX_CHUNK_SIZE:
+                # start large files on a fresh chunk so their pieces line up
+                cut = True
+            elif len(current) + BLOCK_SIZE + len(data or b'') > MAX_CHUNK_SIZE:
+                cut = True
+            else:
+                cut = (len(current) >= MIN_CHUNK_SIZE and
+                       zlib.crc32(key) % BOUNDARY_MODULUS == 0)
+            if cut:
+                yield bytes(current)
+                current = bytearray()
+
+        current += header
+        if data is not None:
+            current += data
+        else:
+            remaining = padded_size
+            while remaining:
+                if len(current) >= MAX_CHUNK_SIZE:
+                    yield bytes(current)
+                    current = bytearray()
+                piece = fp.read(min(remaining, MAX_CHUNK_SIZE - len(current)))
+                assert piece, 'Unexpected end of tar stream'
+                current += piece
+                remaining -= len(piece)
+
+        in_extension = typeflag in EXTENSION_TYPES
+
+    if current:
+        yield bytes(current)
+
+
+def read_manifest(path):
+    """
+    Returns the manifest in the given image directory, or None.
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_FILE)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(path, manifest):
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    tmp_path = '{}.{}'.format(manifest_path, uuid4().hex)
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.rename(tmp_path, manifest_path)
+
+
+class ChunkStore(object):
+    """
+    A local directory of compressed chunks keyed by the sha256 of their
+    uncompressed content.
+    """
+    preset = 6
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def get_key(chunk_id):
+        return '{}/{}/{}'.format(CHUNK_DIR, chunk_id[:2], chunk_id)
+
+    def get_path(self, chunk_id):
+        return os.path.join(self.root, chunk_id[:2], chunk_id)
+
+    def has(self, chunk_id):
+        return os.path.exists(self.get_path(chunk_id))
+
+    def add(self, data):
+        """
+        Store a raw chunk, returning its manifest entry. Chunks which are
+        already present are not rewritten.
+        """
+        chunk_id = hashlib.sha256(data).hexdigest()
+        path = self.get_path(chunk_id)
+        created = not os.path.exists(path)
+        if created:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{}.{}'.format(path, uuid4().hex)
+            with open(tmp_path, 'wb') as fp:
+                fp.write(lzma.compress(data, preset=self.preset))
+            os.rename(tmp_path, path)
+        return {
+            'id': chunk_id,
+            'size': len(data),
+            'compressed_size': os.path.getsize(path),
+            'created': created,
+        }
+
+    def missing(self, chunks):
+        return [c for c in chunks if not self.has(c['id'])]
+
+    def assemble(self, chunks, dest):
+        """
+        Write the chunks, in order, as a single multi-stream xz file.
+        """
+        tmp_path = '{}.{}'.format(dest, uuid4().hex)
+        with open(tmp_path, 'wb') as out:
+            for chunk in chunks:
+                with open(self.get_path(chunk['id']), 'rb') as fp:
+                    shutil.copyfileobj(fp, out, 1024 * 1024)
+        os.rename(tmp_path, dest)
+
+    def remove(self, chunk_id):
+        try:
+            os.unlink(self.get_path(chunk_id))
+        except FileNotFoundError:
+            pass
+
+    def get_sizes(self):
+        """
+        Returns a dict of chunk id to on-disk size for every stored chunk.
+        """
+        sizes = {}
+        if not os.path.exists(self.root):
+            return sizes
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if '.' in name:
+                    # partially written chunk
+                    continue
+                sizes[name] = os.path.getsize(os.path.join(dirpath, name))
+        return sizes
@@ -1,6 +1,13 @@
+import codecs
+import os
+import re
+
 from collections import deque
 from functools import wraps
 from threading import Condition, Event, Lock
+from time import time
+
+LINE_CONTROL_RE = re.compile(r'(\r|\n)')
 
 
 def chunked(buffer, chunk_size=4096):
@@ -49,34 +56,228 @@ class ThreadSafeDeque(deque):
     rotate = _locked(deque.rotate)
 
 
+class LineCollapser(object):
+    """
+    Streaming filter reducing terminal output to what it leaves on screen.
+
+    A carriage return moves back to the start of the line, so progress bars
+    (i.e. from pip, wget or apt) which redraw a line hundreds of times are
+    kept as the line's current state. A line left unfinished for ``window``
+    seconds is passed on: if it has only grown (i.e. test runner dots) just
+    the new text is sent, otherwise the line as it stands followed by a
+    carriage return, so whatever replaces it still overwrites it downstream.
+    At most ``max_line`` characters of a line are held.
+
+    Consecutive identical lines past ``repeat_limit`` are counted instead,
+    and summarized once a different line arrives (or after ``window``).
+    """
+    repeat_limit = 3
+
+    max_line = 65536
+
+    def __init__(self, window=5, repeat_limit=None):
+        self.window = window
+        if repeat_limit is not None:
+            self.repeat_limit = repeat_limit
+
+        # the part of the current line not yet sent, which starts at
+        # ``column`` downstream
+        self.line = ''
+        self.cursor = 0
+        self.column = 0
+        # whether the line was only written to at its end since last sent
+        self.appending = True
+        # when the line was first written to since it was last sent
+        self.pending_since = None
+        # whether some of the line was already sent
+        self.shipped = False
+
+        self.last_line = None
+        self.repeats = 0
+        self.suppressed = 0
+        self.suppressed_since = None
+
+    def feed(self, text, now=None):
+        """
+        Returns the output which is ready to be passed on.
+        """
+        result = []
+        for part in LINE_CONTROL_RE.split(text):
+            if part == '\n':
+                self.end_line(result, now)
+            elif part == '\r':
+                if self.column:
+                    # the start of the line was sent as it grew, so it can
+                    # only be overwritten downstream
+                    result.append(self.line + '\r')
+                    self.line = ''
+                    self.column = 0
+                    self.pending_since = None
+                self.cursor = 0
+                self.appending = False
+            elif part:
+                if self.pending_since is None:
+                    self.pending_since = now or time()
+                end = self.cursor + len(part)
+                self.line = self.line[:self.cursor] + part + self.line[end:]
+                self.cursor = end
+                if len(self.line) > self.max_line:
+                    if self.appending:
+                        self.send_tail(result)
+                    else:
+                        self.line = self.line[:self.max_line]
+                        self.cursor = min(self.cursor, self.max_line)
+        return ''.join(result)
+
+    def send_tail(self, result):
+        result.append(self.line)
+        self.column += len(self.line)
+        self.line = ''
+        self.cursor = 0
+        self.pending_since = None
+        self.shipped = True
+
+    def reset_line(self):
+        self.line = ''
+        self.cursor = 0
+        self.column = 0
+        self.appending = True
+        self.pending_since = None
+        self.shipped = False
+
+    def end_line(self, result, now=None):
+        line, shipped = self.line, self.shipped
+        self.reset_line()
+
+        if line == self.last_line and not shipped:
+            self.repeats += 1
+            if self.repeats > self.repeat_limit:
+                self.suppressed += 1
+                if self.suppressed_since is None:
+                    self.suppressed_since = now or time()
+                return
+        else:
+            self.flush_suppressed(result)
+            self.last_line = None if shipped else line
+            self.repeats = 0
+        result.append(line + '\n')
+
+    def flush_suppressed(self, result):
+        if self.suppressed:
+            result.append('==> Previous line repeated {} more times\n'.format(self.suppressed))
+            self.suppressed = 0
+            self.suppressed_since = None
+
+    def flush(self, now=None, final=False):
+        """
+        Returns output held back for longer than the window, or everything
+        held if this is the ``final`` flush.
+        """
+        now = now or time()
+        result = []
+        if final or (self.suppressed and now - self.suppressed_since >= self.window):
+            self.flush_suppressed(result)
+
+        if final:
+            if self.line:
+                result.append(self.line)
+            self.reset_line()
+        elif self.pending_since is not None and now - self.pending_since >= self.window:
+            # the summary must come before the line it would overwrite
+            self.flush_suppressed(result)
+            if self.appending:
+                self.send_tail(result)
+            else:
+                result.append(self.line + '\r')
+                self.shipped = True
+                self.pending_since = None
+        return ''.join(result)
+
+
 class LogReporter(object):
     source = 'console'
 
-    def __init__(self, api, jobstep_id, source=None):
+    streams = ('stdout', 'stderr')
+
+    # seconds unfinished lines and repeats are held back before uploading
+    flush_window = 5
+
+    def __init__(self, api, jobstep_id, source=None, raw_dir=None, flush_window=None):
         self.api = api
         self.jobstep_id = jobstep_id
         if source is not None:
             self.source = source
+        if flush_window is not None:
+            self.flush_window = flush_window
+
+        self.buffers = dict((s, ThreadSafeDeque()) for s in self.streams)
+        self.decoders = dict(
+            (s, codecs.getincrementaldecoder('utf-8')(errors='replace'))
+            for s in self.streams
+        )
+        self.collapsers = dict(
+            (s, LineCollapser(self.flush_window)) for s in self.streams
+        )
+
+        # everything written, as it was written, before any collapsing
+        self.raw_files = {}
+        if raw_dir:
+            os.makedirs(raw_dir, exist_ok=True)
+            for stream in self.streams:
+                self.raw_files[stream] = open(os.path.join(
+                    raw_dir, '{}.{}.log'.format(jobstep_id, stream)), 'ab')
 
-        self.buffer = ThreadSafeDeque()
         self.done = Event()
         self.cv = Condition()
 
+    def get_source(self, stream):
+        if stream == 'stdout':
+            return self.source
+        return '{}.{}'.format(self.source, stream)
+
+    def has_pending(self):
+        return any(self.buffers.values())
+
     def process(self):
         with self.cv:
             self.done.clear()
-            while not self.done.is_set() or self.buffer:
-                for chunk in chunked(self.buffer):
-                    self.api.append_log(self.jobstep_id, {
-                        'text': chunk,
-                        'source': self.source,
-                    })
-                if not self.done.is_set():
-                    self.cv.wait(5)
-
-    def write(self, chunk):
+            while True:
+                done = self.done.is_set()
+                for stream in self.streams:
+                    held = self.collapsers[stream].flush(final=done)
+                    if held:
+                        self.buffers[stream].append(held)
+                    for chunk in chunked(self.buffers[stream]):
+                        self.api.append_log(self.jobstep_id, {
+                            'text': chunk,
+                            'source': self.get_source(stream),
+                        })
+                if done:
+                    break
+                self.cv.wait(self.flush_window)
+
+            for fp in self.raw_files.values():
+                fp.close()
+            self.raw_files = {}
+
+    def write(self, chunk, stream='stdout'):
+        """
+        Queue output for upload. ``chunk`` may be text or raw bytes read
+        straight from a child process; bytes are decoded incrementally per
+        stream so multi-byte sequences split across reads survive. Output is
+        collapsed (see ``LineCollapser``) before it is queued, after being
+        copied as is to the raw log, if any.
+        """
         with self.cv:
-            self.buffer.append(chunk)
+            raw = self.raw_files.get(stream)
+            if raw is not None:
+                raw.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+            if isinstance(chunk, bytes):
+                chunk = self.decoders[stream].decode(chunk)
+            chunk = self.collapsers[stream].feed(chunk)
+            if not chunk:
+                return
+            self.buffers[stream].append(chunk)
             self.cv.notifyAll()
 
     def close(self):
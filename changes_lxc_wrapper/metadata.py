@@ -0,0 +1,202 @@
+"""
+Persistent metadata about the images in a snapshot cache.
+
+An SQLite database under the cache root records what is known about each
+image (sizes, upstream state, access history), so the manager doesn't have
+to walk the whole cache and query Changes on every run. The database is
+advisory: the manager periodically reconciles it against the disk and
+upstream, and anything writing to it during a build must not fail the build
+if it can't.
+"""
+import json
+import os
+import sqlite3
+
+from contextlib import contextmanager
+from time import time
+
+METADATA_FILE = 'metadata.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    project TEXT,
+    date_created TEXT,
+    is_active INTEGER NOT NULL DEFAULT 0,
+    is_known INTEGER NOT NULL DEFAULT 0,
+    is_intact INTEGER NOT NULL DEFAULT 1,
+    dir_size INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    shared_size INTEGER NOT NULL DEFAULT 0,
+    chunks TEXT NOT NULL DEFAULT '[]',
+    hits INTEGER NOT NULL DEFAULT 0,
+    last_access REAL,
+    download_time REAL,
+    date_added REAL
+);
+CREATE INDEX IF NOT EXISTS images_project ON images (project);
+CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access);
+CREATE INDEX IF NOT EXISTS images_size ON images (size);
+CREATE INDEX IF NOT EXISTS images_date_created ON images (date_created);
+CREATE TABLE IF NOT EXISTS chunks (
+    id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value REAL
+);
+"""
+
+IMAGE_FIELDS = (
+    'path', 'project', 'date_created', 'is_active', 'is_known', 'is_intact',
+    'dir_size', 'size', 'shared_size', 'chunks', 'hits', 'last_access',
+    'download_time', 'date_added',
+)
+
+# The order cleanup evicts images by (anything invalid, then largest
+# first), with active images, which are never evicted, last
+EVICTION_ORDER = 'is_active, is_known AND is_intact, size DESC'
+
+
+class MetadataStore(object):
+    # seconds to wait on another process holding the write lock
+    timeout = 30
+
+    def __init__(self, path):
+        self.path = path
+        self.initialized = False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Yields a connection, committing on success and rolling back on
+        error. Connections are never shared between threads.
+        """
+        if not self.initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        try:
+            if not self.initialized:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(SCHEMA)
+                self.initialized = True
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record_image(self, image_id, path, conn=None, **fields):
+        """
+        Insert or update an image. Fields which aren't given keep their
+        current (or default) values.
+        """
+        assert set(fields) <= set(IMAGE_FIELDS), \
+            "Unknown image fields: {}".format(set(fields) - set(IMAGE_FIELDS))
+        if 'chunks' in fields:
+            fields['chunks'] = json.dumps(sorted(fields['chunks']))
+        fields['path'] = path
+
+        def write(conn):
+            conn.execute(
+                'INSERT OR IGNORE INTO images (id, path, date_added) VALUES (?, ?, ?)',
+                (str(image_id), path, time()))
+            conn.execute('UPDATE images SET {} WHERE id = ?'.format(
+                ', '.join('{} = ?'.format(k) for k in sorted(fields))),
+                [fields[k] for k in sorted(fields)] + [str(image_id)])
+
+        if conn is not None:
+            write(conn)
+        else:
+            with self.transaction() as conn:
+                write(conn)
+
+    def record_access(self, image_id):
+        with self.transaction() as conn:
+            conn.execute(
+                'UPDATE images SET hits = hits + 1, last_access = ? WHERE id = ?',
+                (time(), str(image_id)))
+
+    def query(self, where=None, params=(), order_by=None, limit=None,
+              with_priority=False):
+        """
+        Iterate over image rows. ``where`` and ``order_by`` are SQL fragments
+        and must never come from user input; values go in ``params``.
+
+        With ``with_priority`` rows also carry their ``eviction_priority``,
+        which is ranked across all images regardless of ``where``, and may
+        be ordered by (i.e. ``eviction_priority DESC``).
+        """
+        # ranked here rather than with a window function, which SQLite
+        # only has from 3.25
+        by_priority = bool(with_priority and order_by and
+                           order_by.split()[0] == 'eviction_priority')
+        sql = 'SELECT * FROM images'
+        if where:
+            sql += ' WHERE {}'.format(where)
+        if order_by and not by_priority:
+            sql += ' ORDER BY {}'.format(order_by)
+        if limit and not by_priority:
+            sql += ' LIMIT {:d}'.format(limit)
+        with self.transaction() as conn:
+            priorities = self.get_eviction_priorities(conn) if with_priority else {}
+            rows = []
+            for row in conn.execute(sql, params):
+                row = dict(row)
+                row['chunks'] = json.loads(row['chunks'])
+                if with_priority:
+                    row['eviction_priority'] = priorities[row['id']]
+                if by_priority:
+                    rows.append(row)
+                else:
+                    yield row
+
+        if by_priority:
+            # as SQLite orders NULLs: first ascending, last descending
+            desc = order_by.split()[-1].upper() == 'DESC'
+            rows.sort(key=lambda r: (r['eviction_priority'] is not None,
+                                     r['eviction_priority'] or 0), reverse=desc)
+            for row in rows[:limit or None]:
+                yield row
+
+    def get_eviction_priorities(self, conn):
+        """
+        Returns each image's position in the order cleanup evicts by, or
+        None for active images.
+        """
+        priorities = {}
+        rank = 0
+        for image_id, is_active in conn.execute(
+                'SELECT id, is_active FROM images ORDER BY {}'.format(EVICTION_ORDER)):
+            if is_active:
+                priorities[image_id] = None
+            else:
+                rank += 1
+                priorities[image_id] = rank
+        return priorities
+
+    def add_chunks(self, chunks):
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO chunks (id, size) VALUES (?, ?)',
+                [(c['id'], c['compressed_size']) for c in chunks])
+
+    def get_chunk_sizes(self):
+        with self.transaction() as conn:
+            return dict(conn.execute('SELECT id, size FROM chunks'))
+
+    def get_state(self, key):
+        with self.transaction() as conn:
+            row = conn.execute(
+                'SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value, conn=None):
+        sql = 'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)'
+        if conn is not None:
+            conn.execute(sql, (key, value))
+        else:
+            with self.transaction() as conn:
+                conn.execute(sql, (key, value))
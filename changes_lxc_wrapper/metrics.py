@@ -0,0 +1,88 @@
+import json
+import resource
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+from time import time
+
+from .cgroup import read_cgroup_stats
+
+
+def get_cpu_time():
+    """
+    CPU time (user + system) consumed by this process and any children we
+    have waited on, which covers subprocess.call and attach_wait.
+    """
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+class PhaseRecorder(object):
+    """
+    Records wall time, CPU time and (optionally) cgroup counters for named
+    phases of a job. Each finished phase is kept in memory and, if a path is
+    given, appended to it as a JSON line.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.phases = []
+        self.lock = Lock()
+        # phases nest (launch runs commands), track depth per thread
+        self.local = local()
+
+    @contextmanager
+    def phase(self, name, container=None, **tags):
+        depth = getattr(self.local, 'depth', 0)
+        record = dict(tags, phase=name, depth=depth)
+
+        cgroup_before = read_cgroup_stats(container) if container is not None else {}
+        cpu_start = get_cpu_time()
+        start = time()
+        self.local.depth = depth + 1
+        try:
+            yield record
+        except Exception:
+            record['failed'] = True
+            raise
+        finally:
+            self.local.depth = depth
+            record['start'] = start
+            record['wall_time'] = time() - start
+            record['cpu_time'] = get_cpu_time() - cpu_start
+            if container is not None:
+                cgroup_after = read_cgroup_stats(container)
+                for key, value in cgroup_after.items():
+                    if key in ('memory_bytes', 'memory_peak_bytes'):
+                        record['cgroup_' + key] = value
+                    elif key in cgroup_before:
+                        record['cgroup_' + key] = value - cgroup_before[key]
+            self.record(record)
+
+    def record(self, record):
+        with self.lock:
+            self.phases.append(record)
+            if self.path:
+                with open(self.path, 'a') as fp:
+                    fp.write(json.dumps(record, default=str) + '\n')
+
+    def dumps(self):
+        with self.lock:
+            return json.dumps(self.phases, default=str)
+
+
+def instrumented(name):
+    """
+    Decorator for Container methods which records the call as a phase on
+    ``self.metrics``.
+    """
+    def wrapper(func):
+        @wraps(func)
+        def wrapped(self, *args, **kwargs):
+            with self.metrics.phase(name, container=self):
+                return func(self, *args, **kwargs)
+        return wrapped
+    return wrapper
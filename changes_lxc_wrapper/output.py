@@ -0,0 +1,61 @@
+import logging
+import os
+
+from threading import Thread
+
+
+READ_SIZE = 65536
+
+
+def write_fd(fd, data):
+    """
+    Write all of ``data`` to a raw file descriptor, handling partial writes.
+    """
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+class OutputPipe(object):
+    """
+    Captures a stream from a child process through an OS pipe.
+
+    The read end is drained in large blocks on a background thread and every
+    block is handed to each sink as raw bytes, so no work is done per line.
+    """
+    def __init__(self, *sinks):
+        self.sinks = sinks
+        self.read_fd, self.write_fd = os.pipe()
+        self.thread = Thread(target=self.pump)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def pump(self):
+        try:
+            while True:
+                chunk = os.read(self.read_fd, READ_SIZE)
+                if not chunk:
+                    break
+                for sink in self.sinks:
+                    # keep draining the fd so the writer never blocks
+                    try:
+                        sink(chunk)
+                    except Exception:
+                        logging.exception('Output sink %r failed', sink)
+        finally:
+            os.close(self.read_fd)
+
+    def close(self, timeout=None):
+        """
+        Close our copy of the write end and wait for the reader to drain.
+
+        Processes which outlive the command (i.e. daemons started by a build)
+        may hold the pipe open, so the wait is bounded by ``timeout``.
+        """
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+            self.write_fd = None
+        self.thread.join(timeout)
@@ -0,0 +1,110 @@
+"""
+Helpers for archiving and re-applying the upper (delta) directory of an
+overlayfs container.
+
+Both the kernel overlay driver (whiteouts are 0:0 character devices) and
+the older Ubuntu overlayfs driver (whiteouts are symlinks to
+``(overlay-whiteout)``) are understood. Opaque directories are marked with
+the ``trusted.overlay.opaque`` xattr in both.
+"""
+import os
+import shutil
+import stat
+import subprocess
+
+OVERLAYFS_WHITEOUT_TARGET = '(overlay-whiteout)'
+
+OPAQUE_XATTR = 'trusted.overlay.opaque'
+
+
+def is_whiteout(path, st):
+    if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+        return True
+    if stat.S_ISLNK(st.st_mode):
+        return os.readlink(path) == OVERLAYFS_WHITEOUT_TARGET
+    return False
+
+
+def is_opaque(path):
+    try:
+        return os.getxattr(path, OPAQUE_XATTR, follow_symlinks=False) == b'y'
+    except OSError:
+        return False
+
+
+def scan_delta(base, delta):
+    """
+    Walk an overlay upper directory, returning a tuple of:
+
+    - whiteouts: paths which must be removed from the lower layer, which
+      includes lower directories replaced by a non-directory
+    - opaque: directories whose lower contents must be cleared
+    - markers: whiteout entries in the upper directory itself, which must not
+      be archived
+
+    All paths are relative to the root of the filesystem.
+    """
+    whiteouts, opaque, markers = [], [], []
+    for dirpath, dirnames, filenames in os.walk(delta):
+        rel_dir = os.path.relpath(dirpath, delta)
+        if rel_dir != '.' and is_opaque(dirpath):
+            opaque.append(rel_dir)
+
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            path = os.path.join(dirpath, name)
+            rel_path = os.path.normpath(os.path.join(rel_dir, name))
+            st = os.lstat(path)
+            if is_whiteout(path, st):
+                whiteouts.append(rel_path)
+                markers.append(rel_path)
+                continue
+
+            lower = os.path.join(base, rel_path)
+            if os.path.isdir(lower) and not os.path.islink(lower):
+                whiteouts.append(rel_path)
+
+    return sorted(whiteouts), sorted(opaque), sorted(markers)
+
+
+def get_exclude_args(markers):
+    """
+    Returns tar arguments which exclude the given paths (relative to the
+    archive root) from the archive.
+    """
+    args = []
+    for path in markers:
+        args.extend(['--exclude', './{}'.format(path)])
+    if args:
+        args = ['--anchored', '--no-wildcards'] + args
+    return args
+
+
+def resolve(rootfs, rel_path):
+    path = os.path.normpath(os.path.join(rootfs, rel_path))
+    assert path.startswith(rootfs.rstrip('/') + '/'), \
+        "Refusing to modify path outside of rootfs: {}".format(rel_path)
+    return path
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def apply_delta(rootfs, archive_path, manifest):
+    """
+    Apply a delta image (its archive and manifest) on top of a rootfs.
+    """
+    for rel_path in manifest.get('opaque', ()):
+        path = resolve(rootfs, rel_path)
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                remove_path(os.path.join(path, name))
+
+    for rel_path in manifest.get('whiteouts', ()):
+        remove_path(resolve(rootfs, rel_path))
+
+    subprocess.check_call(["tar", "--numeric-owner", "-xpJf", archive_path,
+                           "-C", rootfs])
@@ -0,0 +1,333 @@
+"""
+Package and dependency caches kept on the host and mounted into containers.
+
+Every job otherwise downloads the same apt archives, wheels, npm tarballs
+and Maven artifacts into a container which is thrown away. Each cache is
+an entry under ``<cache>/packages/<release>/<scope>/<kind>``, where the
+scope is the project for language caches and shared by every project for
+apt (whose archives only depend on the release).
+
+Tools which write their caches atomically (pip, npm) get the entry
+bind-mounted read-write. The others (apt locks its archive directory,
+Maven updates files in place) get an overlay with the entry as its lower
+layer and a private upper directory, so concurrent jobs never write to
+the same files. New files in the upper directory are moved into the entry
+when the container is destroyed, and never replace ones already there.
+
+An entry's lock file is held while it is attached or evicted, and any
+container whose config references an entry is using it, so eviction never
+removes a cache from under a job. The lock file's mtime records last use.
+"""
+import fcntl
+import os
+import shutil
+import stat
+
+from fnmatch import fnmatch
+from uuid import uuid4
+
+from .rootfs_cache import LXC_PATH, get_tree_size
+
+PACKAGE_DIR = 'packages'
+
+# upper and work directories of overlaid caches, per container
+WORK_DIR = '.work'
+
+SHARED_SCOPE = '_shared'
+
+OVERLAY_FSTYPES = ('overlay', 'overlayfs')
+
+
+class PackageCacheKind(object):
+    def __init__(self, name, target, shared=False, overlay=False, exclude=()):
+        self.name = name
+        # path inside the rootfs, formatted with the home directory
+        self.target = target
+        # one entry for every project on the release
+        self.shared = shared
+        # mounted as an overlay rather than bound read-write
+        self.overlay = overlay
+        # patterns of names in the upper directory which are never harvested
+        self.exclude = exclude
+
+    def get_target(self, home_dir):
+        return self.target.format(home=home_dir.lstrip('/'))
+
+
+PACKAGE_CACHES = dict((kind.name, kind) for kind in (
+    PackageCacheKind('apt', 'var/cache/apt/archives', shared=True, overlay=True,
+                     exclude=('lock', 'partial')),
+    PackageCacheKind('pip', '{home}/.cache/pip'),
+    PackageCacheKind('npm', '{home}/.npm'),
+    PackageCacheKind('maven', '{home}/.m2/repository', overlay=True,
+                     exclude=('*.lastUpdated', '*.part', '*.tmp')),
+))
+
+
+def parse_package_caches(value):
+    """
+    Parses a comma separated list of cache kinds (i.e. apt,pip).
+    """
+    kinds = [k.strip() for k in value.split(',') if k.strip()]
+    for kind in kinds:
+        if kind not in PACKAGE_CACHES:
+            raise ValueError('Unknown package cache: {} (expected one of {})'.format(
+                kind, ', '.join(sorted(PACKAGE_CACHES))))
+    return kinds
+
+
+def get_overlay_fstype():
+    """
+    Returns the name of the overlay filesystem supported by the kernel,
+    preferring the upstream driver.
+    """
+    try:
+        with open('/proc/filesystems') as fp:
+            supported = set(line.split()[-1] for line in fp if line.strip())
+    except (IOError, OSError):
+        supported = set()
+    for fstype in OVERLAY_FSTYPES:
+        if fstype in supported:
+            return fstype
+    return OVERLAY_FSTYPES[0]
+
+
+def parse_mount_entry(value):
+    """
+    Returns (source, target, fstype, options) of an ``lxc.mount.entry``.
+    """
+    parts = value.split()
+    options = {}
+    for option in parts[3].split(','):
+        key, _, option_value = option.partition('=')
+        options[key] = option_value
+    return parts[0], parts[1], parts[2], options
+
+
+def get_mount_users(lxc_path, path):
+    """
+    Returns the names of containers whose config mounts ``path``, whether
+    bound or as the lower layer of an overlay.
+    """
+    users = []
+    if not os.path.isdir(lxc_path):
+        return users
+    reference = '{} '.format(path)
+    lower = 'lowerdir={},'.format(path)
+    for name in os.listdir(lxc_path):
+        try:
+            with open(os.path.join(lxc_path, name, 'config')) as fp:
+                config = fp.read()
+        except (IOError, OSError):
+            continue
+        if reference in config or lower in config:
+            users.append(name)
+    return users
+
+
+class PackageCacheEntry(object):
+    def __init__(self, release, scope, kind, path, size, last_used):
+        self.release = release
+        self.scope = scope
+        self.kind = kind
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+
+    @property
+    def id(self):
+        return '/'.join((self.release, self.scope, self.kind))
+
+
+class PackageCache(object):
+    def __init__(self, root, lxc_path=LXC_PATH):
+        self.root = os.path.join(root, PACKAGE_DIR)
+        self.lxc_path = lxc_path
+        self.overlay_fstype = None
+
+    def get_path(self, kind, release, project=None):
+        scope = SHARED_SCOPE if PACKAGE_CACHES[kind].shared else str(project)
+        return os.path.join(self.root, release, scope, kind)
+
+    def get_lock_path(self, path):
+        return '{}.lock'.format(path)
+
+    def get_work_path(self, container_name, kind):
+        return os.path.join(self.root, WORK_DIR, container_name, kind)
+
+    def get_mount_entries(self, container_name, kinds, release, project=None,
+                          home_dir='/home/ubuntu'):
+        """
+        Creates (or reuses) the entries for the given kinds, returning the
+        ``lxc.mount.entry`` values which attach them to the container.
+
+        Kinds kept per project are skipped without a project. The entries'
+        locks are held until the caller's config is saved, so must be
+        released with ``release_locks``.
+        """
+        mounts, locks = [], []
+        try:
+            for name in kinds:
+                kind = PACKAGE_CACHES[name]
+                if not kind.shared and not project:
+                    print("==> No project given, not attaching {} cache".format(name))
+                    continue
+
+                path = self.get_path(name, release, project)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                lock = open(self.get_lock_path(path), 'a')
+                locks.append(lock)
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                os.utime(lock.name)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                    # builds run as an unprivileged user inside the container
+                    os.chmod(path, 0o777)
+
+                target = kind.get_target(home_dir)
+                if kind.overlay:
+                    mounts.append(self.get_overlay_entry(path, target, container_name, name))
+                else:
+                    mounts.append('{} {} none bind,create=dir 0 0'.format(path, target))
+                print("==> Attaching {} cache: {}".format(name, path))
+        except Exception:
+            self.release_locks(locks)
+            raise
+        return mounts, locks
+
+    def get_overlay_entry(self, path, target, container_name, kind):
+        work_path = self.get_work_path(container_name, kind)
+        upper = os.path.join(work_path, 'upper')
+        work = os.path.join(work_path, 'work')
+        for dir_path in (upper, work):
+            os.makedirs(dir_path, exist_ok=True)
+        os.chmod(upper, 0o777)
+
+        if self.overlay_fstype is None:
+            self.overlay_fstype = get_overlay_fstype()
+        options = 'lowerdir={},upperdir={}'.format(path, upper)
+        if self.overlay_fstype == 'overlay':
+            options += ',workdir={}'.format(work)
+        return '{fstype} {target} {fstype} {options},create=dir 0 0'.format(
+            fstype=self.overlay_fstype, target=target, options=options)
+
+    def release_locks(self, locks):
+        for lock in locks:
+            lock.close()
+
+    def harvest(self, mount_entries, container_name):
+        """
+        Moves files new to a container's overlaid caches into their entries,
+        then removes its upper directories. The container must be stopped.
+        """
+        for value in mount_entries:
+            _, _, fstype, options = parse_mount_entry(value)
+            if fstype not in OVERLAY_FSTYPES:
+                continue
+            path = options.get('lowerdir', '')
+            if os.path.dirname(os.path.dirname(os.path.dirname(path))) != self.root:
+                continue
+            kind = PACKAGE_CACHES.get(os.path.basename(path))
+            if kind is None:
+                continue
+
+            with open(self.get_lock_path(path), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                if os.path.isdir(path):
+                    count = self.harvest_files(options['upperdir'], path, kind.exclude)
+                    if count:
+                        print("==> Saved {} new files to {} cache".format(count, kind.name))
+                os.utime(lock.name)
+
+        shutil.rmtree(os.path.join(self.root, WORK_DIR, container_name),
+                      ignore_errors=True)
+
+    def harvest_files(self, upper, path, exclude=()):
+        """
+        Moves regular files from ``upper`` into ``path``, skipping whiteouts,
+        links, excluded names and any file already present.
+        """
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(upper):
+            dirnames[:] = [d for d in dirnames
+                           if not any(fnmatch(d, p) for p in exclude)]
+            rel_dir = os.path.relpath(dirpath, upper)
+            for name in filenames:
+                if any(fnmatch(name, p) for p in exclude):
+                    continue
+                src = os.path.join(dirpath, name)
+                if not stat.S_ISREG(os.lstat(src).st_mode):
+                    continue
+                dest = os.path.normpath(os.path.join(path, rel_dir, name))
+                if os.path.lexists(dest):
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                # the work directory lives next to the entries, so this
+                # is a rename rather than a copy
+                os.rename(src, dest)
+                count += 1
+        return count
+
+    def list(self):
+        entries = []
+        if not os.path.exists(self.root):
+            return entries
+        for release in sorted(os.listdir(self.root)):
+            release_path = os.path.join(self.root, release)
+            if release.startswith('.') or not os.path.isdir(release_path):
+                continue
+            for scope in sorted(os.listdir(release_path)):
+                scope_path = os.path.join(release_path, scope)
+                if not os.path.isdir(scope_path):
+                    continue
+                for kind in sorted(os.listdir(scope_path)):
+                    path = os.path.join(scope_path, kind)
+                    if kind not in PACKAGE_CACHES or not os.path.isdir(path):
+                        continue
+                    lock_path = self.get_lock_path(path)
+                    entries.append(PackageCacheEntry(
+                        release=release,
+                        scope=scope,
+                        kind=kind,
+                        path=path,
+                        size=get_tree_size(path),
+                        last_used=os.path.getmtime(
+                            lock_path if os.path.exists(lock_path) else path),
+                    ))
+        return entries
+
+    def get_users(self, entry):
+        """
+        Returns the names of containers whose config mounts the entry.
+        """
+        return get_mount_users(self.lxc_path, entry.path)
+
+    def remove(self, entry):
+        """
+        Removes the entry unless a container is using it. Returns whether
+        it was removed.
+        """
+        with open(self.get_lock_path(entry.path), 'a') as lock:
+            # waits for launches attaching the entry to save their config
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.get_users(entry):
+                return False
+            tmp_path = '{}.{}'.format(entry.path, uuid4().hex)
+            os.rename(entry.path, tmp_path)
+        shutil.rmtree(tmp_path)
+        return True
+
+    def remove_stale_work(self):
+        """
+        Removes the upper directories of containers which no longer exist,
+        returning their names.
+        """
+        work_root = os.path.join(self.root, WORK_DIR)
+        if not os.path.isdir(work_root):
+            return []
+        stale = []
+        for name in os.listdir(work_root):
+            if not os.path.exists(os.path.join(self.lxc_path, name)):
+                shutil.rmtree(os.path.join(work_root, name), ignore_errors=True)
+                stale.append(name)
+        return stale
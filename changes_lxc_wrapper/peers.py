@@ -0,0 +1,229 @@
+"""
+Sharing snapshot images between build hosts.
+
+Every host can serve its snapshot cache read-only over HTTP. The cache
+layout matches the image store's keys (``<dist>/<release>/<arch>/<snapshot>/
+<file>`` and ``chunks/ab/<chunk id>``), so a peer is simply another store
+we can read from. Peers are only trusted for content we can check against a
+hash from the image manifest; manifests and legacy images still come from
+the object store when one is configured.
+"""
+import logging
+import os
+import random
+import re
+import shutil
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import BoundedSemaphore
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+from .image_store import ImageStore
+from .integrity import IntegrityError, copy_verified
+from .layers import CHUNK_DIR, MANIFEST_FILE
+from .rootfs_cache import ROOTFS_DIR
+
+DEFAULT_PORT = 8411
+
+# files in the middle of being written are renamed into place once complete
+TMP_FILE_RE = re.compile(r'\.[0-9a-f]{32}$')
+
+
+def load_peers(peers=(), peers_file=None):
+    """
+    Combine peers given explicitly with those listed (one URL per line) in
+    ``peers_file``, which a discovery agent may keep up to date.
+    """
+    result = list(peers or ())
+    if peers_file:
+        try:
+            with open(peers_file) as fp:
+                for line in fp:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        result.append(line)
+        except FileNotFoundError:
+            pass
+    return [p.rstrip('/') for i, p in enumerate(result) if p not in result[:i]]
+
+
+class PeerImageStore(ImageStore):
+    """
+    Reads hash-verified content from peers (in random order, to spread the
+    load) before falling back to ``store``. Everything else goes to
+    ``store``, or to the peers when there is no store.
+    """
+    def __init__(self, peers, store=None, timeout=10):
+        self.peers = list(peers)
+        self.store = store
+        self.timeout = timeout
+        self.peer_hits = 0
+        self.peer_misses = 0
+
+    def set_rate_limiter(self, limiter):
+        super().set_rate_limiter(limiter)
+        if self.store:
+            self.store.set_rate_limiter(limiter)
+
+    def get_peer_url(self, peer, key):
+        return '{}/{}'.format(peer, key)
+
+    def get_peers(self):
+        peers = list(self.peers)
+        random.shuffle(peers)
+        return peers
+
+    def open_peer(self, peer, key, method='GET'):
+        return urlopen(Request(self.get_peer_url(peer, key), method=method),
+                       timeout=self.timeout)
+
+    def get(self, key, path):
+        if self.store:
+            return self.store.get(key, path)
+        with open(path, 'wb') as out:
+            fp = self.open(key)
+            try:
+                shutil.copyfileobj(fp, out, 1024 * 1024)
+            finally:
+                fp.close()
+
+    def put(self, path, key):
+        assert self.store, 'Missing S3 bucket configuration'
+        self.store.put(path, key)
+
+    def exists(self, key):
+        if self.store:
+            return self.store.exists(key)
+        for peer in self.get_peers():
+            try:
+                self.open_peer(peer, key, method='HEAD').close()
+                return True
+            except (URLError, OSError):
+                continue
+        return False
+
+    def open(self, key):
+        if self.store:
+            return self.store.open(key)
+        for peer in self.get_peers():
+            try:
+                return self.open_peer(peer, key)
+            except (URLError, OSError):
+                continue
+        raise IOError('No peer has {}'.format(key))
+
+    def get_verified(self, key, path, sha256, decompress=False):
+        for peer in self.get_peers():
+            try:
+                fp = self.open_peer(peer, key)
+                try:
+                    copy_verified(self.throttle(fp), path, sha256,
+                                  decompress=decompress)
+                finally:
+                    fp.close()
+            except (URLError, OSError, IntegrityError) as e:
+                logging.info('Unable to fetch %s from peer %s: %s', key, peer, e)
+                continue
+            self.peer_hits += 1
+            return
+        self.peer_misses += 1
+        assert self.store, 'No peer has {} and no S3 bucket is configured'.format(key)
+        self.store.get_verified(key, path, sha256, decompress=decompress)
+
+    def download(self, prefix, local_path):
+        assert self.store, 'Missing S3 bucket configuration'
+        self.store.download(prefix, local_path)
+
+    def upload(self, local_path, prefix):
+        assert self.store, 'Missing S3 bucket configuration'
+        self.store.upload(local_path, prefix)
+
+    def put_chunks(self, chunk_store, chunks):
+        assert self.store, 'Missing S3 bucket configuration'
+        self.store.put_chunks(chunk_store, chunks)
+
+    def start_upload(self, key):
+        assert self.store, 'Missing S3 bucket configuration'
+        return self.store.start_upload(key)
+
+    def put_part(self, key, upload_id, number, data):
+        return self.store.put_part(key, upload_id, number, data)
+
+    def complete_upload(self, key, upload_id, parts):
+        self.store.complete_upload(key, upload_id, parts)
+
+    def abort_upload(self, key, upload_id):
+        self.store.abort_upload(key, upload_id)
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def get_path(self):
+        """
+        Map the request to a complete image file or chunk in the cache, or
+        return None.
+        """
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        for part in parts:
+            if not part or part.startswith('.') or TMP_FILE_RE.search(part):
+                return None
+
+        if len(parts) == 3 and parts[0] == CHUNK_DIR:
+            path = os.path.join(self.server.root, *parts)
+        elif len(parts) == 5 and parts[0] not in (CHUNK_DIR, ROOTFS_DIR):
+            # only images which have finished downloading (the manifest is
+            # written last) are served
+            image_path = os.path.join(self.server.root, *parts[:4])
+            if not os.path.exists(os.path.join(image_path, MANIFEST_FILE)):
+                return None
+            path = os.path.join(image_path, parts[4])
+        else:
+            return None
+
+        if not os.path.isfile(path):
+            return None
+        return path
+
+    def send_file(self, include_body):
+        path = self.get_path()
+        if path is None:
+            self.send_error(404)
+            return
+
+        if not self.server.slots.acquire(blocking=False):
+            # let the client move on to another peer (or the object store)
+            self.send_error(503)
+            return
+        try:
+            with open(path, 'rb') as fp:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(os.fstat(fp.fileno()).st_size))
+                self.end_headers()
+                if include_body:
+                    shutil.copyfileobj(fp, self.wfile, 1024 * 1024)
+        finally:
+            self.server.slots.release()
+
+    def do_GET(self):
+        self.send_file(include_body=True)
+
+    def do_HEAD(self):
+        self.send_file(include_body=False)
+
+
+class ImageServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a snapshot cache to peers, with at most ``max_connections``
+    transfers in flight.
+    """
+    daemon_threads = True
+
+    def __init__(self, root, address=('', DEFAULT_PORT), max_connections=8):
+        self.root = root
+        self.slots = BoundedSemaphore(max_connections)
+        super().__init__(address, ImageRequestHandler)
@@ -0,0 +1,112 @@
+"""
+Work left after a build, run once its result has been reported.
+
+Saving a snapshot means archiving the container, uploading the image,
+marking it active upstream and tearing the container down, none of which
+the job's result depends on. The wrapper hands these stages to a
+``PostBuildPipeline`` so the jobstep is finished first, though it still
+waits for them before exiting. Each stage can be limited to a number of
+concurrent runs across every wrapper on the host, as archiving and uploads
+compete with the builds which follow for CPU and bandwidth.
+"""
+import fcntl
+import logging
+import os
+
+from contextlib import contextmanager
+from threading import Thread
+from time import sleep
+
+from .metrics import PhaseRecorder
+
+PIPELINE_DIR = 'pipeline'
+
+# stage name to how many may run at once on the host
+DEFAULT_STAGE_LIMITS = {
+    'create_image': 1,
+    'upload': 2,
+}
+
+
+class PostBuildPipeline(object):
+    """
+    Runs each submitted job's stages in order on a background thread.
+
+    Stages are ``(name, func, always)``. Once a stage fails the rest are
+    skipped, except those marked ``always`` (i.e. reporting and teardown),
+    which are called with ``failed``.
+    """
+    # seconds between attempts to take a stage's slot
+    poll_interval = 1
+
+    def __init__(self, lock_dir, limits=None, metrics=None):
+        self.lock_dir = lock_dir
+        self.limits = dict(DEFAULT_STAGE_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.metrics = metrics or PhaseRecorder()
+        self.threads = []
+
+    def submit(self, name, stages):
+        print("==> Queueing {} for {}".format(', '.join(s for s, _, _ in stages), name))
+        thread = Thread(target=self.process, args=(name, stages))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def process(self, name, stages):
+        failed = False
+        for stage, func, always in stages:
+            if failed and not always:
+                print("==> Skipping {} for {}".format(stage, name))
+                continue
+            try:
+                with self.acquire(stage):
+                    with self.metrics.phase('post_build.{}'.format(stage), job=name):
+                        if always:
+                            func(failed=failed)
+                        else:
+                            func()
+            except Exception:
+                logging.exception('Post-build stage %s failed for %s', stage, name)
+                failed = True
+        return not failed
+
+    @contextmanager
+    def acquire(self, stage):
+        """
+        Hold one of the stage's slots, each a lock file shared by every
+        process using ``lock_dir``.
+        """
+        limit = self.limits.get(stage)
+        if not limit:
+            yield
+            return
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        waiting = False
+        while True:
+            for slot in range(limit):
+                lock = open(os.path.join(self.lock_dir, '{}.{}.lock'.format(stage, slot)), 'a')
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock.close()
+                    continue
+                try:
+                    yield
+                finally:
+                    lock.close()
+                return
+            if not waiting:
+                print("==> Waiting for one of {} {} slots".format(limit, stage))
+                waiting = True
+            sleep(self.poll_interval)
+
+    def close(self):
+        """
+        Wait for every submitted job's stages to finish.
+        """
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
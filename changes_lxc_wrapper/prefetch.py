@@ -0,0 +1,186 @@
+"""
+Background prefetching of snapshot images.
+
+When a project's snapshot is rebuilt every host would otherwise fetch it on
+demand when its next job arrives. Instead we poll the snapshot list for
+active images we don't have, and download them ahead of time for the
+projects this host has been running jobs for, busiest first.
+"""
+import json
+import logging
+import os
+import subprocess
+
+from collections import Counter
+from time import sleep, time
+from uuid import UUID
+
+from .history import JOB_HISTORY_FILE, JobHistory
+from .image_store import RateLimiter
+from .layers import MANIFEST_FILE
+from .metrics import PhaseRecorder
+
+DEFAULT_WINDOW = 7 * 24 * 60 * 60
+
+DEFAULT_RELEASE = 'precise'
+
+
+def lower_priority():
+    """
+    Run (along with anything we spawn) at low CPU and idle IO priority so
+    prefetching never competes with builds.
+    """
+    os.nice(10)
+    try:
+        subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
+    except OSError:
+        logging.warning('Unable to lower IO priority, ionice is unavailable')
+
+
+class Candidate(object):
+    def __init__(self, image_id, project, jobs, release):
+        self.image_id = image_id
+        self.project = project
+        self.jobs = jobs
+        self.release = release
+
+
+class Prefetcher(object):
+    def __init__(self, api, cache, image_store, max_disk=None, bandwidth=None,
+                 window=DEFAULT_WINDOW, release=DEFAULT_RELEASE, metrics=None):
+        self.api = api
+        # a SnapshotCache, for the current size of the cache
+        self.cache = cache
+        self.image_store = image_store
+        self.max_disk = max_disk
+        self.window = window
+        self.release = release
+        self.metrics = metrics or PhaseRecorder()
+        self.history = JobHistory(os.path.join(cache.root, JOB_HISTORY_FILE))
+
+        if bandwidth:
+            # shared by every transfer, including parallel chunk fetches
+            self.image_store.set_rate_limiter(RateLimiter(bandwidth))
+
+    def get_container(self, release):
+        # only needed once there's something to fetch
+        from .container import Container
+
+        return Container(
+            name='changes-lxc-prefetch',
+            release=release,
+            image_store=self.image_store,
+            metrics=self.metrics,
+        )
+
+    def get_candidates(self, snapshots):
+        """
+        Returns active images which are not cached, for projects with recent
+        jobs on this host, ordered by how many jobs each project ran.
+        """
+        image_projects = {}
+        for snapshot in snapshots:
+            for image in snapshot['images']:
+                image_projects[str(UUID(image['id']))] = snapshot['project']['id']
+
+        # images are launched under the release of the job, which the
+        # snapshot list doesn't tell us, so reuse the project's last one
+        job_counts = Counter()
+        releases = {}
+        for entry in self.history.read(since=time() - self.window):
+            project = image_projects.get(entry['snapshot'])
+            if project is None:
+                continue
+            job_counts[project] += 1
+            releases[project] = entry['release'] or self.release
+
+        candidates = []
+        for snapshot in snapshots:
+            project = snapshot['project']['id']
+            if not snapshot['isActive'] or not job_counts[project]:
+                continue
+            for image in snapshot['images']:
+                image_id = str(UUID(image['id']))
+                container = self.get_container(releases[project])
+                if container.is_image_cached(image_id):
+                    continue
+                candidates.append(Candidate(
+                    image_id=image_id,
+                    project=project,
+                    jobs=job_counts[project],
+                    release=releases[project],
+                ))
+
+        candidates.sort(key=lambda c: c.jobs, reverse=True)
+        return candidates
+
+    def get_download_size(self, container, image_id):
+        """
+        Estimate the bytes needed to fetch an image from its manifest, or
+        return None for images without one. Delta parents are not included
+        as they are normally already cached.
+        """
+        key = '{}/{}'.format(container.get_image_path(image_id), MANIFEST_FILE)
+        if not self.image_store.exists(key):
+            return None
+        fp = self.image_store.open(key)
+        try:
+            manifest = json.loads(fp.read().decode('utf-8'))
+        finally:
+            fp.close()
+        if 'files' not in manifest:
+            return None
+
+        size = sum(f['size'] for f in manifest['files'].values())
+        size += sum(c['compressed_size'] for c in
+                    container.chunk_store.missing(manifest.get('chunks', ())))
+        return size
+
+    def run_once(self):
+        """
+        Prefetch whatever is missing and fits the cache budget, returning the
+        number of images fetched.
+        """
+        self.history.prune(time() - self.window)
+
+        candidates = self.get_candidates(self.api.list_snapshots())
+        if not candidates:
+            return 0
+
+        self.cache.initialize()
+        used = self.cache.total_size
+
+        fetched = 0
+        for candidate in candidates:
+            container = self.get_container(candidate.release)
+            size = self.get_download_size(container, candidate.image_id)
+            if size is None:
+                print("==> Not prefetching image {}, it has no manifest".format(
+                    candidate.image_id))
+                continue
+            if self.max_disk and used + size > self.max_disk:
+                print("==> Not prefetching image {} ({} bytes), cache is full".format(
+                    candidate.image_id, size))
+                continue
+
+            print("==> Prefetching image {} for project {} ({} recent jobs)".format(
+                candidate.image_id, candidate.project, candidate.jobs))
+            try:
+                with self.metrics.phase('prefetch', snapshot=candidate.image_id) as record:
+                    record['bytes'] = size
+                    container.ensure_image_chain(candidate.image_id, assemble=False)
+            except Exception:
+                logging.exception('Failed to prefetch image %s', candidate.image_id)
+                continue
+            used += size
+            fetched += 1
+        return fetched
+
+    def run(self, interval=60):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                # keep polling through API or store outages
+                logging.exception('Prefetch failed')
+            sleep(interval)
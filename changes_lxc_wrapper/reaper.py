@@ -0,0 +1,110 @@
+import logging
+import os
+
+from queue import Queue
+from threading import Thread
+
+
+def get_start_time(pid):
+    """
+    When the process started, in clock ticks since boot (field 22 of
+    /proc/<pid>/stat), or None if it doesn't exist.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as fp:
+            stat = fp.read()
+    except (IOError, OSError):
+        return None
+    # the command name may contain spaces, so count from after it
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def get_owner_id(pid=None):
+    """
+    Identifies a process, as written to a container's owner file.
+    """
+    pid = pid or os.getpid()
+    start_time = get_start_time(pid)
+    if start_time is None:
+        return str(pid)
+    return '{} {}'.format(pid, start_time)
+
+
+def is_orphaned(owner_path):
+    """
+    A container is orphaned if the wrapper process recorded as its owner no
+    longer exists. Containers without an owner file were not created by us
+    (i.e. snapshot base containers) and are never considered orphans.
+
+    The owner's start time is recorded along with its pid, so a new
+    process given the same pid isn't taken for the owner.
+    """
+    try:
+        with open(owner_path) as fp:
+            values = fp.read().split()
+        pid = int(values[0])
+        start_time = int(values[1]) if len(values) > 1 else None
+    except (IOError, OSError, ValueError, IndexError):
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        # exists, but belongs to someone else
+        pass
+    if start_time is not None and get_start_time(pid) not in (start_time, None):
+        # the pid was reused
+        return True
+    return False
+
+
+class ContainerReaper(object):
+    """
+    Destroys containers on background threads, with at most
+    ``concurrency`` destroys at once. This lets the wrapper report a job's
+    result before its container is torn down; the wrapper still waits for
+    every teardown (``close``) before it exits.
+    """
+    concurrency = 2
+
+    def __init__(self, concurrency=None):
+        if concurrency is not None:
+            self.concurrency = concurrency
+
+        self.queue = Queue()
+        self.workers = []
+
+    def start(self):
+        for _ in range(self.concurrency):
+            worker = Thread(target=self.process)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, container):
+        print("==> Queueing container {} for teardown".format(container.name))
+        self.queue.put(container)
+
+    def process(self):
+        while True:
+            container = self.queue.get()
+            try:
+                if container is None:
+                    return
+                container.destroy()
+            except Exception:
+                logging.exception('Failed to destroy container %s', container.name)
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """
+        Wait for all queued teardowns to finish and stop the workers.
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
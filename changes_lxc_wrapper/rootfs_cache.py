@@ -0,0 +1,210 @@
+"""
+Cache of extracted snapshot root filesystems.
+
+Each entry is a snapshot image (and its delta parents) extracted once into
+``<cache>/rootfs/<snapshot>/rootfs``. A base container is defined on top of
+it so launches only ever pay for a clone (see ``clone``). Entries are tracked for
+size and last use independently of the compressed images they came from.
+"""
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+
+from time import time
+from uuid import uuid4
+
+from .overlay import apply_delta
+
+ROOTFS_DIR = 'rootfs'
+
+META_FILE = 'meta.json'
+
+LXC_PATH = '/var/lib/lxc'
+
+# Written next to the config of a container whose rootfs was cloned (rather
+# than overlaid) from an entry, naming the entry's rootfs
+ORIGIN_FILE = 'changes-lxc-origin'
+
+
+def get_tree_size(path):
+    """
+    Like get_directory_size, but a rootfs is full of symlinks (often
+    absolute, or dangling on the host) which must not be followed.
+    """
+    total_size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            if not os.path.islink(fp):
+                total_size += os.lstat(fp).st_size
+    return total_size
+
+
+class RootfsEntry(object):
+    def __init__(self, id, path, size, last_used, chain):
+        self.id = id
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+        self.chain = chain
+
+    @property
+    def rootfs(self):
+        return os.path.join(self.path, ROOTFS_DIR)
+
+
+class RootfsCache(object):
+    def __init__(self, root, lxc_path=LXC_PATH):
+        self.root = os.path.join(root, ROOTFS_DIR)
+        self.lxc_path = lxc_path
+
+    def get_path(self, snapshot):
+        return os.path.join(self.root, str(snapshot))
+
+    def get_rootfs(self, snapshot):
+        return os.path.join(self.get_path(snapshot), ROOTFS_DIR)
+
+    def get(self, snapshot):
+        """
+        Returns the entry for a snapshot, or None if it has not been (fully)
+        extracted.
+        """
+        path = self.get_path(snapshot)
+        try:
+            with open(os.path.join(path, META_FILE)) as fp:
+                meta = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+        return RootfsEntry(
+            id=str(snapshot),
+            path=path,
+            size=meta['size'],
+            last_used=os.path.getmtime(os.path.join(path, META_FILE)),
+            chain=meta['chain'],
+        )
+
+    def touch(self, snapshot):
+        meta_path = os.path.join(self.get_path(snapshot), META_FILE)
+        if os.path.exists(meta_path):
+            os.utime(meta_path)
+
+    def extract(self, snapshot, layers, backend=None):
+        """
+        Extract the given layers, a list of (snapshot, archive path, manifest)
+        ordered from the full image to the requested snapshot.
+
+        With a clone backend the rootfs is created by it, so launches can
+        clone it cheaply.
+        """
+        def populate(rootfs):
+            if backend is not None:
+                backend.create_rootfs(rootfs)
+            else:
+                os.makedirs(rootfs)
+            (_, archive_path, _), deltas = layers[0], layers[1:]
+            subprocess.check_call(["tar", "--numeric-owner", "-xpJf",
+                                   archive_path, "-C", rootfs])
+            for _, archive_path, manifest in deltas:
+                apply_delta(rootfs, archive_path, manifest)
+
+        return self.add(snapshot, [str(s) for s, _, _ in layers], populate, backend)
+
+    def add(self, snapshot, chain, populate, backend=None):
+        """
+        Add an entry whose rootfs is created by ``populate(path)``.
+
+        This happens in a scratch directory which is only renamed into
+        place once complete, so a partial rootfs is never used.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        path = self.get_path(snapshot)
+
+        with open('{}.lock'.format(path), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # someone else may have extracted it while we waited
+            entry = self.get(snapshot)
+            if entry is not None:
+                return entry
+
+            tmp_path = '{}.{}'.format(path, uuid4().hex)
+            rootfs = os.path.join(tmp_path, ROOTFS_DIR)
+            os.makedirs(tmp_path)
+            try:
+                populate(rootfs)
+
+                with open(os.path.join(tmp_path, META_FILE), 'w') as fp:
+                    json.dump({
+                        'size': get_tree_size(rootfs),
+                        'chain': chain,
+                        'date_extracted': time(),
+                    }, fp)
+
+                if os.path.exists(path):
+                    # left over from an interrupted extraction
+                    shutil.rmtree(path)
+                os.rename(tmp_path, path)
+            except Exception:
+                if backend is not None and os.path.exists(rootfs):
+                    backend.remove_rootfs(rootfs)
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise
+
+        if backend is not None:
+            backend.rootfs_moved(os.path.join(path, ROOTFS_DIR))
+        return self.get(snapshot)
+
+    def list(self):
+        entries = []
+        if not os.path.exists(self.root):
+            return entries
+        for name in os.listdir(self.root):
+            if '.' in name:
+                continue
+            entry = self.get(name)
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+    def get_users(self, entry):
+        """
+        Returns the names of containers whose config references the entry,
+        or which were cloned from it, excluding the base container defined
+        on top of it.
+        """
+        users = []
+        if not os.path.isdir(self.lxc_path):
+            return users
+        for name in os.listdir(self.lxc_path):
+            if name == entry.id:
+                continue
+            for filename in ('config', ORIGIN_FILE):
+                try:
+                    with open(os.path.join(self.lxc_path, name, filename)) as fp:
+                        if entry.rootfs in fp.read():
+                            users.append(name)
+                            break
+                except (IOError, OSError):
+                    continue
+        return users
+
+    def remove(self, entry, backend=None):
+        assert not self.get_users(entry), \
+            "Extracted rootfs {} is still in use".format(entry.id)
+
+        # the base container defined on this rootfs goes with it
+        base_path = os.path.join(self.lxc_path, entry.id)
+        try:
+            with open(os.path.join(base_path, 'config')) as fp:
+                is_ours = entry.rootfs in fp.read()
+        except (IOError, OSError):
+            is_ours = False
+        if is_ours:
+            shutil.rmtree(base_path)
+
+        if backend is not None and os.path.exists(entry.rootfs):
+            # i.e. a subvolume or dataset
+            backend.remove_rootfs(entry.rootfs)
+        shutil.rmtree(entry.path)
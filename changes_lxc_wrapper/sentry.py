@@ -0,0 +1,48 @@
+"""
+Sentry reporting which costs nothing until there is something to report.
+
+Importing raven and building its client takes longer than most helper
+commands, so the CLIs install a stand-in handler which loads them on the
+first record. Events are sent from raven's background thread rather than
+holding up the command.
+"""
+import logging
+import os
+
+
+def get_threaded_dsn(dsn=None):
+    """
+    The pinned raven picks its transport from the DSN scheme, so ask for the
+    threaded one unless SENTRY_DSN already names a transport.
+    """
+    dsn = dsn or os.environ['SENTRY_DSN']
+    scheme = dsn.split('://', 1)[0]
+    if '+' in scheme:
+        return dsn
+    return 'threaded+' + dsn
+
+
+class LazySentryHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.handler = None
+
+    def get_handler(self):
+        if self.handler is None:
+            from raven import Client
+            from raven.handlers.logging import SentryHandler
+
+            self.handler = SentryHandler(Client(get_threaded_dsn()))
+            self.handler.setLevel(self.level)
+        return self.handler
+
+    def emit(self, record):
+        self.get_handler().handle(record)
+
+
+def configure_logging(level):
+    logging.basicConfig(level=level)
+
+    # raven is only configured through the environment
+    if os.environ.get('SENTRY_DSN'):
+        logging.getLogger().addHandler(LazySentryHandler())
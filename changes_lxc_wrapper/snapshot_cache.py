@@ -1,9 +1,23 @@
 import os.path
 import shutil
 
+from collections import Counter
 from datetime import datetime
+from time import time
 from uuid import UUID
 
+from .clone import CLONE_DIR, CloneBackend
+from .integrity import verify_image
+from .layers import CHUNK_DIR, ChunkStore, read_manifest
+from .metadata import METADATA_FILE, MetadataStore
+from .metrics import PhaseRecorder
+from .package_cache import PACKAGE_DIR, PackageCache
+from .pipeline import PIPELINE_DIR
+from .rootfs_cache import ROOTFS_DIR, RootfsCache
+from .workspace import WORKSPACE_DIR, WorkspaceCache
+
+
+SNAPSHOT_CACHE = '/var/cache/lxc/download'
 
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
@@ -23,67 +37,316 @@ def convert_date(value):
 
 class SnapshotImage(object):
     def __init__(self, id, path, date_created=None, is_active=None,
-                 is_valid=True, project=None):
+                 is_valid=True, project=None, chunks=None, dir_size=None,
+                 hits=0, last_access=None, download_time=None):
         self.id = id
         self.path = path
-        self.size = get_directory_size(path)
+        if dir_size is None:
+            dir_size = get_directory_size(path)
+        self.dir_size = dir_size
+        # bytes freed by removing this snapshot (excludes shared chunks)
+        self.size = self.dir_size
+        self.shared_size = 0
         self.date_created = date_created
         self.is_active = is_active
         self.is_valid = is_valid
         self.project = project
+        self.chunks = set(chunks or ())
+        # launches using this image, and the time of the last one
+        self.hits = hits
+        self.last_access = last_access
+        self.download_time = download_time
 
 
 class SnapshotCache(object):
-    def __init__(self, root, api):
+    # seconds between full walks of the cache to correct the metadata
+    reconcile_interval = 3600
+
+    # seconds between refreshes of upstream (Changes) snapshot state
+    upstream_interval = 300
+
+    def __init__(self, root, api, metrics=None, reconcile=False):
         self.api = api
         self.root = root
         self.snapshots = []
+        self.metrics = metrics or PhaseRecorder()
+        self.chunk_store = ChunkStore(os.path.join(root, CHUNK_DIR))
+        self.chunk_sizes = {}
+        self.chunk_refs = Counter()
+        self.rootfs_cache = RootfsCache(root)
+        self.rootfs_entries = []
+        self.package_cache = PackageCache(root)
+        self.workspace_cache = WorkspaceCache(root)
+        self.metadata = MetadataStore(os.path.join(root, METADATA_FILE))
+        # force a full reconciliation rather than trusting the metadata
+        self.reconcile = reconcile
+        # whether upstream state was fetched by this process
+        self.fetched_upstream = False
 
     def initialize(self):
+        with self.metrics.phase('cache.initialize') as record:
+            self._initialize()
+            record['bytes'] = self.total_size
+            record['snapshots'] = len(self.snapshots)
+
+    def _initialize(self):
         print("==> Initializing snapshot cache")
+        self.refresh()
+        self._load()
+
+        self.rootfs_entries = self.rootfs_cache.list()
+
+        print("==> {} items found in cache ({} bytes)".format(len(self.snapshots), self.total_size))
+        print("==> {} extracted rootfs found in cache ({} bytes)".format(
+            len(self.rootfs_entries), self.rootfs_size))
+
+    def refresh(self):
+        """
+        Bring the metadata up to date if it is due for reconciliation or an
+        upstream refresh, without loading it.
+        """
+        now = time()
+        refreshed = self.metadata.get_state('upstream_refreshed') or 0
+        if self.reconcile or \
+                now - (self.metadata.get_state('reconciled') or 0) > self.reconcile_interval:
+            self._reconcile()
+        elif now - refreshed > self.upstream_interval or self._has_unrefreshed_images(refreshed):
+            self._refresh_upstream()
+
+    def _has_unrefreshed_images(self, refreshed):
+        """
+        Whether images were downloaded or created since the last upstream
+        refresh. Until refreshed they look unknown (i.e. invalid), and
+        cleanup would remove them even if they are active.
+        """
+        return bool(list(self.metadata.query(
+            'NOT is_known AND date_added > ?', (refreshed,), limit=1)))
+
+    def refresh_upstream(self):
+        """
+        Make sure the loaded snapshots have current upstream state (i.e.
+        before deciding what to remove), whenever it was last refreshed.
+        """
+        if not self.fetched_upstream:
+            self._refresh_upstream()
+            self._load()
+
+    def _get_upstream_data(self):
+        print("==> Fetching upstream metadata")
+        self.fetched_upstream = True
+        upstream_data = {}
+        for snapshot in self.api.list_snapshots():
+            for image in snapshot['images']:
+                upstream_data[UUID(image['id'])] = {
+                    'project': UUID(snapshot['project']['id']),
+                    'date_created': convert_date(snapshot['dateCreated']),
+                    'is_active': snapshot['isActive'],
+                }
+        return upstream_data
+
+    def _get_upstream_fields(self, path_data):
+        if not path_data:
+            return {'project': None, 'date_created': None, 'is_active': 0,
+                    'is_known': 0}
+        return {
+            'project': str(path_data['project']),
+            'date_created': path_data['date_created'].strftime(DATETIME_FORMAT),
+            'is_active': int(path_data['is_active']),
+            'is_known': 1,
+        }
+
+    def _reconcile(self):
+        """
+        Rebuild the metadata from a walk of the cache and the upstream
+        snapshot list, keeping access history for images still present.
+        """
+        print("==> Reconciling snapshot cache metadata")
         # find all valid snapshot paths
         path_list = self._collect_files(self.root)
 
         upstream_data = {}
         if path_list:
-            # get upstream metadata
-            print("==> Fetching upstream metadata")
-            for snapshot in self.api.list_snapshots():
-                for image in snapshot['images']:
-                    upstream_data[UUID(image['id'])] = {
-                        'project': UUID(snapshot['project']['id']),
-                        'date_created': convert_date(snapshot['dateCreated']),
-                        'is_active': snapshot['isActive'],
-                    }
+            upstream_data = self._get_upstream_data()
 
         # collect size information for each path
         snapshot_list = []
+        intact = {}
         for path in path_list:
             id_ = UUID(path.rsplit('/', 1)[-1])
             path_data = upstream_data.get(id_, {})
+            manifest = read_manifest(path) or {}
+            # only sizes are checked here, plus whatever launches have
+            # already verified, as hashing every image would be too slow
+            intact[id_] = not verify_image(path, manifest, rehash=False)
             snapshot_list.append(SnapshotImage(
                 id=id_,
                 path=path,
                 is_active=path_data.get('is_active', False),
                 date_created=path_data.get('date_created'),
-                is_valid=bool(path_data),
+                is_valid=bool(path_data) and intact[id_],
                 project=path_data.get('project'),
+                chunks=[c['id'] for c in manifest.get('chunks', ())],
             ))
 
         self.snapshots = snapshot_list
+        self.chunk_sizes = self.chunk_store.get_sizes()
+        self._update_chunk_usage()
 
-        print("==> {} items found in cache ({} bytes)".format(len(self.snapshots), self.total_size))
+        now = time()
+        with self.metadata.transaction() as conn:
+            found = set()
+            for snapshot in snapshot_list:
+                found.add(str(snapshot.id))
+                fields = self._get_upstream_fields(upstream_data.get(snapshot.id))
+                self.metadata.record_image(
+                    snapshot.id, snapshot.path, conn=conn,
+                    is_intact=int(intact[snapshot.id]),
+                    dir_size=snapshot.dir_size,
+                    size=snapshot.size,
+                    shared_size=snapshot.shared_size,
+                    chunks=snapshot.chunks,
+                    **fields)
+            for (image_id,) in conn.execute('SELECT id FROM images').fetchall():
+                if image_id not in found:
+                    conn.execute('DELETE FROM images WHERE id = ?', (image_id,))
+            conn.execute('DELETE FROM chunks')
+            conn.executemany('INSERT INTO chunks (id, size) VALUES (?, ?)',
+                             self.chunk_sizes.items())
+            self.metadata.set_state('reconciled', now, conn=conn)
+            self.metadata.set_state('upstream_refreshed', now, conn=conn)
+
+    def _refresh_upstream(self):
+        """
+        Update upstream state (active, project, validity) of known images
+        without walking the cache.
+        """
+        upstream_data = self._get_upstream_data()
+        with self.metadata.transaction() as conn:
+            for (image_id, path) in conn.execute('SELECT id, path FROM images').fetchall():
+                self.metadata.record_image(
+                    image_id, path, conn=conn,
+                    **self._get_upstream_fields(upstream_data.get(UUID(image_id))))
+            self.metadata.set_state('upstream_refreshed', time(), conn=conn)
+
+    def _get_snapshot(self, row):
+        return SnapshotImage(
+            id=UUID(row['id']),
+            path=row['path'],
+            is_active=bool(row['is_active']),
+            date_created=convert_date(row['date_created']) if row['date_created'] else None,
+            is_valid=bool(row['is_known'] and row['is_intact']),
+            project=UUID(row['project']) if row['project'] else None,
+            chunks=row['chunks'],
+            dir_size=row['dir_size'],
+            hits=row['hits'],
+            last_access=row['last_access'],
+            download_time=row['download_time'],
+        )
+
+    def _load(self):
+        saved_sizes = {}
+        self.snapshots = []
+        for row in self.metadata.query():
+            self.snapshots.append(self._get_snapshot(row))
+            saved_sizes[row['id']] = (row['size'], row['shared_size'])
+        self.chunk_sizes = self.metadata.get_chunk_sizes()
+        self._update_chunk_usage()
+
+        # images added by launches since the last reconciliation only have
+        # their directory size recorded
+        changed = [(s.size, s.shared_size, str(s.id)) for s in self.snapshots
+                   if saved_sizes[str(s.id)] != (s.size, s.shared_size)]
+        if changed:
+            with self.metadata.transaction() as conn:
+                conn.executemany(
+                    'UPDATE images SET size = ?, shared_size = ? WHERE id = ?', changed)
+
+    def query(self, where=None, params=(), order_by=None):
+        """
+        Returns loaded snapshots in the order (and subset) given by an
+        indexed query against the metadata.
+        """
+        by_id = {str(s.id): s for s in self.snapshots}
+        result = []
+        for row in self.metadata.query(where, params, order_by):
+            snapshot = by_id.get(row['id'])
+            if snapshot is not None:
+                result.append(snapshot)
+        return result
+
+    def _update_chunk_usage(self):
+        """
+        Attribute chunk bytes to snapshots. Chunks used by a single snapshot
+        count towards its size; shared chunks are only counted once, in the
+        cache total.
+        """
+        self.chunk_refs = Counter()
+        for snapshot in self.snapshots:
+            self.chunk_refs.update(snapshot.chunks)
+
+        for snapshot in self.snapshots:
+            snapshot.size = snapshot.dir_size
+            snapshot.shared_size = 0
+            for chunk_id in snapshot.chunks:
+                chunk_size = self.chunk_sizes.get(chunk_id, 0)
+                if self.chunk_refs[chunk_id] == 1:
+                    snapshot.size += chunk_size
+                else:
+                    snapshot.shared_size += chunk_size
 
     @property
     def total_size(self):
-        return sum(s.size for s in self.snapshots)
+        return (sum(s.dir_size for s in self.snapshots) +
+                sum(self.chunk_sizes.values()))
+
+    @property
+    def rootfs_size(self):
+        return sum(e.size for e in self.rootfs_entries)
+
+    def remove_rootfs(self, entry, on_disk=True):
+        print("==> Removing extracted rootfs: {}".format(entry.id))
+        with self.metrics.phase('cache.remove_rootfs', snapshot=entry.id) as record:
+            record['bytes'] = entry.size
+            if on_disk:
+                # whatever backend extracted it
+                self.rootfs_cache.remove(entry, CloneBackend())
+            self.rootfs_entries.remove(entry)
 
     def remove(self, snapshot, on_disk=True):
         assert not snapshot.is_active
         print("==> Removing snapshot: {}".format(snapshot.id))
-        if on_disk:
-            shutil.rmtree(snapshot.path)
-        self.snapshots.remove(snapshot)
+        with self.metrics.phase('cache.remove', snapshot=snapshot.id) as record:
+            record['bytes'] = snapshot.size
+            if on_disk:
+                shutil.rmtree(snapshot.path)
+            self.snapshots.remove(snapshot)
+
+            removed_chunks = []
+            for chunk_id in snapshot.chunks:
+                self.chunk_refs[chunk_id] -= 1
+                if self.chunk_refs[chunk_id] <= 0:
+                    if on_disk:
+                        self.chunk_store.remove(chunk_id)
+                    self.chunk_sizes.pop(chunk_id, None)
+                    removed_chunks.append(chunk_id)
+            self._update_chunk_usage()
+
+            if on_disk:
+                self._save_removal(snapshot, removed_chunks)
+
+    def _save_removal(self, snapshot, removed_chunks):
+        """
+        Remove an image (and chunks only it used) from the metadata, and
+        write back sizes which changed as chunks lost an owner.
+        """
+        with self.metadata.transaction() as conn:
+            conn.execute('DELETE FROM images WHERE id = ?', (str(snapshot.id),))
+            conn.executemany('DELETE FROM chunks WHERE id = ?',
+                             [(c,) for c in removed_chunks])
+            if removed_chunks or snapshot.shared_size:
+                conn.executemany(
+                    'UPDATE images SET size = ?, shared_size = ? WHERE id = ?',
+                    [(s.size, s.shared_size, str(s.id)) for s in self.snapshots])
 
     def _collect_files(self, root):
         # The root will consist of three subdirs, depicting the dist, release,
@@ -96,6 +359,9 @@ class SnapshotCache(object):
             if _stack is None:
                 _stack = []
             for name in os.listdir(path):
+                if _depth == 1 and name in (CHUNK_DIR, ROOTFS_DIR, PACKAGE_DIR, WORKSPACE_DIR,
+                                            CLONE_DIR, PIPELINE_DIR):
+                    continue
                 name_path = os.path.join(path, name)
                 if not os.path.isdir(name_path):
                     continue
@@ -0,0 +1,91 @@
+"""
+Size-limited tmpfs for containers' writable layers.
+
+Short, I/O heavy jobs otherwise write their scratch data to the disk shared
+with the image cache and every other container. A tmpfs layer is only
+granted when the host can afford it: its whole size must fit in the memory
+available, less what other tmpfs layers may still fill and a reserve kept
+for the jobs' own processes. Pages written to the layer are charged to the
+container's memory cgroup, so they count towards any memory limit.
+"""
+import fcntl
+import os
+import subprocess
+
+# mount source identifying our tmpfs layers in /proc/self/mounts
+TMPFS_SOURCE = 'changes-lxc-tmpfs'
+
+DEFAULT_RESERVE = 2 * 1024 * 1024 * 1024
+
+
+def get_available_memory(meminfo='/proc/meminfo'):
+    values = {}
+    with open(meminfo) as fp:
+        for line in fp:
+            key, value = line.split(':', 1)
+            values[key] = int(value.split()[0]) * 1024
+    if 'MemAvailable' in values:
+        return values['MemAvailable']
+    # kernels before 3.14
+    return values['MemFree'] + values.get('Cached', 0)
+
+
+def get_tmpfs_layers(mounts='/proc/self/mounts'):
+    layers = []
+    with open(mounts) as fp:
+        for line in fp:
+            source, mount_point = line.split()[:2]
+            if source == TMPFS_SOURCE:
+                layers.append(mount_point)
+    return layers
+
+
+def get_committed_memory(layers):
+    """
+    Bytes the given tmpfs layers may still use, which the memory available
+    doesn't account for yet.
+    """
+    total = 0
+    for path in layers:
+        try:
+            st = os.statvfs(path)
+        except OSError:
+            continue
+        total += st.f_bavail * st.f_frsize
+    return total
+
+
+def get_memory_headroom():
+    return get_available_memory() - get_committed_memory(get_tmpfs_layers())
+
+
+def mount_tmpfs(path, size, reserve=DEFAULT_RESERVE, lock_path=None):
+    """
+    Mount a tmpfs of ``size`` bytes at ``path`` if the host has the memory
+    for it, returning whether it was mounted. With a ``lock_path``,
+    concurrent launches check and mount one at a time.
+    """
+    lock = None
+    if lock_path:
+        lock = open(lock_path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        headroom = get_memory_headroom()
+        if headroom - size < reserve:
+            print("==> Not enough memory for a {} byte tmpfs ({} bytes free, {} reserved)".format(
+                size, headroom, reserve))
+            return False
+
+        os.makedirs(path, exist_ok=True)
+        subprocess.check_call([
+            'mount', '-t', 'tmpfs', '-o', 'size={},mode=0755'.format(size),
+            TMPFS_SOURCE, path,
+        ])
+        return True
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def unmount_tmpfs(path):
+    subprocess.check_call(['umount', path])
@@ -0,0 +1,110 @@
+"""
+Parallel multipart uploads which can start before the whole file exists.
+
+Data written to a MultipartUpload is cut into parts which are sent by a
+small pool of threads while the writer carries on, so an archive can be
+uploaded while it is still being compressed. A failed part is retried on
+its own. Nothing is visible in the store until the upload is completed.
+"""
+import hashlib
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from time import sleep
+
+from .integrity import BLOCK_SIZE
+
+PART_SIZE = 64 * 1024 * 1024
+
+
+class MultipartUpload(object):
+    concurrency = 4
+
+    max_attempts = 4
+
+    def __init__(self, store, key, part_size=PART_SIZE):
+        self.store = store
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = store.start_upload(key)
+        self.executor = ThreadPoolExecutor(self.concurrency)
+        # bounds the parts held in memory while waiting on the network
+        self.slots = BoundedSemaphore(self.concurrency * 2)
+        self.futures = []
+        self.buffer = bytearray()
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self.submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def submit(self, data):
+        for future in self.futures:
+            if future.done() and future.exception():
+                # no point producing more parts for a failed upload
+                raise future.exception()
+
+        self.slots.acquire()
+        number = len(self.futures) + 1
+        future = self.executor.submit(self.put_part, number, data)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+
+    def put_part(self, number, data):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return self.store.put_part(self.key, self.upload_id, number, data)
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    raise
+                logging.warning('Upload of part %d of %s failed (%s), retrying',
+                                number, self.key, e)
+                sleep(attempt ** 2)
+
+    def close(self):
+        """
+        Send any remaining data and complete the upload, returning the size
+        and sha256 of everything written.
+        """
+        try:
+            if self.buffer or not self.futures:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            parts = [f.result() for f in self.futures]
+            self.store.complete_upload(self.key, self.upload_id, parts)
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+        return {'size': self.size, 'sha256': self.digest.hexdigest()}
+
+    def abort(self):
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+        try:
+            self.store.abort_upload(self.key, self.upload_id)
+        except Exception:
+            logging.exception('Failed to abort upload of %s', self.key)
+
+
+def upload_file(store, path, key, part_size=PART_SIZE):
+    """
+    Upload a local file in parallel parts.
+    """
+    upload = MultipartUpload(store, key, part_size)
+    try:
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(BLOCK_SIZE), b''):
+                upload.write(block)
+    except Exception:
+        upload.abort()
+        raise
+    return upload.close()
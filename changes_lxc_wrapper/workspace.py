@@ -0,0 +1,178 @@
+"""
+Per-project build workspaces (i.e. a ccache directory) kept between jobs.
+
+Each workspace is a directory inside the container, backed by a slot under
+``<cache>/workspaces/<project>/<volume>/<slot>`` which is bind-mounted at
+launch and left in place when the container is destroyed. A slot is only
+ever mounted by one container: launches take the first slot which is
+neither locked nor referenced by a container config, creating a new one
+(up to ``max_slots``) when concurrent jobs of a project hold the others.
+
+Slots are bounded and evicted by the manager, as with the other caches.
+"""
+import fcntl
+import os
+import shutil
+
+from uuid import uuid4
+
+from .package_cache import get_mount_users
+from .rootfs_cache import LXC_PATH, get_tree_size
+
+WORKSPACE_DIR = 'workspaces'
+
+
+def get_volume_name(path):
+    """
+    Returns the directory name of the volume backing ``path`` (inside the
+    container).
+    """
+    return path.strip('/').replace('/', '_')
+
+
+class WorkspaceSlot(object):
+    def __init__(self, project, volume, slot, path, size, last_used):
+        self.project = project
+        self.volume = volume
+        self.slot = slot
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+
+    @property
+    def id(self):
+        return '/'.join((self.project, self.volume, self.slot))
+
+
+class WorkspaceCache(object):
+    # concurrent jobs of a project which may each have their own copy
+    max_slots = 4
+
+    def __init__(self, root, lxc_path=LXC_PATH):
+        self.root = os.path.join(root, WORKSPACE_DIR)
+        self.lxc_path = lxc_path
+
+    def get_volume_path(self, project, path):
+        return os.path.join(self.root, str(project), get_volume_name(path))
+
+    def get_lock_path(self, path):
+        return '{}.lock'.format(path)
+
+    def claim(self, project, path):
+        """
+        Returns ``(slot path, lock)`` for a free slot of the workspace, or
+        ``(None, None)`` if every slot is in use. The lock must be held until
+        the container's config (mounting the slot) is saved.
+        """
+        volume_path = self.get_volume_path(project, path)
+        os.makedirs(volume_path, exist_ok=True)
+        for slot in range(self.max_slots):
+            slot_path = os.path.join(volume_path, str(slot))
+            lock = open(self.get_lock_path(slot_path), 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # being claimed by another launch, or evicted
+                lock.close()
+                continue
+            if get_mount_users(self.lxc_path, slot_path):
+                lock.close()
+                continue
+            os.utime(lock.name)
+            if not os.path.isdir(slot_path):
+                os.makedirs(slot_path)
+                # builds run as an unprivileged user inside the container
+                os.chmod(slot_path, 0o777)
+            return slot_path, lock
+        return None, None
+
+    def get_mount_entries(self, project, paths):
+        """
+        Claims a slot for each workspace, returning the ``lxc.mount.entry``
+        values which attach them along with the locks to release once the
+        config is saved.
+        """
+        mounts, locks = [], []
+        if not project:
+            print("==> No project given, not attaching workspaces")
+            return mounts, locks
+        try:
+            for path in paths:
+                slot_path, lock = self.claim(project, path)
+                if slot_path is None:
+                    print("==> All {} workspaces of {} are in use, starting empty".format(
+                        path, project))
+                    continue
+                locks.append(lock)
+                mounts.append('{} {} none bind,create=dir 0 0'.format(
+                    slot_path, path.lstrip('/')))
+                print("==> Attaching workspace {}: {}".format(path, slot_path))
+        except Exception:
+            self.release_locks(locks)
+            raise
+        return mounts, locks
+
+    def release_locks(self, locks):
+        for lock in locks:
+            lock.close()
+
+    def detach(self, mount_entries):
+        """
+        Records the last use of a container's workspaces, which stay where
+        they are for the next job.
+        """
+        for value in mount_entries:
+            slot_path = value.split()[0]
+            lock_path = self.get_lock_path(slot_path)
+            if os.path.dirname(os.path.dirname(os.path.dirname(slot_path))) == self.root \
+                    and os.path.exists(lock_path):
+                os.utime(lock_path)
+
+    def list(self):
+        slots = []
+        if not os.path.exists(self.root):
+            return slots
+        for project in sorted(os.listdir(self.root)):
+            project_path = os.path.join(self.root, project)
+            if not os.path.isdir(project_path):
+                continue
+            for volume in sorted(os.listdir(project_path)):
+                volume_path = os.path.join(project_path, volume)
+                if not os.path.isdir(volume_path):
+                    continue
+                for slot in sorted(os.listdir(volume_path)):
+                    path = os.path.join(volume_path, slot)
+                    if not slot.isdigit() or not os.path.isdir(path):
+                        continue
+                    lock_path = self.get_lock_path(path)
+                    slots.append(WorkspaceSlot(
+                        project=project,
+                        volume=volume,
+                        slot=slot,
+                        path=path,
+                        size=get_tree_size(path),
+                        last_used=os.path.getmtime(
+                            lock_path if os.path.exists(lock_path) else path),
+                    ))
+        return slots
+
+    def get_users(self, slot):
+        return get_mount_users(self.lxc_path, slot.path)
+
+    def remove(self, slot):
+        """
+        Removes the slot unless a container is using it. Returns whether
+        it was removed.
+        """
+        with open(self.get_lock_path(slot.path), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # a launch is claiming it
+                return False
+            if self.get_users(slot):
+                return False
+            tmp_path = '{}.{}'.format(slot.path, uuid4().hex)
+            os.rename(slot.path, tmp_path)
+        shutil.rmtree(tmp_path)
+        return True
@@ -32,6 +32,7 @@ setup(
     entry_points={
         'console_scripts': [
             'changes-lxc = changes_lxc_wrapper.cli.helper:main',
+            'changes-lxc-client = changes_lxc_wrapper.cli.client:main',
             'changes-lxc-wrapper = changes_lxc_wrapper.cli.wrapper:main',
             'changes-snapshot-manager = changes_lxc_wrapper.cli.manager:main',
         ],
@@ -0,0 +1,129 @@
+import csv
+import io
+import json
+import os
+import sqlite3
+
+from mock import patch
+
+from changes_lxc_wrapper.cli.manager import (
+    LIST_FIELDS, ManagerCommand, parse_size_value, write_records
+)
+
+
+PROJECT_ID = 'b4c2a2c6-8b5f-4b8a-9a8e-0f7f1b1f5e2a'
+ACTIVE_ID = '311a862b-dd15-4c44-90f1-fa95a7621860'
+SMALL_ID = 'af986ceb-6640-4b69-b722-42df633ed0b7'
+LARGE_ID = '5b9a0ef4-0a7a-4d0e-8d49-6f3b0b5d7e11'
+
+
+def setup_cache(path):
+    for image_id, size in ((ACTIVE_ID, 100), (SMALL_ID, 10), (LARGE_ID, 1000)):
+        image_path = os.path.join(path, 'ubuntu', 'precise', 'amd64', image_id)
+        os.makedirs(image_path)
+        with open(os.path.join(image_path, 'rootfs.tar.xz'), 'wb') as fp:
+            fp.write(b'x' * size)
+
+
+def run_list(path, *args):
+    with patch('changes_lxc_wrapper.cli.manager.ChangesApi') as mock_api_cls:
+        mock_api_cls.return_value.list_snapshots.return_value = [{
+            'project': {'id': PROJECT_ID},
+            'dateCreated': '2014-01-01T00:00:00.000000',
+            'isActive': image_id == ACTIVE_ID,
+            'images': [{'id': image_id}],
+        } for image_id in (ACTIVE_ID, SMALL_ID)]
+
+        stdout = io.StringIO()
+        with patch('sys.stdout', stdout):
+            command = ManagerCommand([
+                '--api-url', 'http://changes.example.com/api/0/',
+                '--cache-path', path,
+                'list',
+            ] + list(args))
+            command.run()
+    return stdout.getvalue()
+
+
+def test_parse_size_value():
+    assert parse_size_value('10') == 10
+    assert parse_size_value('2k') == 2048
+    assert parse_size_value('3MB') == 3 * 1024 * 1024
+    assert parse_size_value('1g') == 1024 * 1024 * 1024
+
+
+def test_list_jsonl(tmpdir):
+    setup_cache(str(tmpdir))
+
+    output = run_list(str(tmpdir), '--format', 'jsonl', '--sort', 'size', '--desc')
+    records = [json.loads(line) for line in output.splitlines()]
+    assert [r['id'] for r in records] == [LARGE_ID, ACTIVE_ID, SMALL_ID]
+
+    large, active, small = records
+    assert large['size'] == 1000
+    assert not large['is_valid']
+    # unknown snapshots go first, then the largest
+    assert large['eviction_priority'] == 1
+    assert small['eviction_priority'] == 2
+    assert active['eviction_priority'] is None
+    assert active['is_active']
+    assert active['project'] == PROJECT_ID
+    assert active['date_created'] == '2014-01-01T00:00:00'
+    assert active['hits'] == 0
+    assert active['last_access'] is None
+
+
+def test_list_filters(tmpdir):
+    setup_cache(str(tmpdir))
+
+    output = run_list(str(tmpdir), '--format', 'json', '--inactive',
+                      '--project', PROJECT_ID)
+    assert [r['id'] for r in json.loads(output)] == [SMALL_ID]
+
+    output = run_list(str(tmpdir), '--format', 'json', '--min-size', '50',
+                      '--sort', 'size', '--limit', '1')
+    assert [r['id'] for r in json.loads(output)] == [ACTIVE_ID]
+
+    output = run_list(str(tmpdir), '--format', 'json', '--invalid')
+    assert [r['id'] for r in json.loads(output)] == [LARGE_ID]
+
+
+def test_write_records():
+    records = [{field: None for field in LIST_FIELDS} for _ in range(2)]
+    records[0]['id'], records[1]['id'] = 'a', 'b'
+
+    stream = io.StringIO()
+    write_records(iter(records), 'csv', stream)
+    stream.seek(0)
+    assert [r['id'] for r in csv.DictReader(stream)] == ['a', 'b']
+
+    stream = io.StringIO()
+    write_records(iter([]), 'json', stream)
+    assert json.loads(stream.getvalue()) == []
+
+
+def test_list_priority_without_window_functions(tmpdir):
+    setup_cache(str(tmpdir))
+
+    # older SQLite (i.e. 3.8 on trusty) has no window functions
+    statements = []
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    with patch('changes_lxc_wrapper.metadata.sqlite3.connect', traced_connect):
+        # as SQLite sorts NULLs, active images come first
+        output = run_list(str(tmpdir), '--format', 'json', '--sort', 'priority',
+                          '--limit', '2')
+        records = json.loads(output)
+        assert [r['id'] for r in records] == [ACTIVE_ID, LARGE_ID]
+        assert [r['eviction_priority'] for r in records] == [None, 1]
+
+        output = run_list(str(tmpdir), '--format', 'json', '--sort', 'priority', '--desc')
+        assert [r['id'] for r in json.loads(output)] == [SMALL_ID, LARGE_ID, ACTIVE_ID]
+
+    assert statements
+    assert not [s for s in statements if ' OVER ' in s.upper()]
@@ -0,0 +1,18 @@
+import subprocess
+import sys
+
+# modules the CLIs must only load for commands which use them
+HEAVY_MODULES = ('raven', 'lxc', 'http.server')
+
+IMPORT_SCRIPT = """
+import sys
+import changes_lxc_wrapper.cli.{}
+print(' '.join(m for m in {!r} if m in sys.modules))
+"""
+
+
+def test_cli_imports_are_lazy():
+    for name in ('client', 'helper', 'manager', 'wrapper'):
+        output = subprocess.check_output([
+            sys.executable, '-c', IMPORT_SCRIPT.format(name, HEAVY_MODULES)])
+        assert output.decode('utf-8').strip() == '', name
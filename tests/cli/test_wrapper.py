@@ -1,9 +1,11 @@
 import threading
 
-from mock import patch
+import pytest
+
+from mock import ANY, Mock, patch
 from uuid import uuid4
 
-from changes_lxc_wrapper.cli.wrapper import WrapperCommand
+from changes_lxc_wrapper.cli.wrapper import CommandError, WrapperCommand
 
 
 def generate_jobstep_data():
@@ -39,6 +41,7 @@ def test_local_run(mock_run):
         post_launch=None,
         snapshot=None,
         save_snapshot=False,
+        parent_snapshot=None,
         s3_bucket=None,
         pre_launch=None,
         validate=True,
@@ -48,6 +51,7 @@ def test_local_run(mock_run):
         flush_cache=False,
         clean=False,
         keep=False,
+        limits={},
     )
 
 
@@ -72,6 +76,7 @@ def test_remote_run(mock_run, mock_api_cls):
         post_launch=None,
         snapshot='a1028849-e8cf-4ff0-a7d7-fdfe3c4fe925',
         save_snapshot=False,
+        parent_snapshot=None,
         s3_bucket=None,
         pre_launch=None,
         validate=True,
@@ -80,6 +85,7 @@ def test_remote_run(mock_run, mock_api_cls):
         flush_cache=False,
         clean=False,
         keep=False,
+        limits={},
     )
 
 
@@ -125,6 +131,7 @@ def test_non_default_release(mock_run, mock_api_cls):
         post_launch=None,
         snapshot='a1028849-e8cf-4ff0-a7d7-fdfe3c4fe925',
         save_snapshot=False,
+        parent_snapshot=None,
         s3_bucket=None,
         pre_launch=None,
         validate=True,
@@ -133,4 +140,100 @@ def test_non_default_release(mock_run, mock_api_cls):
         flush_cache=False,
         clean=False,
         keep=False,
+        limits={},
     )
+
+
+@patch('changes_lxc_wrapper.cli.wrapper.ChangesApi')
+@patch.object(WrapperCommand, 'run_build_script')
+def test_jobstep_limits(mock_run, mock_api_cls):
+    jobstep_id = uuid4()
+
+    jobstep_data = generate_jobstep_data()
+    jobstep_data['data']['memory_limit'] = '8G'
+    jobstep_data['data']['cpuset'] = 'auto'
+
+    mock_api = mock_api_cls.return_value
+    mock_api.get_jobstep.return_value = jobstep_data
+
+    command = WrapperCommand([
+        '--jobstep-id', jobstep_id.hex,
+        '--api-url', 'http://changes.example.com',
+        '--memory-limit', '4G',
+        '--cpu-shares', '512',
+    ])
+    command.run()
+
+    _, kwargs = mock_run.call_args
+    assert kwargs['limits'] == {
+        'cpu_shares': 512,
+        'cpuset': 'auto',
+        'memory_limit': '8G',
+    }
+
+
+@patch('changes_lxc_wrapper.cli.wrapper.ChangesApi')
+@patch.object(WrapperCommand, 'run_build_script', return_value=True)
+def test_deferred_snapshot(mock_run, mock_api_cls):
+    jobstep_id = uuid4()
+
+    mock_api = mock_api_cls.return_value
+    mock_api.get_jobstep.return_value = generate_jobstep_data()
+
+    command = WrapperCommand([
+        '--jobstep-id', jobstep_id.hex,
+        '--api-url', 'http://changes.example.com',
+        '--save-snapshot',
+    ])
+    command.run()
+
+    mock_api.update_jobstep.assert_called_with(jobstep_id.hex, {"status": "finished"})
+    # left to the post-build stages
+    assert not mock_api.update_snapshot_image.called
+
+    stages = command.get_post_build_stages(
+        container=Mock(), snapshot='snap', parent_snapshot=None, s3_bucket='bucket', keep=True)
+    assert [s[0] for s in stages] == ['create_image', 'upload', 'update_snapshot_image']
+    stages[-1][1](failed=True)
+    mock_api.update_snapshot_image.assert_called_once_with('snap', {"status": "failed"})
+
+
+@patch('changes_lxc_wrapper.container.Container')
+def test_cancel(mock_container_cls):
+    container = mock_container_cls.return_value
+
+    command = WrapperCommand()
+    container.run.side_effect = lambda cmd, user: command.cancel()
+
+    with pytest.raises(CommandError):
+        command.run_build_script(
+            snapshot=None, release='precise', validate=True, s3_bucket=None,
+            pre_launch=None, post_launch=None, clean=False, flush_cache=False,
+            save_snapshot=True, user='ubuntu', cmd=['make'])
+
+    # only the wrapper owns (and so reaps) the containers it launches
+    _, kwargs = container.launch.call_args
+    assert kwargs['owned']
+    container.kill.assert_called_once_with(signalled_at=ANY)
+    # nothing is saved from a cancelled build
+    assert not container.create_image.called
+    container.destroy.assert_called_once_with()
+    assert command.container is None
+
+
+@patch('changes_lxc_wrapper.container.Container')
+def test_deferred_stages_skip_reporter(mock_container_cls):
+    container = mock_container_cls.return_value
+
+    command = WrapperCommand()
+    command.reporter = Mock()
+    command.pipeline = Mock()
+
+    assert command.run_build_script(
+        snapshot=None, release='precise', validate=True, s3_bucket=None,
+        pre_launch=None, post_launch=None, clean=True, flush_cache=False,
+        save_snapshot=True, user='ubuntu', cmd=['make'])
+
+    assert command.pipeline.submit.called
+    assert container.log_reporter is None
+    assert not container.destroy.called
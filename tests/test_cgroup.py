@@ -0,0 +1,116 @@
+from io import StringIO
+from mock import Mock
+
+from changes_lxc_wrapper.cgroup import (
+    CgroupSampler, get_limit_config, get_numa_nodes, parse_limits, percentile
+)
+
+
+def test_percentile():
+    values = [5, 1, 4, 2, 3]
+    assert percentile(values, 50) == 3
+    assert percentile(values, 95) == 5
+    assert percentile(values, 0) == 1
+    assert percentile([], 50) is None
+
+
+def test_sampler_ring_buffer_and_summary():
+    state = {
+        'cpuacct.usage': 0,
+        'memory.usage_in_bytes': 0,
+        'blkio.throttle.io_service_bytes': 0,
+        'pids.current': 1,
+        'memory.failcnt': 5,
+        'cpu.stat': 3,
+    }
+
+    def get_cgroup_item(key):
+        value = state[key]
+        if key == 'blkio.throttle.io_service_bytes':
+            return '8:0 Read {}\n8:0 Write 0\nTotal {}'.format(value, value)
+        if key == 'cpu.stat':
+            return 'nr_periods 10\nnr_throttled {}\nthrottled_time 0'.format(value)
+        return str(value)
+
+    container = Mock()
+    container.running = True
+    container.get_cgroup_item.side_effect = get_cgroup_item
+
+    stream = StringIO()
+    sampler = CgroupSampler(container, size=3, stream=stream)
+    for n in range(5):
+        state['cpuacct.usage'] = n * 10 ** 9
+        state['memory.usage_in_bytes'] = n * 100
+        state['blkio.throttle.io_service_bytes'] = n * 1000
+        state['pids.current'] = n + 1
+        if n == 3:
+            state['memory.failcnt'] = 7
+            state['cpu.stat'] = 7
+        sampler.sample()
+
+    assert len(sampler.samples) == 3
+    summary = sampler.summary()
+    assert summary['samples'] == 3
+    assert summary['memory_peak_bytes'] == 400
+    assert summary['pids_peak'] == 5
+    assert summary['io_read_bytes'] == 2000
+    assert summary['memory_failcnt'] == 2
+    assert summary['nr_throttled'] == 4
+    assert summary['cpu_peak_cores'] > 0
+
+    output = stream.getvalue()
+    assert 'Memory pressure: container hit its memory limit 2 times' in output
+    assert 'CPU throttled: 4 periods' in output
+
+
+
+def test_sampler_ignores_earlier_failures():
+    container = Mock()
+    container.running = True
+    container.get_cgroup_item.side_effect = lambda key: {
+        'memory.failcnt': '5',
+        'cpu.stat': 'nr_throttled 3',
+    }.get(key, '0')
+
+    sampler = CgroupSampler(container, stream=StringIO())
+    sampler.sample()
+    sampler.sample()
+
+    summary = sampler.summary()
+    assert 'memory_failcnt' not in summary
+    assert 'nr_throttled' not in summary
+
+def test_get_numa_nodes(tmpdir):
+    for node, cpulist in ((0, '0-7'), (1, '8-15')):
+        tmpdir.mkdir('node{}'.format(node)).join('cpulist').write(cpulist + '\n')
+    tmpdir.mkdir('power')
+
+    assert get_numa_nodes(str(tmpdir)) == {0: '0-7', 1: '8-15'}
+    assert get_numa_nodes(str(tmpdir.join('missing'))) == {}
+
+
+def test_limit_config_auto_cpuset():
+    busy = Mock()
+    busy.get_cgroup_item.return_value = '0'
+    unpinned = Mock()
+    unpinned.get_cgroup_item.return_value = '0-1'
+
+    nodes = {0: '0-7', 1: '8-15'}
+    config = get_limit_config({
+        'cpu_shares': 512,
+        'cpuset': 'auto',
+        'memory_limit': '4G',
+    }, nodes, [busy, unpinned])
+
+    assert config == [
+        ('lxc.cgroup.cpu.shares', '512'),
+        ('lxc.cgroup.cpuset.cpus', '8-15'),
+        ('lxc.cgroup.cpuset.mems', '1'),
+        ('lxc.cgroup.memory.limit_in_bytes', '4G'),
+    ]
+
+
+def test_parse_limits():
+    assert parse_limits({'release': 'precise', 'cpu_shares': None, 'blkio_weight': 100}) == {
+        'blkio_weight': 100,
+    }
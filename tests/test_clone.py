@@ -0,0 +1,68 @@
+import os
+
+from mock import patch
+
+from changes_lxc_wrapper.clone import (
+    BtrfsBackend, OverlayBackend, ReflinkBackend, ZfsBackend, get_clone_backend,
+    get_mount
+)
+from changes_lxc_wrapper.rootfs_cache import ORIGIN_FILE, RootfsCache
+
+
+def test_get_mount(tmpdir):
+    mounts = tmpdir.join('mounts')
+    mounts.write(
+        '/dev/sda1 / ext4 rw 0 0\n'
+        'tank/lxc /var/cache/lxc zfs rw 0 0\n'
+        '/dev/sdb1 /mnt/my\\040disk btrfs rw 0 0\n'
+    )
+    with patch('os.path.realpath', lambda path: path), \
+            patch('os.path.exists', lambda path: True):
+        assert get_mount('/var/cache/lxc/download/rootfs', str(mounts)) == \
+            ('tank/lxc', '/var/cache/lxc', 'zfs')
+        assert get_mount('/var/cache/lxcfoo', str(mounts))[2] == 'ext4'
+        assert get_mount('/mnt/my disk/a', str(mounts))[2] == 'btrfs'
+
+
+@patch('changes_lxc_wrapper.clone.shutil.which', lambda name: '/sbin/' + name)
+def test_get_clone_backend(tmpdir):
+    path = str(tmpdir)
+    assert isinstance(get_clone_backend(path, 'reflink'), ReflinkBackend)
+
+    for fstype, backend_cls in (('btrfs', BtrfsBackend), ('zfs', ZfsBackend),
+                                ('ext4', OverlayBackend)):
+        with patch('changes_lxc_wrapper.clone.get_mount', return_value=('', '/', fstype)):
+            assert isinstance(get_clone_backend(path), backend_cls)
+            assert isinstance(get_clone_backend(path, 'auto'), backend_cls)
+
+
+def test_add_clone(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('hostname').write('built')
+
+    lxc_path = tmpdir.mkdir('lxc')
+    cache = RootfsCache(str(tmpdir.join('cache')), lxc_path=str(lxc_path))
+
+    def populate(rootfs):
+        os.symlink(str(src), rootfs)
+
+    entry = cache.add('snap', ['snap'], populate)
+    assert entry.chain == ['snap']
+    with open(os.path.join(entry.rootfs, 'hostname')) as fp:
+        assert fp.read() == 'built'
+
+    # a container cloned from the entry, rather than overlaid on it
+    lxc_path.mkdir('clone').join(ORIGIN_FILE).write(entry.rootfs)
+    assert cache.get_users(entry) == ['clone']
+
+
+@patch('changes_lxc_wrapper.clone.subprocess.check_call')
+@patch('changes_lxc_wrapper.clone.get_mount', return_value=('pool/lxc', '/var/lib/lxc', 'zfs'))
+def test_zfs_copy_rootfs(mock_get_mount, mock_check_call):
+    ZfsBackend().copy_rootfs('/var/lib/lxc/job/rootfs', '/var/lib/lxc/cache/rootfs')
+
+    # a new dataset, rather than a clone of a snapshot of the container's
+    (create,), (copy,) = [c[0] for c in mock_check_call.call_args_list]
+    assert create[:2] == ['zfs', 'create']
+    assert create[-1].startswith('pool/lxc/rootfs-')
+    assert copy == ['cp', '-a', '/var/lib/lxc/job/rootfs/.', '/var/lib/lxc/cache/rootfs']
@@ -0,0 +1,87 @@
+import fcntl
+import os
+
+import pytest
+
+from mock import patch
+
+from changes_lxc_wrapper.container import NUMA_LOCK_FILE, Container
+
+
+def attach_wait(self, run, args, **kwargs):
+    return run(args)
+
+
+@patch('changes_lxc_wrapper.metrics.read_cgroup_stats', lambda container: {})
+@patch.object(Container, 'attach_wait', attach_wait)
+@patch.object(Container, 'running', True)
+def test_run_batch(tmpdir):
+    container = Container('test')
+    cwd = str(tmpdir)
+
+    results = container.run_batch([
+        {'cmd': ['sh', '-c', 'echo "$FOO" > foo'], 'cwd': cwd, 'env': {'FOO': 'bar'}},
+        {'cmd': ['sh', '-c', 'pwd > pwd; exit 3'], 'cwd': cwd, 'fail_fast': False},
+        {'cmd': ['sh', '-c', 'exit 4'], 'cwd': cwd},
+        ['touch', os.path.join(cwd, 'skipped')],
+    ])
+
+    assert [r['returncode'] for r in results] == [0, 3, 4, None]
+    assert results[3]['cmd'] == ['touch', os.path.join(cwd, 'skipped')]
+    assert all(r['duration'] >= 0 for r in results[:3])
+    assert tmpdir.join('foo').read() == 'bar\n'
+    assert tmpdir.join('pwd').read() == cwd + '\n'
+    assert not tmpdir.join('skipped').check()
+
+    results = container.run_batch([['false'], ['true']], fail_fast=False)
+    assert [r['returncode'] for r in results] == [1, 0]
+
+
+@patch('changes_lxc_wrapper.metrics.read_cgroup_stats', lambda container: {})
+@patch.object(Container, 'attach_wait', lambda self, run, args, **kwargs: 1)
+@patch.object(Container, 'running', True)
+def test_run_batch_attach_failed(tmpdir):
+    container = Container('test')
+
+    with pytest.raises(AssertionError):
+        container.run_batch([['true']])
+
+
+@patch('changes_lxc_wrapper.metrics.read_cgroup_stats', lambda container: {})
+@patch.object(Container, 'attach_wait', attach_wait)
+@patch.object(Container, 'running', True)
+def test_run(tmpdir):
+    container = Container('test')
+    assert container.run(['sh', '-c', 'exit 2'], cwd=str(tmpdir)) == 2
+    assert container.run(['/nonexistent'], cwd=str(tmpdir)) == 127
+
+
+@patch.object(Container, 'wait', create=True)
+@patch.object(Container, 'unfreeze', create=True)
+@patch.object(Container, 'freeze', create=True, return_value=True)
+@patch.object(Container, 'init_pid', 1234, create=True)
+@patch.object(Container, 'running', True)
+@patch('changes_lxc_wrapper.container.os.kill')
+def test_kill(mock_kill, mock_freeze, mock_unfreeze, mock_wait):
+    container = Container('test')
+    record = container.kill(signalled_at=0)
+
+    mock_freeze.assert_called_once_with()
+    mock_kill.assert_called_once_with(1234, 9)
+    mock_unfreeze.assert_called_once_with()
+    mock_wait.assert_called_once_with('STOPPED', timeout=30)
+    assert record['phase'] == 'cancel'
+    assert 0 < record['cpu_released'] <= record['stopped']
+    assert container.metrics.phases == [record]
+
+
+def test_lock_numa_node(tmpdir):
+    container = Container('test')
+    assert container.lock_numa_node({'cpuset': '0-3'}, str(tmpdir)) is None
+
+    lock = container.lock_numa_node({'cpuset': 'auto'}, str(tmpdir))
+    with open(str(tmpdir.join(NUMA_LOCK_FILE))) as fp:
+        with pytest.raises(BlockingIOError):
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        lock.close()
+        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
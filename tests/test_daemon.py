@@ -0,0 +1,97 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from changes_lxc_wrapper.daemon import HelperDaemon, forward
+
+SERVE_SCRIPT = """
+import os
+import subprocess
+import sys
+from changes_lxc_wrapper.daemon import HelperDaemon
+
+class Command(object):
+    prepared = 0
+
+    def prepare(self, argv):
+        self.prepared += 1
+
+    def execute(self, argv):
+        if argv[0] == 'fail':
+            assert False, 'Broken'
+        if argv[0] == 'exit':
+            sys.exit(int(argv[1]))
+        print('prepared', self.prepared, os.getcwd(), os.environ.get('NAME'))
+        sys.stdout.flush()
+        subprocess.check_call(['echo', 'from child'])
+
+server = HelperDaemon(sys.argv[1], Command())
+print('ready', flush=True)
+server.serve_forever()
+"""
+
+
+@pytest.fixture
+def daemon(request, tmpdir):
+    path = str(tmpdir.join('helper.sock'))
+    proc = subprocess.Popen([sys.executable, '-c', SERVE_SCRIPT, path],
+                            stdout=subprocess.PIPE)
+    assert proc.stdout.readline() == b'ready\n'
+
+    def stop():
+        proc.kill()
+        proc.wait()
+    request.addfinalizer(stop)
+
+    return path
+
+
+def run(path, argv, **kwargs):
+    read_fd, write_fd = os.pipe()
+    with open(os.devnull) as devnull:
+        try:
+            returncode = forward(path, argv, (devnull.fileno(), write_fd, write_fd),
+                                 **kwargs)
+        finally:
+            os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        return returncode, fp.read()
+
+
+def test_forward(daemon, tmpdir):
+    returncode, output = run(daemon, ['exec'], cwd=str(tmpdir), env={'NAME': 'x'})
+    assert returncode == 0
+    assert output == 'prepared 1 {} x\nfrom child\n'.format(tmpdir)
+
+    # state kept by the daemon survives between requests
+    returncode, output = run(daemon, ['exec'], cwd=str(tmpdir), env={})
+    assert output.startswith('prepared 2 ')
+
+
+def test_forward_errors(daemon):
+    returncode, output = run(daemon, ['exit', '3'])
+    assert returncode == 3
+
+    returncode, output = run(daemon, ['fail'])
+    assert returncode == 1
+    assert 'AssertionError: Broken' in output
+
+
+def test_no_daemon(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        forward(str(tmpdir.join('missing.sock')), ['exec'])
+
+
+def test_socket_permissions(tmpdir):
+    path = str(tmpdir.join('helper.sock'))
+    umask = os.umask(0o022)
+    try:
+        server = HelperDaemon(path, None)
+        server.server_close()
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
+
+    assert os.stat(path).st_mode & 0o777 == 0o600
@@ -3,6 +3,7 @@ from time import sleep
 from threading import Thread
 from uuid import uuid4
 
+from changes_lxc_wrapper.api import BuildCancelled
 from changes_lxc_wrapper.heartbeat import Heartbeater
 
 
@@ -44,3 +45,28 @@ def test_simple():
 
     heartbeater.close()
     heartbeat_thread.join()
+
+
+def test_cancelled():
+    mock_api = Mock()
+    mock_api.get_jobstep.side_effect = BuildCancelled
+
+    heartbeater = Heartbeater(mock_api, uuid4())
+    heartbeater.wait()
+
+    assert heartbeater.cancelled.is_set()
+
+
+def test_closed():
+    mock_api = Mock()
+    mock_api.get_jobstep.return_value = {
+        'status': {'id': 'in_progress'}
+    }
+
+    heartbeater = Heartbeater(mock_api, uuid4())
+    heartbeat_thread = Thread(target=heartbeater.wait)
+    heartbeat_thread.start()
+    heartbeater.close()
+    heartbeat_thread.join()
+
+    assert not heartbeater.cancelled.is_set()
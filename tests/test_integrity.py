@@ -0,0 +1,94 @@
+import hashlib
+import io
+import lzma
+import os
+
+import pytest
+
+from changes_lxc_wrapper.image_store import LocalImageStore
+from changes_lxc_wrapper.integrity import (
+    IntegrityError, VerificationCache, copy_hashed, copy_verified,
+    describe_file, verify_image
+)
+from changes_lxc_wrapper.layers import ChunkStore
+
+
+def test_copy_hashed(tmpdir):
+    data = os.urandom(3 * 1024 * 1024)
+    dest = str(tmpdir.join('out'))
+    size, sha256 = copy_hashed(io.BytesIO(data), dest)
+    assert size == len(data)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert describe_file(dest) == {'size': size, 'sha256': sha256}
+
+
+def test_copy_verified(tmpdir):
+    data = b'hello world'
+    dest = str(tmpdir.join('out'))
+
+    with pytest.raises(IntegrityError):
+        copy_verified(io.BytesIO(data[:5]), dest, hashlib.sha256(data).hexdigest())
+    assert os.listdir(str(tmpdir)) == []
+
+    copy_verified(io.BytesIO(data), dest, hashlib.sha256(data).hexdigest())
+    with open(dest, 'rb') as fp:
+        assert fp.read() == data
+
+    copy_verified(io.BytesIO(lzma.compress(data)), dest,
+                  hashlib.sha256(data).hexdigest(), decompress=True)
+    with open(dest, 'rb') as fp:
+        assert lzma.decompress(fp.read()) == data
+
+
+def test_verify_image(tmpdir):
+    path = str(tmpdir)
+    with open(os.path.join(path, 'rootfs.tar.xz'), 'wb') as fp:
+        fp.write(b'x' * 1000)
+    manifest = {'files': {'rootfs.tar.xz': describe_file(os.path.join(path, 'rootfs.tar.xz'))}}
+
+    assert verify_image(path, manifest) == []
+    assert 'rootfs.tar.xz' in VerificationCache(path).data
+
+    # corrupt in place, keeping the size
+    with open(os.path.join(path, 'rootfs.tar.xz'), 'r+b') as fp:
+        fp.write(b'y')
+    assert verify_image(path, manifest, rehash=False) == []
+    assert verify_image(path, manifest) == ['rootfs.tar.xz']
+
+    # truncation is caught without hashing
+    with open(os.path.join(path, 'rootfs.tar.xz'), 'wb') as fp:
+        fp.write(b'x' * 10)
+    assert verify_image(path, manifest, rehash=False) == ['rootfs.tar.xz']
+
+    os.unlink(os.path.join(path, 'rootfs.tar.xz'))
+    assert verify_image(path, manifest, rehash=False) == ['rootfs.tar.xz']
+
+
+def test_verify_image_uses_cache(tmpdir, monkeypatch):
+    path = str(tmpdir)
+    with open(os.path.join(path, 'config'), 'w') as fp:
+        fp.write('lxc.arch = x86_64\n')
+    manifest = {'files': {'config': describe_file(os.path.join(path, 'config'))}}
+    assert verify_image(path, manifest) == []
+
+    def fail(path):
+        raise AssertionError('should not re-hash')
+
+    monkeypatch.setattr('changes_lxc_wrapper.integrity.hash_file', fail)
+    assert verify_image(path, manifest) == []
+
+
+def test_get_chunks_rejects_corrupt(tmpdir):
+    local = ChunkStore(str(tmpdir.join('local')))
+    entry = local.add(b'chunk' * 100)
+
+    remote = LocalImageStore(str(tmpdir.join('remote')))
+    remote.put_chunks(local, [entry])
+    with open(remote.get_path(local.get_key(entry['id'])), 'wb') as fp:
+        fp.write(lzma.compress(b'other'))
+
+    other = ChunkStore(str(tmpdir.join('other')))
+    with pytest.raises(IntegrityError):
+        remote.get_chunks(other, [entry])
+    assert other.missing([entry]) == [entry]
+    assert other.get_sizes() == {}
@@ -0,0 +1,92 @@
+import io
+import lzma
+import os
+import tarfile
+
+from changes_lxc_wrapper import layers
+from changes_lxc_wrapper.image_store import LocalImageStore
+from changes_lxc_wrapper.layers import (
+    ChunkStore, read_manifest, split_archive, write_manifest
+)
+
+
+def make_archive(files):
+    fp = io.BytesIO()
+    with tarfile.open(fileobj=fp, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return fp.getvalue()
+
+
+def make_files(count, changed=None):
+    files = []
+    for n in range(count):
+        data = os.urandom(3000) if n == changed else bytes([n % 256]) * 3000
+        files.append(('dir/{}/file-{}'.format('x' * (n % 3) * 60, n), data))
+    return files
+
+
+def setup_module(module):
+    module._sizes = layers.MIN_CHUNK_SIZE, layers.MAX_CHUNK_SIZE
+    layers.MIN_CHUNK_SIZE = 8 * 1024
+    layers.MAX_CHUNK_SIZE = 64 * 1024
+
+
+def teardown_module(module):
+    layers.MIN_CHUNK_SIZE, layers.MAX_CHUNK_SIZE = module._sizes
+
+
+def test_split_archive_roundtrip():
+    files = make_files(200) + [('big', os.urandom(200 * 1024))]
+    archive = make_archive(files)
+
+    chunks = list(split_archive(io.BytesIO(archive)))
+
+    assert len(chunks) > 1
+    assert b''.join(chunks) == archive
+    assert max(len(c) for c in chunks) <= layers.MAX_CHUNK_SIZE
+
+
+def test_split_archive_dedupes_unchanged_files():
+    before = list(split_archive(io.BytesIO(make_archive(make_files(400)))))
+    after = list(split_archive(io.BytesIO(make_archive(make_files(400, changed=200)))))
+
+    shared = set(before) & set(after)
+    assert len(after) > 4
+    assert len(after) - len(shared) <= 2
+
+
+def test_chunk_store_assemble(tmpdir):
+    archive = make_archive(make_files(200))
+    store = ChunkStore(str(tmpdir.join('chunks')))
+
+    entries = [store.add(c) for c in split_archive(io.BytesIO(archive))]
+    assert all(e['created'] for e in entries)
+    assert not any(store.add(c)['created'] for c in split_archive(io.BytesIO(archive)))
+
+    dest = str(tmpdir.join('rootfs.tar.xz'))
+    store.assemble(entries, dest)
+    with open(dest, 'rb') as fp:
+        assert lzma.decompress(fp.read()) == archive
+
+    write_manifest(str(tmpdir), {'chunks': entries})
+    assert read_manifest(str(tmpdir)) == {'chunks': entries}
+    assert read_manifest(str(tmpdir.join('missing'))) is None
+
+
+def test_local_image_store_chunks(tmpdir):
+    archive = make_archive(make_files(100))
+    local = ChunkStore(str(tmpdir.join('local')))
+    entries = [local.add(c) for c in split_archive(io.BytesIO(archive))]
+
+    remote = LocalImageStore(str(tmpdir.join('remote')))
+    remote.put_chunks(local, entries)
+    assert all(remote.exists(local.get_key(e['id'])) for e in entries)
+
+    other = ChunkStore(str(tmpdir.join('other')))
+    assert other.missing(entries) == entries
+    remote.get_chunks(other, entries)
+    assert other.missing(entries) == []
+    assert other.get_sizes() == local.get_sizes()
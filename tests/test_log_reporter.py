@@ -2,7 +2,7 @@ from mock import call, Mock
 from threading import Thread
 from uuid import uuid4
 
-from changes_lxc_wrapper.log_reporter import LogReporter
+from changes_lxc_wrapper.log_reporter import LineCollapser, LogReporter
 
 
 def test_line_buffering():
@@ -30,3 +30,110 @@ def test_line_buffering():
             'source': 'console',
         }),
     ]
+
+
+def test_byte_streams():
+    mock_api = Mock()
+    jobstep_id = uuid4()
+
+    reporter = LogReporter(mock_api, jobstep_id)
+    reporter_thread = Thread(target=reporter.process)
+    reporter_thread.start()
+
+    snowman = '☃'.encode('utf-8')
+    reporter.write(b'hello ' + snowman[:1])
+    reporter.write(snowman[1:] + b'\n')
+    reporter.write(b'oops\n', stream='stderr')
+
+    reporter.close()
+    reporter_thread.join()
+
+    assert mock_api.mock_calls == [
+        call.append_log(jobstep_id, {
+            'text': 'hello ☃\n',
+            'source': 'console',
+        }),
+        call.append_log(jobstep_id, {
+            'text': 'oops\n',
+            'source': 'console.stderr',
+        }),
+    ]
+
+
+def test_collapse_carriage_returns():
+    collapser = LineCollapser(window=5)
+
+    assert collapser.feed('Downloading  0%', now=100) == ''
+    for pct in range(1, 100):
+        assert collapser.feed('\rDownloading {:2}%'.format(pct), now=100) == ''
+    assert collapser.feed('\rDone\n', now=101) == 'Doneloading 99%\n'
+
+    # crlf line endings keep the line
+    assert collapser.feed('ok\r', now=102) == ''
+    assert collapser.feed('\n', now=102) == 'ok\n'
+
+
+def test_collapse_flush_window():
+    collapser = LineCollapser(window=5)
+
+    assert collapser.feed('50%', now=100) == ''
+    assert collapser.flush(now=104) == ''
+    assert collapser.flush(now=105) == '50%'
+    # nothing new to send
+    assert collapser.flush(now=110) == ''
+
+    # what was sent can only be overwritten
+    assert collapser.feed('\r60%', now=111) == '\r'
+    assert collapser.feed('\r70%', now=112) == ''
+    assert collapser.flush(now=116) == '70%\r'
+    assert collapser.feed('\r100%', now=117) == ''
+    assert collapser.flush(final=True) == '100%'
+
+
+def test_collapse_growing_line():
+    collapser = LineCollapser(window=5)
+    collapser.max_line = 100
+
+    sent = ''
+    for n in range(600):
+        sent += collapser.feed('.', now=1000 + n)
+        sent += collapser.flush(now=1000 + n)
+        assert len(collapser.line) <= 5
+    sent += collapser.feed(' ok\n', now=1600)
+
+    # only what the line grew by is sent each window
+    assert sent == '.' * 600 + ' ok\n'
+
+    # even within a window, only so much of a line is held
+    assert collapser.feed('x' * 150, now=1601) == 'x' * 150
+    assert collapser.line == ''
+
+
+def test_collapse_repeats():
+    collapser = LineCollapser(window=5, repeat_limit=2)
+
+    assert collapser.feed('waiting\n' * 10, now=100) == 'waiting\n' * 3
+    assert collapser.flush(now=101) == ''
+    assert collapser.flush(now=105) == '==> Previous line repeated 7 more times\n'
+    assert collapser.feed('waiting\nready\n', now=106) == \
+        '==> Previous line repeated 1 more times\nready\n'
+
+
+def test_raw_copy(tmpdir):
+    mock_api = Mock()
+    jobstep_id = uuid4()
+
+    reporter = LogReporter(mock_api, jobstep_id, raw_dir=str(tmpdir))
+    reporter_thread = Thread(target=reporter.process)
+    reporter_thread.start()
+
+    reporter.write(b'\xff 10%\r 20%\r')
+    reporter.write(b' done\n')
+    reporter.write('==> Running\n')
+
+    reporter.close()
+    reporter_thread.join()
+
+    assert ''.join(c[1][1]['text'] for c in mock_api.mock_calls) == ' done\n==> Running\n'
+    assert tmpdir.join('{}.stdout.log'.format(jobstep_id)).read_binary() == \
+        b'\xff 10%\r 20%\r done\n==> Running\n'
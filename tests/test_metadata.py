@@ -0,0 +1,171 @@
+import os
+
+from argparse import Namespace
+from mock import Mock
+from subprocess import check_call
+from uuid import UUID
+
+from changes_lxc_wrapper.cli.manager import ManagerCommand
+from changes_lxc_wrapper.metadata import METADATA_FILE, MetadataStore
+from changes_lxc_wrapper.snapshot_cache import SnapshotCache
+
+
+CACHE_PATH = '/tmp/changes-lxc-wrapper-metadata-test'
+
+PROJECT_ID = 'b4c2a2c6-8b5f-4b8a-9a8e-0f7f1b1f5e2a'
+SNAPSHOT_1_ID = '311a862b-dd15-4c44-90f1-fa95a7621860'
+SNAPSHOT_2_ID = 'af986ceb-6640-4b69-b722-42df633ed0b7'
+
+
+def get_api(active=SNAPSHOT_1_ID):
+    api = Mock()
+    api.list_snapshots.return_value = [{
+        'id': image_id,
+        'project': {'id': PROJECT_ID},
+        'dateCreated': '2014-01-0{}T00:00:00.000000'.format(n),
+        'isActive': image_id == active,
+        'images': [{'id': image_id}],
+    } for n, image_id in enumerate((SNAPSHOT_1_ID, SNAPSHOT_2_ID), 1)]
+    return api
+
+
+def setup_cache(path):
+    check_call(['rm', '-rf', path])
+    for image_id, size in ((SNAPSHOT_1_ID, 5), (SNAPSHOT_2_ID, 50)):
+        image_path = '{}/ubuntu/precise/amd64/{}'.format(path, image_id)
+        os.makedirs(image_path)
+        with open(os.path.join(image_path, 'rootfs.tar.xz'), 'wb') as fp:
+            fp.write(b'x' * size)
+
+
+def test_metadata_store(tmpdir):
+    store = MetadataStore(str(tmpdir.join('cache', METADATA_FILE)))
+    store.record_image(SNAPSHOT_1_ID, '/a', dir_size=10, size=10, chunks=['b', 'a'])
+    store.record_image(SNAPSHOT_2_ID, '/b', dir_size=20, size=20)
+    store.record_access(SNAPSHOT_1_ID)
+    store.record_access(SNAPSHOT_1_ID)
+    # updates keep fields which aren't given
+    store.record_image(SNAPSHOT_1_ID, '/a', is_active=1)
+
+    rows = list(store.query(order_by='size DESC'))
+    assert [r['id'] for r in rows] == [SNAPSHOT_2_ID, SNAPSHOT_1_ID]
+    assert rows[1]['hits'] == 2
+    assert rows[1]['chunks'] == ['a', 'b']
+    assert rows[1]['is_active'] == 1
+    assert rows[1]['dir_size'] == 10
+
+    assert [r['id'] for r in store.query('size < ?', (15,))] == [SNAPSHOT_1_ID]
+
+    store.add_chunks([{'id': 'a', 'compressed_size': 3}])
+    assert store.get_chunk_sizes() == {'a': 3}
+
+    assert store.get_state('reconciled') is None
+    store.set_state('reconciled', 12.5)
+    assert store.get_state('reconciled') == 12.5
+
+
+def test_snapshot_cache_uses_metadata():
+    setup_cache(CACHE_PATH)
+
+    api = get_api()
+    cache = SnapshotCache(CACHE_PATH, api)
+    cache.initialize()
+    assert api.list_snapshots.call_count == 1
+    assert cache.total_size == 55
+    assert [s.id for s in cache.query(order_by='size DESC')] == [
+        UUID(SNAPSHOT_2_ID), UUID(SNAPSHOT_1_ID)]
+
+    # a launch records its image; the next run picks it up without walking
+    # the cache or asking upstream
+    new_id = '5b9a0ef4-0a7a-4d0e-8d49-6f3b0b5d7e11'
+    cache.metadata.record_image(new_id, '/nonexistent', dir_size=500, is_known=1)
+    cache.metadata.record_access(new_id)
+
+    cache = SnapshotCache(CACHE_PATH, api)
+    cache.initialize()
+    assert api.list_snapshots.call_count == 1
+    assert cache.total_size == 555
+    new = cache.query('id = ?', (new_id,))[0]
+    assert new.hits == 1
+    assert new.size == 500
+    assert next(cache.metadata.query('id = ?', (new_id,)))['size'] == 500
+
+    # removal is reflected in the metadata
+    cache.remove(cache.query('id = ?', (SNAPSHOT_2_ID,))[0])
+    assert [r['id'] for r in cache.metadata.query(order_by='size')] == [
+        SNAPSHOT_1_ID, new_id]
+
+    # reconciling drops images which are no longer on disk
+    cache = SnapshotCache(CACHE_PATH, api, reconcile=True)
+    cache.initialize()
+    assert api.list_snapshots.call_count == 2
+    assert [s.id for s in cache.snapshots] == [UUID(SNAPSHOT_1_ID)]
+    assert cache.snapshots[0].is_active
+    assert cache.snapshots[0].is_valid
+
+
+def test_snapshot_cache_refreshes_upstream():
+    setup_cache(CACHE_PATH)
+
+    cache = SnapshotCache(CACHE_PATH, get_api())
+    cache.initialize()
+
+    api = get_api(active=SNAPSHOT_2_ID)
+    cache = SnapshotCache(CACHE_PATH, api)
+    cache.upstream_interval = 0
+    cache.initialize()
+    assert api.list_snapshots.call_count == 1
+    snapshots = {str(s.id): s for s in cache.snapshots}
+    assert snapshots[SNAPSHOT_2_ID].is_active
+    assert not snapshots[SNAPSHOT_1_ID].is_active
+
+
+def test_snapshot_cache_refreshes_new_images():
+    setup_cache(CACHE_PATH)
+
+    cache = SnapshotCache(CACHE_PATH, get_api())
+    cache.initialize()
+
+    # a launch downloads an image which upstream already knows is active
+    new_id = '5b9a0ef4-0a7a-4d0e-8d49-6f3b0b5d7e11'
+    api = get_api(active=new_id)
+    api.list_snapshots.return_value.append({
+        'id': new_id,
+        'project': {'id': PROJECT_ID},
+        'dateCreated': '2014-01-03T00:00:00.000000',
+        'isActive': True,
+        'images': [{'id': new_id}],
+    })
+    cache.metadata.record_image(new_id, '/nonexistent', dir_size=500)
+
+    cache = SnapshotCache(CACHE_PATH, api)
+    cache.initialize()
+    assert api.list_snapshots.call_count == 1
+    new = cache.query('id = ?', (new_id,))[0]
+    assert new.is_active
+    assert new.is_valid
+
+    # nothing new since, so no refresh until the interval passes
+    cache = SnapshotCache(CACHE_PATH, api)
+    cache.initialize()
+    assert api.list_snapshots.call_count == 1
+
+
+def test_cleanup_refreshes_upstream():
+    setup_cache(CACHE_PATH)
+
+    cache = SnapshotCache(CACHE_PATH, get_api())
+    cache.initialize()
+
+    # snapshot 2 became active since, within the refresh interval
+    cache = SnapshotCache(CACHE_PATH, get_api(active=SNAPSHOT_2_ID))
+    cache.initialize()
+    assert not cache.api.list_snapshots.called
+
+    ManagerCommand().run_cleanup(cache, Namespace(
+        dry_run=False, ttl=None, max_disk=0, max_disk_per_class=None,
+        max_rootfs_disk=None, max_package_disk=None, max_workspace_size=None,
+        max_workspace_disk=None))
+
+    assert cache.api.list_snapshots.call_count == 1
+    assert [str(s.id) for s in cache.snapshots] == [SNAPSHOT_2_ID]
@@ -0,0 +1,59 @@
+import json
+import pytest
+
+from mock import Mock
+
+from changes_lxc_wrapper.metrics import PhaseRecorder
+
+
+def test_phase_records_file(tmpdir):
+    path = str(tmpdir.join('metrics.jsonl'))
+    recorder = PhaseRecorder(path)
+
+    with recorder.phase('download', snapshot='abc') as record:
+        record['bytes'] = 10
+        with recorder.phase('extract'):
+            pass
+
+    with pytest.raises(ValueError):
+        with recorder.phase('launch'):
+            raise ValueError
+
+    with open(path) as fp:
+        lines = [json.loads(l) for l in fp]
+
+    assert [l['phase'] for l in lines] == ['extract', 'download', 'launch']
+    assert lines[0]['depth'] == 1
+    assert lines[1]['depth'] == 0
+    assert lines[1]['bytes'] == 10
+    assert lines[1]['snapshot'] == 'abc'
+    assert lines[1]['wall_time'] >= 0
+    assert lines[2]['failed']
+    assert recorder.phases == lines
+
+
+def test_phase_cgroup_counters():
+    values = {
+        'cpuacct.usage': ['100', '350'],
+        'memory.usage_in_bytes': ['10', '20'],
+        'memory.max_usage_in_bytes': ['30', '40'],
+        'blkio.throttle.io_service_bytes': [
+            '8:0 Read 5\n8:0 Write 7\nTotal 12',
+            '8:0 Read 15\n8:0 Write 7\n8:16 Write 3\nTotal 25',
+        ],
+    }
+
+    container = Mock()
+    container.running = True
+    container.get_cgroup_item.side_effect = lambda key: values[key].pop(0)
+
+    recorder = PhaseRecorder()
+    with recorder.phase('run', container=container):
+        pass
+
+    record = recorder.phases[0]
+    assert record['cgroup_cpu_ns'] == 250
+    assert record['cgroup_memory_bytes'] == 20
+    assert record['cgroup_memory_peak_bytes'] == 40
+    assert record['cgroup_io_read_bytes'] == 10
+    assert record['cgroup_io_write_bytes'] == 3
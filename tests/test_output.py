@@ -0,0 +1,35 @@
+import os
+
+from changes_lxc_wrapper.output import OutputPipe
+
+
+def test_pipe_sinks():
+    first, second = [], []
+
+    pipe = OutputPipe(first.append, second.append)
+    pipe.start()
+
+    os.write(pipe.write_fd, b'hello\n')
+    os.write(pipe.write_fd, b'world\n')
+    pipe.close()
+
+    assert not pipe.thread.is_alive()
+    assert b''.join(first) == b'hello\nworld\n'
+    assert b''.join(second) == b'hello\nworld\n'
+
+
+def test_pipe_sink_error():
+    received = []
+
+    def broken(chunk):
+        raise IOError('sink closed')
+
+    pipe = OutputPipe(broken, received.append)
+    pipe.start()
+
+    os.write(pipe.write_fd, b'hello\n')
+    os.write(pipe.write_fd, b'world\n')
+    pipe.close()
+
+    assert not pipe.thread.is_alive()
+    assert b''.join(received) == b'hello\nworld\n'
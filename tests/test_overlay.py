@@ -0,0 +1,54 @@
+import os
+import subprocess
+
+from changes_lxc_wrapper.overlay import (
+    OVERLAYFS_WHITEOUT_TARGET, apply_delta, get_exclude_args, scan_delta
+)
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fp:
+        fp.write(data)
+
+
+def read(path):
+    with open(path) as fp:
+        return fp.read()
+
+
+def test_delta_roundtrip(tmpdir):
+    base = str(tmpdir.join('base'))
+    delta = str(tmpdir.join('delta'))
+    target = str(tmpdir.join('target'))
+
+    write(os.path.join(base, 'etc/keep'), 'keep')
+    write(os.path.join(base, 'etc/changed'), 'old')
+    write(os.path.join(base, 'etc/deleted'), 'gone')
+    write(os.path.join(base, 'var/lib/thing/data'), 'dir')
+    subprocess.check_call(['cp', '-a', base, target])
+
+    write(os.path.join(delta, 'etc/changed'), 'new')
+    write(os.path.join(delta, 'etc/added'), 'added')
+    os.symlink(OVERLAYFS_WHITEOUT_TARGET, os.path.join(delta, 'etc/deleted'))
+    # a lower directory replaced by a file
+    write(os.path.join(delta, 'var/lib/thing'), 'file')
+
+    whiteouts, opaque, markers = scan_delta(base, delta)
+    assert whiteouts == ['etc/deleted', 'var/lib/thing']
+    assert opaque == []
+    assert markers == ['etc/deleted']
+
+    archive = str(tmpdir.join('delta.tar.xz'))
+    subprocess.check_call(
+        ['tar', '-Jcf', archive, '-C', delta] + get_exclude_args(markers) + ['.'])
+    listing = subprocess.check_output(['tar', '-tJf', archive]).decode('utf-8')
+    assert './etc/deleted' not in listing.splitlines()
+
+    apply_delta(target, archive, {'whiteouts': whiteouts, 'opaque': opaque})
+
+    assert read(os.path.join(target, 'etc/keep')) == 'keep'
+    assert read(os.path.join(target, 'etc/changed')) == 'new'
+    assert read(os.path.join(target, 'etc/added')) == 'added'
+    assert not os.path.lexists(os.path.join(target, 'etc/deleted'))
+    assert read(os.path.join(target, 'var/lib/thing')) == 'file'
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from mock import patch
+
+from changes_lxc_wrapper.package_cache import (
+    PackageCache, parse_mount_entry, parse_package_caches
+)
+
+
+def test_parse_package_caches():
+    assert parse_package_caches('apt, pip') == ['apt', 'pip']
+    with pytest.raises(ValueError):
+        parse_package_caches('apt,gems')
+
+
+@patch('changes_lxc_wrapper.package_cache.get_overlay_fstype', return_value='overlay')
+def test_mount_entries(mock_fstype, tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')), lxc_path=str(tmpdir.mkdir('lxc')))
+
+    mounts, locks = cache.get_mount_entries(
+        'job1', ['apt', 'pip', 'npm'], 'trusty', project=None)
+    cache.release_locks(locks)
+    # pip and npm are kept per project
+    assert len(mounts) == 1
+
+    mounts, locks = cache.get_mount_entries(
+        'job1', ['apt', 'pip'], 'trusty', project='proj')
+    cache.release_locks(locks)
+
+    apt_path = cache.get_path('apt', 'trusty')
+    pip_path = cache.get_path('pip', 'trusty', 'proj')
+    assert apt_path.endswith('packages/trusty/_shared/apt')
+    assert pip_path.endswith('packages/trusty/proj/pip')
+
+    source, target, fstype, options = parse_mount_entry(mounts[0])
+    assert (source, target, fstype) == ('overlay', 'var/cache/apt/archives', 'overlay')
+    assert options['lowerdir'] == apt_path
+    assert options['upperdir'] == os.path.join(cache.get_work_path('job1', 'apt'), 'upper')
+    assert 'workdir' in options
+    assert mounts[1] == '{} home/ubuntu/.cache/pip none bind,create=dir 0 0'.format(pip_path)
+
+
+@patch('changes_lxc_wrapper.package_cache.get_overlay_fstype', return_value='overlay')
+def test_harvest(mock_fstype, tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')), lxc_path=str(tmpdir.mkdir('lxc')))
+    mounts, locks = cache.get_mount_entries('job1', ['apt'], 'trusty')
+    cache.release_locks(locks)
+
+    apt_path = cache.get_path('apt', 'trusty')
+    with open(os.path.join(apt_path, 'old.deb'), 'w') as fp:
+        fp.write('shared')
+
+    upper = parse_mount_entry(mounts[0])[3]['upperdir']
+    os.makedirs(os.path.join(upper, 'partial'))
+    for name, data in (('new.deb', 'new'), ('old.deb', 'private'),
+                       ('lock', ''), ('partial/half.deb', 'ha')):
+        with open(os.path.join(upper, name), 'w') as fp:
+            fp.write(data)
+
+    cache.harvest(mounts, 'job1')
+
+    assert sorted(os.listdir(apt_path)) == ['new.deb', 'old.deb']
+    # files already present are never replaced
+    with open(os.path.join(apt_path, 'old.deb')) as fp:
+        assert fp.read() == 'shared'
+    assert not os.path.exists(cache.get_work_path('job1', 'apt'))
+
+
+def test_remove_in_use(tmpdir):
+    lxc_path = tmpdir.mkdir('lxc')
+    cache = PackageCache(str(tmpdir.join('cache')), lxc_path=str(lxc_path))
+    mounts, locks = cache.get_mount_entries('job1', ['pip'], 'trusty', project='proj')
+    cache.release_locks(locks)
+    with open(os.path.join(cache.get_path('pip', 'trusty', 'proj'), 'a.whl'), 'w') as fp:
+        fp.write('wheel')
+
+    entry, = cache.list()
+    assert entry.id == 'trusty/proj/pip'
+    assert entry.size == len('wheel')
+
+    lxc_path.mkdir('job1').join('config').write(
+        'lxc.mount.entry = {}\n'.format(mounts[0]))
+    assert cache.get_users(entry) == ['job1']
+    assert not cache.remove(entry)
+
+    lxc_path.join('job1').remove()
+    assert cache.remove(entry)
+    assert cache.list() == []
+
+
+def test_remove_stale_work(tmpdir):
+    lxc_path = tmpdir.mkdir('lxc')
+    lxc_path.mkdir('job1')
+    cache = PackageCache(str(tmpdir.join('cache')), lxc_path=str(lxc_path))
+    for name in ('job1', 'job2'):
+        cache.get_overlay_entry(cache.get_path('apt', 'trusty'), 'var/cache/apt/archives',
+                                name, 'apt')
+
+    assert cache.remove_stale_work() == ['job2']
+    assert os.path.exists(cache.get_work_path('job1', 'apt'))
@@ -0,0 +1,123 @@
+import hashlib
+import lzma
+import os
+import subprocess
+import sys
+
+import pytest
+
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from changes_lxc_wrapper.image_store import LocalImageStore
+from changes_lxc_wrapper.layers import ChunkStore, write_manifest
+from changes_lxc_wrapper.peers import PeerImageStore, load_peers
+
+SERVE_SCRIPT = """
+import sys
+from changes_lxc_wrapper.peers import ImageServer
+server = ImageServer(sys.argv[1], ('127.0.0.1', 0))
+print(server.server_address[1], flush=True)
+server.serve_forever()
+"""
+
+IMAGE_KEY = 'ubuntu/precise/amd64/311a862b-dd15-4c44-90f1-fa95a7621860'
+
+
+def start_peer(root):
+    proc = subprocess.Popen([sys.executable, '-c', SERVE_SCRIPT, root],
+                            stdout=subprocess.PIPE)
+    port = int(proc.stdout.readline())
+    return proc, 'http://127.0.0.1:{}'.format(port)
+
+
+@pytest.fixture
+def peers(request, tmpdir):
+    """
+    Two hosts: one holding a complete image and chunk, one holding a
+    corrupt copy of the chunk.
+    """
+    good = ChunkStore(str(tmpdir.join('good', 'chunks')))
+    entry = good.add(b'chunk' * 1000)
+    image_path = str(tmpdir.join('good', *IMAGE_KEY.split('/')))
+    os.makedirs(image_path)
+    with open(os.path.join(image_path, 'config'), 'w') as fp:
+        fp.write('lxc.arch = x86_64\n')
+    write_manifest(image_path, {})
+
+    bad = ChunkStore(str(tmpdir.join('bad', 'chunks')))
+    path = bad.get_path(entry['id'])
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fp:
+        fp.write(lzma.compress(b'garbage'))
+
+    procs = []
+    urls = []
+    for name in ('good', 'bad'):
+        proc, url = start_peer(str(tmpdir.join(name)))
+        procs.append(proc)
+        urls.append(url)
+
+    def stop():
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+    request.addfinalizer(stop)
+
+    return urls, entry
+
+
+def test_load_peers(tmpdir):
+    peers_file = tmpdir.join('peers')
+    peers_file.write('# rack 12\nhttp://a:8411/\n\nhttp://b:8411\n')
+    assert load_peers(['http://b:8411'], str(peers_file)) == [
+        'http://b:8411', 'http://a:8411']
+    assert load_peers(['http://c'], str(tmpdir.join('missing'))) == ['http://c']
+
+
+def test_serves_complete_images_only(peers, tmpdir):
+    (good, _), entry = peers
+
+    with urlopen('{}/{}/config'.format(good, IMAGE_KEY)) as fp:
+        assert fp.read() == b'lxc.arch = x86_64\n'
+
+    for key in ('{}/.verified'.format(IMAGE_KEY),
+                '{}/../../../../good/chunks'.format(IMAGE_KEY),
+                'ubuntu/precise/amd64/missing/config'):
+        with pytest.raises(HTTPError) as exc:
+            urlopen('{}/{}'.format(good, key))
+        assert exc.value.code == 404
+
+
+def test_fetch_from_peers(peers, tmpdir):
+    urls, entry = peers
+
+    # the corrupt peer is tried first, but rejected by hash
+    store = PeerImageStore(urls)
+    store.get_peers = lambda: list(reversed(urls))
+    chunks = ChunkStore(str(tmpdir.join('local')))
+    store.get_chunks(chunks, [entry])
+    assert chunks.missing([entry]) == []
+    assert store.peer_hits == 1
+
+    assert store.exists('{}/config'.format(IMAGE_KEY))
+    assert not store.exists('{}/snapshot_id'.format(IMAGE_KEY))
+
+
+def test_fallback_to_store(peers, tmpdir):
+    urls, _ = peers
+
+    remote = LocalImageStore(str(tmpdir.join('remote')))
+    data = b'only in the object store'
+    src = str(tmpdir.join('src'))
+    with open(src, 'wb') as fp:
+        fp.write(data)
+    remote.put(src, '{}/snapshot_id'.format(IMAGE_KEY))
+
+    store = PeerImageStore(urls, remote)
+    dest = str(tmpdir.join('dest'))
+    store.get_verified('{}/snapshot_id'.format(IMAGE_KEY), dest,
+                       hashlib.sha256(data).hexdigest())
+    with open(dest, 'rb') as fp:
+        assert fp.read() == data
+    assert store.peer_misses == 1
@@ -0,0 +1,53 @@
+import fcntl
+import os
+
+from mock import Mock
+
+from changes_lxc_wrapper.pipeline import PostBuildPipeline
+
+
+def test_stages_run_in_order(tmpdir):
+    calls = []
+    pipeline = PostBuildPipeline(str(tmpdir))
+    pipeline.submit('job1', [
+        ('create_image', lambda: calls.append('create_image'), False),
+        ('upload', lambda: calls.append('upload'), False),
+        ('teardown', lambda failed: calls.append(('teardown', failed)), True),
+    ])
+    pipeline.close()
+
+    assert calls == ['create_image', 'upload', ('teardown', False)]
+
+
+def test_failure_skips_stages(tmpdir):
+    upload = Mock()
+    report = Mock()
+    pipeline = PostBuildPipeline(str(tmpdir))
+
+    assert not pipeline.process('job1', [
+        ('create_image', Mock(side_effect=Exception('disk full')), False),
+        ('upload', upload, False),
+        ('update_snapshot_image', report, True),
+    ])
+
+    assert not upload.called
+    report.assert_called_once_with(failed=True)
+
+
+def test_stage_limit(tmpdir):
+    pipeline = PostBuildPipeline(str(tmpdir), limits={'upload': 2})
+
+    with pipeline.acquire('upload'):
+        with pipeline.acquire('upload'):
+            # both slots are taken
+            for slot in range(2):
+                with open(os.path.join(str(tmpdir), 'upload.{}.lock'.format(slot))) as fp:
+                    try:
+                        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        pass
+                    else:
+                        raise AssertionError('slot {} is free'.format(slot))
+
+    with open(os.path.join(str(tmpdir), 'upload.0.lock')) as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
@@ -0,0 +1,111 @@
+import os
+
+from mock import Mock, patch
+from time import time
+
+from changes_lxc_wrapper.history import JobHistory
+from changes_lxc_wrapper.image_store import LocalImageStore, RateLimiter
+from changes_lxc_wrapper.integrity import describe_file
+from changes_lxc_wrapper.layers import write_manifest
+from changes_lxc_wrapper.prefetch import Prefetcher
+
+BUSY_PROJECT = 'a2c4f8ee-1a6e-4e0f-a5a4-3a1b8f4e0c11'
+QUIET_PROJECT = 'd1c0b1b7-5c0d-4f63-8bd6-9bb0e6b8e7a3'
+OLD_IMAGE = '311a862b-dd15-4c44-90f1-fa95a7621860'
+NEW_IMAGE = 'af986ceb-6640-4b69-b722-42df633ed0b7'
+QUIET_IMAGE = '5b9a0ef4-0a7a-4d0e-8d49-6f3b0b5d7e11'
+
+
+def get_snapshots():
+    return [{
+        'project': {'id': BUSY_PROJECT},
+        'isActive': False,
+        'images': [{'id': OLD_IMAGE}],
+    }, {
+        'project': {'id': BUSY_PROJECT},
+        'isActive': True,
+        'images': [{'id': NEW_IMAGE}],
+    }, {
+        'project': {'id': QUIET_PROJECT},
+        'isActive': True,
+        'images': [{'id': QUIET_IMAGE}],
+    }]
+
+
+def create_remote_image(remote_root, image_id, data):
+    path = os.path.join(remote_root, 'ubuntu', 'trusty', 'amd64', image_id)
+    os.makedirs(path)
+    files = {}
+    for name, content in (('rootfs.tar.xz', data), ('config', b'lxc.arch = x86_64\n'),
+                          ('snapshot_id', image_id.encode('utf-8'))):
+        with open(os.path.join(path, name), 'wb') as fp:
+            fp.write(content)
+        files[name] = describe_file(os.path.join(path, name))
+    write_manifest(path, {'snapshot': image_id, 'files': files})
+
+
+def test_job_history(tmpdir):
+    history = JobHistory(str(tmpdir.join('jobs.log')))
+    history.record(OLD_IMAGE, 'precise', when=100)
+    history.record(NEW_IMAGE, 'trusty')
+    assert [e['snapshot'] for e in history.read()] == [OLD_IMAGE, NEW_IMAGE]
+
+    history.prune(since=time() - 60)
+    assert [e['release'] for e in history.read()] == ['trusty']
+
+
+def test_rate_limiter():
+    sleeps = []
+    limiter = RateLimiter(1000)
+    with patch('changes_lxc_wrapper.image_store.sleep', sleeps.append):
+        limiter.consume(1000)
+        assert not sleeps
+        limiter.consume(500)
+    assert len(sleeps) == 1 and 0.4 < sleeps[0] <= 0.5
+
+
+def get_prefetcher(tmpdir, **kwargs):
+    cache = Mock()
+    cache.root = str(tmpdir.join('cache'))
+    cache.total_size = 0
+    api = Mock()
+    api.list_snapshots.return_value = get_snapshots()
+
+    history = JobHistory(os.path.join(cache.root, 'jobs.log'))
+    history.record(OLD_IMAGE, 'trusty')
+    history.record(OLD_IMAGE, 'trusty')
+
+    remote = str(tmpdir.join('remote'))
+    create_remote_image(remote, NEW_IMAGE, b'x' * 1000)
+    create_remote_image(remote, QUIET_IMAGE, b'y' * 1000)
+
+    return Prefetcher(api, cache, LocalImageStore(remote), **kwargs)
+
+
+def test_candidates(tmpdir):
+    prefetcher = get_prefetcher(tmpdir)
+    with patch('changes_lxc_wrapper.container.SNAPSHOT_CACHE', prefetcher.cache.root):
+        candidates = prefetcher.get_candidates(get_snapshots())
+    assert [(c.image_id, c.jobs, c.release) for c in candidates] == [
+        (NEW_IMAGE, 2, 'trusty')]
+
+
+def test_run_once(tmpdir):
+    prefetcher = get_prefetcher(tmpdir, bandwidth=10 * 1024 * 1024)
+    with patch('changes_lxc_wrapper.container.SNAPSHOT_CACHE', prefetcher.cache.root):
+        assert prefetcher.run_once() == 1
+        assert prefetcher.get_candidates(get_snapshots()) == []
+
+    image_path = os.path.join(prefetcher.cache.root, 'ubuntu', 'trusty', 'amd64', NEW_IMAGE)
+    with open(os.path.join(image_path, 'rootfs.tar.xz'), 'rb') as fp:
+        assert fp.read() == b'x' * 1000
+    assert not os.path.exists(os.path.join(
+        prefetcher.cache.root, 'ubuntu', 'trusty', 'amd64', QUIET_IMAGE))
+    assert isinstance(prefetcher.image_store.rate_limiter, RateLimiter)
+
+
+def test_run_once_over_budget(tmpdir):
+    prefetcher = get_prefetcher(tmpdir, max_disk=1500)
+    prefetcher.cache.total_size = 1000
+    with patch('changes_lxc_wrapper.container.SNAPSHOT_CACHE', prefetcher.cache.root):
+        assert prefetcher.run_once() == 0
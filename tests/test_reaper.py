@@ -0,0 +1,46 @@
+import os
+import subprocess
+
+from mock import Mock
+
+from changes_lxc_wrapper.reaper import ContainerReaper, get_owner_id, is_orphaned
+
+
+def test_is_orphaned(tmpdir):
+    owner_path = tmpdir.join('owner.pid')
+    assert not is_orphaned(str(owner_path))
+
+    owner_path.write(str(os.getpid()))
+    assert not is_orphaned(str(owner_path))
+
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    owner_path.write(str(proc.pid))
+    assert is_orphaned(str(owner_path))
+
+
+def test_is_orphaned_reused_pid(tmpdir):
+    owner_path = tmpdir.join('owner.pid')
+    owner_path.write(get_owner_id())
+    assert not is_orphaned(str(owner_path))
+
+    # our pid, as if it had belonged to an earlier process
+    pid, start_time = get_owner_id().split()
+    owner_path.write('{} {}'.format(pid, int(start_time) - 1))
+    assert is_orphaned(str(owner_path))
+
+
+def test_reaper_destroys_in_background():
+    failing = Mock()
+    failing.destroy.side_effect = Exception('boom')
+    containers = [Mock(), failing, Mock()]
+
+    reaper = ContainerReaper(concurrency=2)
+    reaper.start()
+    for container in containers:
+        reaper.submit(container)
+    reaper.close()
+
+    for container in containers:
+        container.destroy.assert_called_once_with()
+    assert not reaper.workers
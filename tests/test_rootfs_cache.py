@@ -0,0 +1,67 @@
+import os
+import subprocess
+
+import pytest
+
+from changes_lxc_wrapper.rootfs_cache import RootfsCache
+
+
+def make_archive(path, files):
+    src = path + '.src'
+    os.makedirs(src)
+    for name, data in files.items():
+        full_path = os.path.join(src, name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as fp:
+            fp.write(data)
+    subprocess.check_call(['tar', '-Jcf', path, '-C', src, '.'])
+
+
+def test_extract_chain(tmpdir):
+    base = str(tmpdir.join('base.tar.xz'))
+    delta = str(tmpdir.join('delta.tar.xz'))
+    make_archive(base, {'etc/hostname': 'base', 'etc/old': 'old'})
+    make_archive(delta, {'etc/hostname': 'delta'})
+
+    lxc_path = tmpdir.mkdir('lxc')
+    cache = RootfsCache(str(tmpdir.join('cache')), lxc_path=str(lxc_path))
+    assert cache.get('snap') is None
+
+    entry = cache.extract('snap', [
+        ('parent', base, {}),
+        ('snap', delta, {'whiteouts': ['etc/old'], 'opaque': []}),
+    ])
+
+    with open(os.path.join(entry.rootfs, 'etc/hostname')) as fp:
+        assert fp.read() == 'delta'
+    assert not os.path.exists(os.path.join(entry.rootfs, 'etc/old'))
+    assert entry.size == len('delta')
+    assert entry.chain == ['parent', 'snap']
+    assert [e.id for e in cache.list()] == ['snap']
+
+    # a second extract reuses the existing entry
+    assert cache.extract('snap', []).path == entry.path
+
+    # base container defined on the rootfs, plus a clone layered on top
+    lxc_path.mkdir('snap').join('config').write('lxc.rootfs = {}\n'.format(entry.rootfs))
+    lxc_path.mkdir('clone').join('config').write(
+        'lxc.rootfs = overlayfs:{}:/var/lib/lxc/clone/delta0\n'.format(entry.rootfs))
+
+    assert cache.get_users(entry) == ['clone']
+    with pytest.raises(AssertionError):
+        cache.remove(entry)
+
+    lxc_path.join('clone').remove()
+    cache.remove(entry)
+    assert not os.path.exists(entry.path)
+    assert not lxc_path.join('snap').check()
+    assert cache.list() == []
+
+
+def test_failed_extract_leaves_nothing(tmpdir):
+    cache = RootfsCache(str(tmpdir))
+    with pytest.raises(Exception):
+        cache.extract('snap', [('snap', str(tmpdir.join('missing.tar.xz')), {})])
+
+    assert cache.get('snap') is None
+    assert [n for n in os.listdir(cache.root) if not n.endswith('.lock')] == []
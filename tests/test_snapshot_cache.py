@@ -4,6 +4,7 @@ from mock import Mock
 from subprocess import check_call
 from uuid import UUID
 
+from changes_lxc_wrapper.layers import ChunkStore, write_manifest
 from changes_lxc_wrapper.snapshot_cache import SnapshotCache
 
 
@@ -48,3 +49,70 @@ def test_simple():
     assert cache.total_size == 0
 
     assert not os.path.exists('{}/ubuntu/precise/i386/af986ceb-6640-4b69-b722-42df633ed0b7'.format(CACHE_PATH))
+
+
+def test_shared_chunks():
+    mock_api = Mock()
+    mock_api.list_snapshots.return_value = []
+
+    setup_dummy_cache(CACHE_PATH)
+
+    chunks = ChunkStore('{}/chunks'.format(CACHE_PATH))
+    shared = chunks.add(b'shared' * 100)
+    only_1 = chunks.add(b'first' * 100)
+    only_2 = chunks.add(b'second' * 100)
+
+    snapshot_1_path = '{}/ubuntu/precise/i386/311a862b-dd15-4c44-90f1-fa95a7621860'.format(CACHE_PATH)
+    snapshot_2_path = '{}/ubuntu/precise/i386/af986ceb-6640-4b69-b722-42df633ed0b7'.format(CACHE_PATH)
+    write_manifest(snapshot_1_path, {'chunks': [shared, only_1]})
+    write_manifest(snapshot_2_path, {'chunks': [shared, only_2]})
+
+    cache = SnapshotCache(CACHE_PATH, mock_api)
+    cache.initialize()
+
+    cache.snapshots.sort(key=lambda x: x.id)
+    assert len(cache.snapshots) == 2
+
+    snapshot_1, snapshot_2 = cache.snapshots
+    assert snapshot_1.size == snapshot_1.dir_size + only_1['compressed_size']
+    assert snapshot_1.shared_size == shared['compressed_size']
+    assert cache.total_size == (
+        snapshot_1.dir_size + snapshot_2.dir_size +
+        shared['compressed_size'] + only_1['compressed_size'] +
+        only_2['compressed_size'])
+
+    cache.remove(snapshot_2)
+
+    assert not chunks.has(only_2['id'])
+    assert chunks.has(shared['id'])
+    assert snapshot_1.size == (
+        snapshot_1.dir_size + shared['compressed_size'] + only_1['compressed_size'])
+    assert snapshot_1.shared_size == 0
+
+
+def test_truncated_image_is_invalid():
+    mock_api = Mock()
+    mock_api.list_snapshots.return_value = [{
+        'id': 'a',
+        'project': {'id': 'b4c2a2c6-8b5f-4b8a-9a8e-0f7f1b1f5e2a'},
+        'dateCreated': '2014-01-01T00:00:00.000000',
+        'isActive': False,
+        'images': [
+            {'id': '311a862b-dd15-4c44-90f1-fa95a7621860'},
+            {'id': 'af986ceb-6640-4b69-b722-42df633ed0b7'},
+        ],
+    }]
+
+    setup_dummy_cache(CACHE_PATH)
+
+    snapshot_2_path = '{}/ubuntu/precise/i386/af986ceb-6640-4b69-b722-42df633ed0b7'.format(CACHE_PATH)
+    write_manifest(snapshot_2_path, {'files': {
+        'foo': {'size': 10, 'sha256': 'abc'},
+    }})
+
+    cache = SnapshotCache(CACHE_PATH, mock_api)
+    cache.initialize()
+
+    cache.snapshots.sort(key=lambda x: x.id)
+    assert cache.snapshots[0].is_valid
+    assert not cache.snapshots[1].is_valid
@@ -0,0 +1,38 @@
+from mock import patch
+
+from changes_lxc_wrapper.tmpfs import (
+    TMPFS_SOURCE, get_available_memory, get_tmpfs_layers, mount_tmpfs
+)
+
+
+def test_get_available_memory(tmpdir):
+    meminfo = tmpdir.join('meminfo')
+    meminfo.write('MemTotal: 8000 kB\nMemFree: 1000 kB\nMemAvailable: 3000 kB\n')
+    assert get_available_memory(str(meminfo)) == 3000 * 1024
+
+    meminfo.write('MemTotal: 8000 kB\nMemFree: 1000 kB\nCached: 500 kB\n')
+    assert get_available_memory(str(meminfo)) == 1500 * 1024
+
+
+def test_get_tmpfs_layers(tmpdir):
+    mounts = tmpdir.join('mounts')
+    mounts.write(
+        'tmpfs /run tmpfs rw 0 0\n'
+        '{} /var/lib/lxc/job1/tmpfs tmpfs rw,size=1048576k 0 0\n'.format(TMPFS_SOURCE)
+    )
+    assert get_tmpfs_layers(str(mounts)) == ['/var/lib/lxc/job1/tmpfs']
+
+
+@patch('changes_lxc_wrapper.tmpfs.subprocess.check_call')
+@patch('changes_lxc_wrapper.tmpfs.get_memory_headroom', return_value=5 * 1024)
+def test_mount_tmpfs(mock_headroom, mock_call, tmpdir):
+    path = str(tmpdir.join('tmpfs'))
+    lock_path = str(tmpdir.join('tmpfs.lock'))
+
+    assert not mount_tmpfs(path, 4 * 1024, reserve=2 * 1024, lock_path=lock_path)
+    assert not mock_call.called
+
+    assert mount_tmpfs(path, 2 * 1024, reserve=2 * 1024, lock_path=lock_path)
+    mock_call.assert_called_once_with([
+        'mount', '-t', 'tmpfs', '-o', 'size=2048,mode=0755', TMPFS_SOURCE, path,
+    ])
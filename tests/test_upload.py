@@ -0,0 +1,71 @@
+import hashlib
+import os
+
+import pytest
+
+from collections import Counter
+from mock import patch
+
+from changes_lxc_wrapper.image_store import UPLOAD_DIR, LocalImageStore
+from changes_lxc_wrapper.upload import MultipartUpload, upload_file
+
+
+class FlakyImageStore(LocalImageStore):
+    def __init__(self, root, failures):
+        super().__init__(root)
+        self.failures = failures
+        self.attempts = Counter()
+
+    def put_part(self, key, upload_id, number, data):
+        self.attempts[number] += 1
+        if self.failures.get(number, 0) >= self.attempts[number]:
+            raise IOError('Connection reset')
+        return super().put_part(key, upload_id, number, data)
+
+
+def test_multipart_upload(tmpdir):
+    store = LocalImageStore(str(tmpdir))
+    data = os.urandom(10000)
+
+    upload = MultipartUpload(store, 'ubuntu/precise/amd64/abc/rootfs.tar.xz', part_size=1024)
+    for offset in range(0, len(data), 700):
+        upload.write(data[offset:offset + 700])
+        # nothing is visible until the upload completes
+        assert not store.exists('ubuntu/precise/amd64/abc/rootfs.tar.xz')
+    assert upload.close() == {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+    assert len(upload.futures) == 10
+
+    with store.open('ubuntu/precise/amd64/abc/rootfs.tar.xz') as fp:
+        assert fp.read() == data
+    assert os.listdir(str(tmpdir.join(UPLOAD_DIR))) == []
+
+
+def test_empty_upload(tmpdir):
+    store = LocalImageStore(str(tmpdir))
+    MultipartUpload(store, 'empty').close()
+    with store.open('empty') as fp:
+        assert fp.read() == b''
+
+
+@patch('changes_lxc_wrapper.upload.sleep')
+def test_retries_failed_parts_only(mock_sleep, tmpdir):
+    store = FlakyImageStore(str(tmpdir), failures={2: 2})
+    src = tmpdir.join('src')
+    src.write_binary(b'x' * 3000)
+
+    upload_file(store, str(src), 'dest', part_size=1024)
+    assert store.attempts == {1: 1, 2: 3, 3: 1}
+    with store.open('dest') as fp:
+        assert fp.read() == b'x' * 3000
+
+
+@patch('changes_lxc_wrapper.upload.sleep')
+def test_failed_upload_is_aborted(mock_sleep, tmpdir):
+    store = FlakyImageStore(str(tmpdir), failures={1: MultipartUpload.max_attempts})
+    src = tmpdir.join('src')
+    src.write_binary(b'x' * 100)
+
+    with pytest.raises(IOError):
+        upload_file(store, str(src), 'dest', part_size=1024)
+    assert not store.exists('dest')
+    assert os.listdir(str(tmpdir.join(UPLOAD_DIR))) == []
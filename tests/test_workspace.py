@@ -0,0 +1,55 @@
+import os
+
+from changes_lxc_wrapper.workspace import WorkspaceCache
+
+
+def test_claim(tmpdir):
+    lxc_path = tmpdir.mkdir('lxc')
+    cache = WorkspaceCache(str(tmpdir.join('cache')), lxc_path=str(lxc_path))
+    cache.max_slots = 2
+
+    assert cache.get_mount_entries(None, ['/home/ubuntu/.ccache']) == ([], [])
+
+    mounts, locks = cache.get_mount_entries('proj', ['/home/ubuntu/.ccache'])
+    slot_path = os.path.join(cache.root, 'proj', 'home_ubuntu_.ccache', '0')
+    assert mounts == ['{} home/ubuntu/.ccache none bind,create=dir 0 0'.format(slot_path)]
+
+    # still being claimed by the first launch
+    other_mounts, other_locks = cache.get_mount_entries('proj', ['/home/ubuntu/.ccache'])
+    assert other_mounts[0].startswith(slot_path[:-1] + '1 ')
+    cache.release_locks(other_locks)
+
+    # saved in the first container's config, so in use once unlocked
+    lxc_path.mkdir('job1').join('config').write(
+        'lxc.mount.entry = {}\n'.format(mounts[0]))
+    cache.release_locks(locks)
+    lxc_path.mkdir('job2').join('config').write(
+        'lxc.mount.entry = {}\n'.format(other_mounts[0]))
+    assert cache.get_mount_entries('proj', ['/home/ubuntu/.ccache']) == ([], [])
+
+    # kept after the job for the next one
+    with open(os.path.join(slot_path, 'cached.o'), 'w') as fp:
+        fp.write('object')
+    lxc_path.join('job1').remove()
+    mounts, locks = cache.get_mount_entries('proj', ['/home/ubuntu/.ccache'])
+    cache.release_locks(locks)
+    assert mounts[0].startswith(slot_path + ' ')
+    assert os.path.exists(os.path.join(slot_path, 'cached.o'))
+
+
+def test_remove(tmpdir):
+    lxc_path = tmpdir.mkdir('lxc')
+    cache = WorkspaceCache(str(tmpdir.join('cache')), lxc_path=str(lxc_path))
+    mounts, locks = cache.get_mount_entries('proj', ['/build'])
+    cache.release_locks(locks)
+
+    slot, = cache.list()
+    assert slot.id == 'proj/build/0'
+
+    lxc_path.mkdir('job1').join('config').write(
+        'lxc.mount.entry = {}\n'.format(mounts[0]))
+    assert not cache.remove(slot)
+
+    lxc_path.join('job1').remove()
+    assert cache.remove(slot)
+    assert cache.list() == []